@@ -0,0 +1,901 @@
+# Benchmarks for the filters in nlds_lib
+# Usage: python nlds_benchmark.py
+#        python nlds_benchmark.py --check
+#        python nlds_benchmark.py --suite [--output results.json] [--baseline baseline.json]
+
+# Author: Gerardo Durán-Martín (@gerdm)
+
+import jax
+import sys
+import json
+import argparse
+import platform
+import jax.numpy as jnp
+import nlds_lib as ds
+from jax import random
+from itertools import product
+from functools import partial
+from time import perf_counter
+
+
+def fz(x, dt=0.4):
+    return x + dt * jnp.array([jnp.sin(x[1]), jnp.cos(x[0])])
+
+
+def fx(x):
+    return x
+
+
+def time_call(f, *args, nruns=3):
+    """
+    Time the execution of f(*args), blocking until
+    the result is available
+
+    Returns
+    -------
+    * float: time (in seconds) of the first call
+    * float: best time (in seconds) over nruns further calls
+    """
+    tinit = perf_counter()
+    jax.block_until_ready(f(*args))
+    time_first = perf_counter() - tinit
+
+    time_best = time_first
+    for _ in range(nruns):
+        tinit = perf_counter()
+        jax.block_until_ready(f(*args))
+        time_best = min(time_best, perf_counter() - tinit)
+    return time_first, time_best
+
+
+def benchmark_ekf_scan(nsteps_list=(100, 1_000, 10_000, 100_000), loop_max_steps=1_000, atol=1e-4):
+    """
+    Compare the Python-loop and the compiled (lax.scan) versions of the
+    Extended Kalman Filter. The loop version is only run up to loop_max_steps.
+    The filtered means of both versions must agree within atol; an
+    AssertionError is raised otherwise
+    """
+    Q = jnp.eye(2) * 0.001
+    R = jnp.eye(2) * 0.05
+    x0 = jnp.array([1.5, 0.0])
+    ekf = ds.ExtendedKalmanFilter(fz, fx, Q, R)
+    key = random.PRNGKey(314)
+
+    print(f"{'nsteps':>8} {'loop (s)':>10} {'scan 1st (s)':>13} {'scan (s)':>10} {'speedup':>8} {'max diff':>9}")
+    for nsteps in nsteps_list:
+        sample_obs = x0 + random.normal(key, (nsteps, 2))
+        time_first, time_scan = time_call(ekf.filter, x0, sample_obs)
+
+        if nsteps <= loop_max_steps:
+            filter_loop = partial(ekf.filter, method="loop")
+            _, time_loop = time_call(filter_loop, x0, sample_obs, nruns=0)
+            error = jnp.abs(ekf.filter(x0, sample_obs)[0] - filter_loop(x0, sample_obs)[0]).max()
+            print(f"{nsteps:>8} {time_loop:>10.4f} {time_first:>13.4f} {time_scan:>10.4f} "
+                  f"{time_loop / time_scan:>7.0f}x {error:>9.1e}")
+            assert error < atol, f"scan and loop EKF differ by {error:.2e} >= {atol:.0e} over {nsteps} steps"
+        else:
+            print(f"{nsteps:>8} {'-':>10} {time_first:>13.4f} {time_scan:>10.4f} {'-':>8} {'-':>9}")
+
+
+def benchmark_filter_batch(n_sequences_list=(10, 100, 1_000), nsteps=500):
+    """
+    Compare filtering each sequence in a Python loop against a single
+    call to filter_batch for the Extended and Unscented Kalman filters
+    """
+    Q = jnp.eye(2) * 0.001
+    R = jnp.eye(2) * 0.05
+    x0 = jnp.array([1.5, 0.0])
+    ekf = ds.ExtendedKalmanFilter(fz, fx, Q, R)
+    ukf = ds.UnscentedKalmanFilter(fz, fx, Q, R, alpha=1, beta=0, kappa=2)
+    key = random.PRNGKey(314)
+
+    def filter_each(model, init_state, sample_obs):
+        return [model.filter(x, y) for x, y in zip(init_state, sample_obs)]
+
+    print(f"{'filter':>6} {'nseq':>6} {'per-seq (s)':>12} {'batch (s)':>10} {'speedup':>8}")
+    for name, model in [("ekf", ekf), ("ukf", ukf)]:
+        for n_sequences in n_sequences_list:
+            sample_obs = x0 + random.normal(key, (n_sequences, nsteps, 2))
+            init_state = jnp.tile(x0, (n_sequences, 1))
+            _, time_each = time_call(filter_each, model, init_state, sample_obs, nruns=1)
+            _, time_batch = time_call(model.filter_batch, init_state, sample_obs)
+            print(f"{name:>6} {n_sequences:>6} {time_each:>12.4f} {time_batch:>10.4f} {time_each / time_batch:>7.0f}x")
+
+
+def benchmark_sqrt_ukf(state_sizes=(50, 100, 200, 500), nsteps=100, obs_size=5, atol=1e-4):
+    """
+    Compare the per-step cost of the Unscented Kalman Filter against
+    its square-root version for increasing state sizes. The filtered
+    means and covariances of both filters must agree within atol;
+    an AssertionError is raised otherwise
+    """
+    def fz_ukf(x): return x + 0.01 * jnp.sin(x)
+    def fx_ukf(x): return x[:obs_size]
+
+    key = random.PRNGKey(314)
+    print(f"{'d':>6} {'ukf (ms/step)':>14} {'sr-ukf (ms/step)':>17} {'speedup':>8} {'max diff':>9}")
+    for state_size in state_sizes:
+        Q = jnp.eye(state_size) * 0.001
+        R = jnp.eye(obs_size) * 0.05
+        x0 = jnp.zeros(state_size)
+        sample_obs = random.normal(key, (nsteps, obs_size))
+        ukf = ds.UnscentedKalmanFilter(fz_ukf, fx_ukf, Q, R, alpha=1, beta=0, kappa=0)
+        srukf = ds.SquareRootUnscentedKalmanFilter.from_base(ukf, alpha=1, beta=0, kappa=0)
+        _, time_ukf = time_call(ukf.filter, x0, sample_obs, nruns=1)
+        _, time_srukf = time_call(srukf.filter, x0, sample_obs, nruns=1)
+        time_ukf, time_srukf = 1e3 * time_ukf / nsteps, 1e3 * time_srukf / nsteps
+        moments_ukf, moments_srukf = ukf.filter(x0, sample_obs), srukf.filter(x0, sample_obs)
+        error = max(jnp.abs(a - b).max() for a, b in zip(moments_ukf, moments_srukf))
+        print(f"{state_size:>6} {time_ukf:>14.3f} {time_srukf:>17.3f} {time_ukf / time_srukf:>7.1f}x {error:>9.1e}")
+        assert error < atol, f"UKF and SR-UKF differ by {error:.2e} >= {atol:.0e} for d={state_size}"
+
+
+def benchmark_parallel_kf(nsteps_list=(1_000, 10_000, 100_000), atol=1e-4):
+    """
+    Compare the sequential (lax.scan) and parallel-in-time (associative scan)
+    Kalman filters over a linear-Gaussian model. The filtered means and
+    covariances of both filters must agree within atol; an AssertionError
+    is raised otherwise
+    """
+    A = jnp.array([[1.0, 0.1], [-0.1, 0.95]])
+    C = jnp.array([[1.0, 0.0]])
+    Q = jnp.eye(2) * 0.1
+    R = jnp.eye(1) * 0.3
+    x0 = jnp.zeros(2)
+    ekf = ds.ExtendedKalmanFilter(lambda x: A @ x, lambda x: C @ x, Q, R)
+    pkf = ds.ParallelExtendedKalmanFilter.from_base(ekf)
+    key = random.PRNGKey(314)
+
+    print(f"{'nsteps':>8} {'sequential (s)':>15} {'parallel (s)':>13} {'speedup':>8} {'max diff':>9}")
+    for nsteps in nsteps_list:
+        sample_obs = random.normal(key, (nsteps, 1))
+        _, time_seq = time_call(ekf.filter, x0, sample_obs)
+        _, time_par = time_call(pkf.filter, x0, sample_obs)
+        moments_seq, moments_par = ekf.filter(x0, sample_obs), pkf.filter(x0, sample_obs)
+        error = max(jnp.abs(a - b).max() for a, b in zip(moments_seq, moments_par))
+        print(f"{nsteps:>8} {time_seq:>15.4f} {time_par:>13.4f} {time_seq / time_par:>7.1f}x {error:>9.1e}")
+        assert error < atol, f"sequential and parallel KF differ by {error:.2e} >= {atol:.0e} over {nsteps} steps"
+
+
+def benchmark_streaming(nsteps=2_000, burst_size=32):
+    """
+    Per-observation latency of the online step and step_burst methods
+    """
+    Q = jnp.eye(2) * 0.001
+    R = jnp.eye(2) * 0.05
+    x0 = jnp.array([1.5, 0.0])
+    ekf = ds.ExtendedKalmanFilter(fz, fx, Q, R)
+    ukf = ds.UnscentedKalmanFilter(fz, fx, Q, R, alpha=1, beta=0, kappa=2)
+    key = random.PRNGKey(314)
+    sample_obs = x0 + random.normal(key, (nsteps, 2))
+    obs_list = list(sample_obs)
+    burst_list = [sample_obs[i:i + burst_size] for i in range(0, nsteps, burst_size)]
+
+    def run_step(model):
+        state = model.init(x0)
+        for obs in obs_list:
+            state, _ = model.step(state, obs)
+        return state
+
+    def run_burst(model):
+        state = model.init(x0)
+        for obs_burst in burst_list:
+            state, _ = model.step_burst(state, obs_burst)
+        return state
+
+    print(f"{'filter':>6} {'step (us/obs)':>14} {'burst (us/obs)':>15}")
+    for name, model in [("ekf", ekf), ("ukf", ukf)]:
+        _, time_step = time_call(run_step, model, nruns=1)
+        _, time_burst = time_call(run_burst, model, nruns=1)
+        print(f"{name:>6} {1e6 * time_step / nsteps:>14.1f} {1e6 * time_burst / nsteps:>15.1f}")
+
+
+def benchmark_continuous_ekf(T=20, nsamples=200, dt=0.01):
+    """
+    Run time and accuracy of the integrators of the continuous-discrete
+    Extended Kalman filter. The error is measured against RK4 with a
+    step size 20 times smaller
+    """
+    def fz_duffing(x): return jnp.array([x[1], x[0] - x[0] ** 3])
+
+    Q = jnp.eye(2) * 0.001
+    R = jnp.eye(2) * 0.01
+    x0 = jnp.array([0.5, -0.6])
+    cekf = ds.ContinuousExtendedKalmanFilter(fz_duffing, fx, Q, R)
+    key = random.PRNGKey(314)
+    sample_state, sample_obs, jump_size = cekf.sample(key, x0, T, nsamples, dt=dt)
+    mu_ref, _ = cekf.estimate(sample_state, sample_obs, 20 * jump_size, dt / 20, integrator="rk4")
+
+    configs = [
+        ("rk2", jump_size, dt),
+        ("rk4", jump_size, dt),
+        ("rk4", jump_size // 5, 5 * dt),
+        ("adaptive", 1, jump_size * dt),
+    ]
+    print(f"{'integrator':>10} {'dt':>6} {'1st (s)':>8} {'run (ms)':>9} {'max error':>10}")
+    for integrator, jump, dt_int in configs:
+        estimate = partial(cekf.estimate, integrator=integrator)
+        time_first, time_run = time_call(estimate, sample_state, sample_obs, jump, dt_int)
+        mu_hist, _ = estimate(sample_state, sample_obs, jump, dt_int)
+        error = jnp.abs(mu_hist - mu_ref).max()
+        print(f"{integrator:>10} {dt_int:>6.2f} {time_first:>8.3f} {1e3 * time_run:>9.2f} {error:>10.2e}")
+
+
+def benchmark_bootstrap(nparticles_list=(100, 1_000, 10_000), nsteps=200):
+    """
+    Accuracy (against the exact Kalman filter on a linear-Gaussian model)
+    and run time of the Bootstrap filter for different resampling schemes
+    """
+    A = jnp.array([[1.0, 0.1], [-0.1, 0.95]])
+    C = jnp.array([[1.0, 0.0]])
+    Q = jnp.eye(2) * 0.1
+    R = jnp.eye(1) * 0.3
+    x0 = jnp.zeros(2)
+    kf = ds.ExtendedKalmanFilter(lambda x: A @ x, lambda x: C @ x, Q, R)
+    key = random.PRNGKey(314)
+    _, sample_obs = kf.sample(key, x0, nsteps)
+    mu_kf, _ = kf.filter(x0, sample_obs)
+
+    configs = [("multinomial", 1.0), ("systematic", 1.0), ("systematic", 0.5), ("residual", 0.5)]
+    print(f"{'resampling':>11} {'ess thr':>7} {'N':>6} {'rmse':>8} {'run (ms)':>9}")
+    for resampling, ess_threshold in configs:
+        pf = ds.BootstrapFiltering.from_base(kf, resampling, ess_threshold)
+        for nparticles in nparticles_list:
+            _, time_run = time_call(pf.filter, key, x0, sample_obs, nparticles)
+            mu_pf = pf.filter(key, x0, sample_obs, nparticles)
+            rmse = jnp.sqrt(((mu_pf - mu_kf) ** 2).mean())
+            print(f"{resampling:>11} {ess_threshold:>7.1f} {nparticles:>6} {rmse:>8.4f} {1e3 * time_run:>9.2f}")
+
+
+def benchmark_iekf(nsteps=500, noise_configs=((0.1, 0.001), (0.2, 0.001))):
+    """
+    Accuracy (rmse against the true state) and run time of the Extended,
+    Iterated Extended and Unscented Kalman filters under a range-bearing
+    observation model. Each config is a pair of (state noise, observation noise)
+    """
+    def fx_range(x): return jnp.array([jnp.arctan2(x[1], x[0]), jnp.sqrt(x[0] ** 2 + x[1] ** 2)])
+
+    x0 = jnp.array([1.5, 0.5])
+    key = random.PRNGKey(0)
+    print(f"{'q':>5} {'r':>6} {'filter':>6} {'rmse':>8} {'run (ms)':>9} {'iters':>6}")
+    for q, r in noise_configs:
+        model = ds.NLDS(partial(fz, dt=0.1), fx_range, jnp.eye(2) * q, jnp.eye(2) * r)
+        sample_state, sample_obs = model.sample(key, x0, nsteps)
+        filters = [
+            ("ekf", ds.ExtendedKalmanFilter.from_base(model)),
+            ("iekf", ds.IteratedExtendedKalmanFilter.from_base(model)),
+            ("ukf", ds.UnscentedKalmanFilter.from_base(model, alpha=1, beta=0, kappa=0)),
+        ]
+        for name, kf in filters:
+            _, time_run = time_call(kf.filter, x0, sample_obs)
+            mu_hist, _ = kf.filter(x0, sample_obs)
+            rmse = jnp.sqrt(((mu_hist - sample_state) ** 2).mean())
+            if name == "iekf":
+                n_iter = kf.filter(x0, sample_obs, full_output=True)["n_iter"].mean()
+                n_iter = f"{n_iter:>6.2f}"
+            else:
+                n_iter = f"{'-':>6}"
+            print(f"{q:>5.2f} {r:>6.3f} {name:>6} {rmse:>8.4f} {1e3 * time_run:>9.2f} {n_iter}")
+
+
+def benchmark_fit_noise(nsteps=1_000, grid_size=10, n_iter=100):
+    """
+    Learn isotropic (Q, R) through a grid search over log_likelihood
+    against learning full (Q, R) matrices with fit_noise, for the
+    Extended and the Iterated Extended Kalman filters
+    """
+    A = jnp.array([[1.0, 0.1], [-0.1, 0.95]])
+    C = jnp.array([[1.0, 0.0]])
+    x0 = jnp.zeros(2)
+    model = ds.ExtendedKalmanFilter(lambda x: A @ x, lambda x: C @ x, jnp.eye(2) * 0.1, jnp.eye(1) * 0.3)
+    key = random.PRNGKey(314)
+    _, sample_obs = model.sample(key, x0, nsteps)
+    kf = model.replace_noise(jnp.eye(2), jnp.eye(1))
+    grid = jnp.logspace(-2, 0, grid_size)
+
+    def grid_search():
+        return max((float(kf.replace_noise(q * jnp.eye(2), r * jnp.eye(1)).log_likelihood(x0, sample_obs)), q, r)
+                   for q in grid for r in grid)
+
+    def fit(checkpoint_every=None, kf_init=kf):
+        kf_fit, _ = kf_init.fit_noise(x0, sample_obs, n_iter=n_iter, checkpoint_every=checkpoint_every)
+        return kf_fit.log_likelihood(x0, sample_obs)
+
+    _, time_grid = time_call(grid_search, nruns=0)
+    loglik_grid, *_ = grid_search()
+    print(f"{'method':>18} {'1st (s)':>8} {'run (s)':>8} {'loglik':>10}")
+    print(f"{'grid ' + str(grid_size ** 2):>18} {'-':>8} {time_grid:>8.3f} {loglik_grid:>10.2f}")
+    for checkpoint_every in [None, int(nsteps ** 0.5)]:
+        time_first, time_fit = time_call(fit, checkpoint_every, nruns=1)
+        name = f"fit_noise {n_iter}" + ("" if checkpoint_every is None else " (ckpt)")
+        print(f"{name:>18} {time_first:>8.3f} {time_fit:>8.3f} {fit(checkpoint_every):>10.2f}")
+
+    iekf = ds.IteratedExtendedKalmanFilter.from_base(kf)
+    time_first, time_fit = time_call(fit, None, iekf, nruns=1)
+    name = f"iekf fit_noise {n_iter}"
+    print(f"{name:>18} {time_first:>8.3f} {time_fit:>8.3f} {fit(None, iekf):>10.2f}")
+
+
+def benchmark_structured_ekf(state_sizes=(100, 1_000, 10_000), nsteps=100, rank=10, ekf_max_size=1_000):
+    """
+    Per-step run time of the dense Extended Kalman filter against the
+    diagonal (decoupled), block-decoupled and low-rank versions when
+    learning the weights of a linear model under a tanh observation
+    model. The dense filter is only run up to ekf_max_size
+    """
+    def fx_tanh(w, x): return jnp.tanh(x @ w)
+
+    key = random.PRNGKey(314)
+    print(f"{'d':>6} {'filter':>10} {'ms/step':>8} {'history (MB)':>13}")
+    for state_size in state_sizes:
+        key_x, key_w, key_noise = random.split(random.fold_in(key, state_size), 3)
+        observations = random.normal(key_x, (nsteps, 1, state_size)) / jnp.sqrt(state_size)
+        sample_obs = fx_tanh(random.normal(key_w, (state_size,)), observations)
+        sample_obs = sample_obs + 0.1 * random.normal(key_noise, sample_obs.shape)
+        q, R = 1e-6 * jnp.ones(state_size), jnp.eye(1) * 0.01
+        x0, V0 = jnp.zeros(state_size), jnp.ones(state_size)
+
+        Q_blocks = jnp.tile(1e-6 * jnp.eye(10), (state_size // 10, 1, 1))
+        filters = [
+            ("diag", ds.DecoupledExtendedKalmanFilter(lambda w: w, fx_tanh, q, R, diag_history=True), V0),
+            ("block-10", ds.DecoupledExtendedKalmanFilter(lambda w: w, fx_tanh, Q_blocks, R, diag_history=True), V0),
+            (f"lowrank-{rank}", ds.LowRankExtendedKalmanFilter(lambda w: w, fx_tanh, q, R, rank, diag_history=True), V0),
+        ]
+        if state_size <= ekf_max_size:
+            filters.insert(0, ("ekf", ds.ExtendedKalmanFilter(lambda w: w, fx_tanh, jnp.diag(q), R), jnp.diag(V0)))
+        for name, kf, Vinit in filters:
+            _, time_run = time_call(kf.filter, x0, sample_obs, observations, Vinit, nruns=1)
+            _, cov_hist = kf.filter(x0, sample_obs, observations, Vinit)
+            print(f"{state_size:>6} {name:>10} {1e3 * time_run / nsteps:>8.3f} {cov_hist.nbytes / 2 ** 20:>13.2f}")
+
+
+def benchmark_jacobian(shapes=((10, 10), (100, 1), (100, 100), (1_000, 1), (1_000, 10)), nsteps=50):
+    """
+    Per-step run time of the Extended Kalman filter for each Jacobian
+    strategy when learning the weights w of the observation model
+    tanh(X_t @ w), with X_t: array(obs_size, state_size).
+    Each shape is (state_size, obs_size)
+    """
+    def fx_tanh(w, X): return jnp.tanh(X @ w)
+
+    key = random.PRNGKey(314)
+    print(f"{'d':>6} {'m':>5} {'jacfwd':>8} {'jacrev':>8} {'jvp':>8} {'auto':>8}   (ms/step)")
+    for state_size, obs_size in shapes:
+        key_x, key_y = random.split(random.fold_in(key, state_size * obs_size))
+        observations = random.normal(key_x, (nsteps, obs_size, state_size)) / jnp.sqrt(state_size)
+        sample_obs = random.normal(key_y, (nsteps, obs_size))
+        Q, R = jnp.eye(state_size) * 1e-6, jnp.eye(obs_size) * 0.1
+        x0 = jnp.zeros(state_size)
+        times = []
+        for jacobian in ["jacfwd", "jacrev", "jvp", "auto"]:
+            ekf = ds.ExtendedKalmanFilter(lambda w: w, fx_tanh, Q, R, jacobian)
+            _, time_run = time_call(ekf.filter, x0, sample_obs, observations, nruns=1)
+            times.append(1e3 * time_run / nsteps)
+        print(f"{state_size:>6} {obs_size:>5} " + " ".join(f"{t:>8.3f}" for t in times))
+
+
+def benchmark_rbpf(nparticles_list=(10, 100, 1_000), nsteps=100, nparticles_ref=100_000):
+    """
+    Accuracy (against a Bootstrap filter with nparticles_ref particles) and
+    run time of the Rao-Blackwellised and Bootstrap particle filters on a
+    conditionally linear-Gaussian model
+    """
+    A = jnp.array([[1.0, 0.3], [0.0, 0.9]])
+
+    def fz_cl(z):
+        zn, zl = z[:1], z[1:]
+        return jnp.concatenate((jnp.arctan(zn) + 0.5 * zl[:1], jnp.cos(zn) * A @ zl))
+
+    def fx_cl(z):
+        zn, zl = z[:1], z[1:]
+        return jnp.concatenate((0.1 * zn * jnp.abs(zn), zl[:1] - zl[1:]))
+
+    Q = jnp.diag(jnp.array([0.1, 0.05, 0.05]))
+    R = jnp.eye(2) * 0.1
+    x0 = jnp.zeros(3)
+    model = ds.NLDS(fz_cl, fx_cl, Q, R)
+    key = random.PRNGKey(314)
+    _, sample_obs = model.sample(key, x0, nsteps)
+    bpf = ds.BootstrapFiltering.from_base(model)
+    rbpf = ds.RaoBlackwellParticleFilter.from_base(model, linear_size=2)
+    mu_ref = bpf.filter(key, x0, sample_obs, nparticles_ref)
+
+    print(f"{'filter':>6} {'N':>6} {'rmse':>8} {'run (ms)':>9}")
+    for name, pf in [("bpf", bpf), ("rbpf", rbpf)]:
+        for nparticles in nparticles_list:
+            _, time_run = time_call(pf.filter, key, x0, sample_obs, nparticles)
+            mu_pf = pf.filter(key, x0, sample_obs, nparticles)
+            rmse = jnp.sqrt(((mu_pf - mu_ref) ** 2).mean())
+            print(f"{name:>6} {nparticles:>6} {rmse:>8.4f} {1e3 * time_run:>9.2f}")
+
+
+def benchmark_masked(nsteps=1_000, missing_fractions=(0.0, 0.3, 0.9)):
+    """
+    Run time of the EKF over sequences with missing observations: a single
+    compiled scan with a mask against dispatching one compiled step
+    per time step
+    """
+    Q = jnp.eye(2) * 0.001
+    R = jnp.eye(2) * 0.01
+    x0 = jnp.array([0.5, -0.6])
+    ekf = ds.ExtendedKalmanFilter(fz, fx, Q, R)
+    key = random.PRNGKey(314)
+    _, sample_obs = ekf.sample(key, x0, nsteps)
+
+    def step_loop(sample_obs, mask):
+        state = ekf.init(x0)
+        for obs, available in zip(sample_obs, mask):
+            state, _ = ekf.step(state, obs, mask=available)
+        return state
+
+    print(f"{'missing':>7} {'scan (ms)':>10} {'steps (ms)':>11} {'speedup':>8}")
+    for missing in missing_fractions:
+        mask = random.uniform(random.PRNGKey(1), (nsteps,)) >= missing
+        sample_obs_missing = jnp.where(mask[:, None], sample_obs, jnp.nan)
+        _, time_scan = time_call(partial(ekf.filter, mask=mask), x0, sample_obs_missing)
+        _, time_loop = time_call(step_loop, sample_obs_missing, mask, nruns=1)
+        print(f"{missing:>7.1f} {1e3 * time_scan:>10.2f} {1e3 * time_loop:>11.2f} {time_loop / time_scan:>8.1f}")
+
+
+def benchmark_monitor(nsteps=1_000):
+    """
+    Run time of the EKF without a monitor, with the monitor removed
+    (with_monitor(None)) and with a FilterMonitor attached. The first two
+    compile to the same program: the instrumentation costs nothing when disabled
+    """
+    Q = jnp.eye(2) * 0.001
+    R = jnp.eye(2) * 0.01
+    x0 = jnp.array([0.5, -0.6])
+    ekf = ds.ExtendedKalmanFilter(fz, fx, Q, R)
+    key = random.PRNGKey(314)
+    _, sample_obs = ekf.sample(key, x0, nsteps)
+    monitor = ds.FilterMonitor()
+
+    configs = [("none", ekf), ("disabled", ekf.with_monitor(None)), ("enabled", ekf.with_monitor(monitor))]
+    print(f"{'monitor':>8} {'run (ms)':>9}")
+    for name, model in configs:
+        _, time_run = time_call(model.filter, x0, sample_obs)
+        print(f"{name:>8} {1e3 * time_run:>9.2f}")
+
+    monitor.reset()
+    ekf.with_monitor(monitor).filter(x0, sample_obs)
+    summary = monitor.summary()
+    stage_times = ", ".join(f"{stage} {1e3 * elapsed:.1f}ms" for stage, elapsed in summary["stage_times"].items())
+    print(f"stages: {stage_times}")
+    print(f"max innovation norm {summary['max_innovation_norm']:.3f}, max cond(V) {summary['max_cov_cond']:.1f}")
+
+
+def benchmark_float32(state_size=20, obs_size=5, nsteps=2_000, atol=1e-4):
+    """
+    Accuracy (against float64) and run time of the EKF and UKF in single
+    precision on a nearly-singular linear-Gaussian model (small observation
+    noise, diffuse prior). "naive" runs the standard EKF updates over float32
+    inputs; "float32" uses dtype=jnp.float32 (Cholesky solves, Joseph-form update
+    and symmetrisation). The smallest eigenvalue over the filtered covariances
+    shows whether they remain positive definite.
+
+    x64 is enabled for the duration of the comparison, so that the reference
+    runs in float64. The stable (dtype=jnp.float32) filters must stay within
+    atol of the reference and keep positive-definite covariances; an
+    AssertionError is raised otherwise
+    """
+    x64_enabled = jax.config.read("jax_enable_x64")
+    jax.config.update("jax_enable_x64", True)
+    try:
+        _benchmark_float32(state_size, obs_size, nsteps, atol)
+    finally:
+        jax.config.update("jax_enable_x64", x64_enabled)
+
+
+def _benchmark_float32(state_size, obs_size, nsteps, atol):
+    A = jnp.eye(state_size) * 0.99 + 0.01 * jnp.eye(state_size, k=1)
+    C = jnp.eye(state_size)[:obs_size]
+    Q = jnp.eye(state_size) * 1e-4
+    R = jnp.eye(obs_size) * 1e-6
+    x0 = jnp.zeros(state_size)
+    Vinit = jnp.eye(state_size) * 100.0
+    key = random.PRNGKey(314)
+    _, sample_obs = ds.NLDS(lambda x: A @ x, lambda x: C @ x, Q, R).sample(key, x0, nsteps)
+
+    def to_float32(tree):
+        return jax.tree_util.tree_map(lambda x: x.astype(jnp.float32), tree)
+
+    A32, C32 = to_float32((A, C))
+    fz64, fx64 = (lambda x: A @ x), (lambda x: C @ x)
+    fz32, fx32 = (lambda x: A32 @ x), (lambda x: C32 @ x)
+    args32 = to_float32((x0, sample_obs))
+
+    # The sigma-point weights of the UKF are only cast to float32 with dtype set
+    configs = [
+        ("ekf", ds.ExtendedKalmanFilter(fz64, fx64, Q, R), [
+            ("naive", ds.ExtendedKalmanFilter(fz32, fx32, *to_float32((Q, R)))),
+            ("float32", ds.ExtendedKalmanFilter(fz32, fx32, Q, R, dtype=jnp.float32)),
+        ]),
+        ("ukf", ds.UnscentedKalmanFilter(fz64, fx64, Q, R, 1, 0, 1), [
+            ("float32", ds.UnscentedKalmanFilter(fz32, fx32, Q, R, 1, 0, 1, dtype=jnp.float32)),
+        ]),
+    ]
+    print(f"{'filter':>6} {'mode':>8} {'max error':>10} {'min eig':>10} {'run (ms)':>9}")
+    for name, model64, models32 in configs:
+        mu_ref, _ = model64.filter(x0, sample_obs, Vinit=Vinit)
+        assert mu_ref.dtype == jnp.float64, f"{name}: the reference ran in {mu_ref.dtype}"
+        _, time_run = time_call(partial(model64.filter, Vinit=Vinit), x0, sample_obs)
+        print(f"{name:>6} {'float64':>8} {0.0:>10.2e} {'-':>10} {1e3 * time_run:>9.2f}")
+        for mode, model in models32:
+            filter_32 = partial(model.filter, Vinit=to_float32(Vinit))
+            mu_hist, V_hist = filter_32(*args32)
+            _, time_run = time_call(filter_32, *args32)
+            error = jnp.abs(mu_hist - mu_ref).max()
+            min_eig = jnp.linalg.eigvalsh(V_hist.astype(jnp.float64)).min()
+            print(f"{name:>6} {mode:>8} {error:>10.2e} {min_eig:>10.2e} {1e3 * time_run:>9.2f}")
+            if mode == "float32":
+                assert mu_hist.dtype == jnp.float32, f"{name}: dtype=jnp.float32 ran in {mu_hist.dtype}"
+                assert error < atol, f"{name} float32: max error {error:.2e} >= {atol:.0e}"
+                assert min_eig > 0, f"{name} float32: covariance not positive definite (min eig {min_eig:.2e})"
+
+
+def benchmark_enkf(state_sizes=(40, 1_000, 10_000), nsteps=100, nensemble=20, obs_every=2,
+                   radius=4.0, local_max_size=1_000, ekf_max_size=1_000):
+    """
+    Per-step run time and accuracy (RMSE against the true states after a burn-in
+    of nsteps // 5 steps) of the ensemble Kalman filters on the Lorenz-96 model
+    observing every obs_every-th entry of the state. Localised versions use a
+    Gaspari-Cohn taper over the (periodic) distance between the entries.
+    The localised stochastic EnKF, which factorises an (obs_size, obs_size)
+    matrix at every step, is only run up to local_max_size and the dense
+    EKF up to ekf_max_size
+    """
+    def l96_drift(x, forcing=8.0):
+        return (jnp.roll(x, -1) - jnp.roll(x, 2)) * jnp.roll(x, 1) - x + forcing
+
+    def fz_l96(x, dt=0.05):
+        k1 = l96_drift(x)
+        k2 = l96_drift(x + dt / 2 * k1)
+        k3 = l96_drift(x + dt / 2 * k2)
+        k4 = l96_drift(x + dt * k3)
+        return x + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+    key = random.PRNGKey(314)
+    burn_in = nsteps // 5
+    print(f"{'d':>6} {'filter':>16} {'ms/step':>8} {'rmse':>7}")
+    for state_size in state_sizes:
+        obs_ix = jnp.arange(0, state_size, obs_every)
+        obs_size = len(obs_ix)
+
+        def fx_l96(x): return x[obs_ix]
+
+        q, R = 0.01 * jnp.ones(state_size), jnp.eye(obs_size)
+        key_init, key_sample, key_filter = random.split(random.fold_in(key, state_size), 3)
+        x0 = 8.0 + random.normal(key_init, (state_size,))
+        x0 = jax.lax.fori_loop(0, 200, lambda _, x: fz_l96(x), x0)
+        # Simulated with diagonal noise: a dense (state_size, state_size) Q is not needed
+        def sample_step(x, keys):
+            key_state, key_obs = keys
+            x = fz_l96(x) + jnp.sqrt(q) * random.normal(key_state, (state_size,))
+            return x, (x, fx_l96(x) + random.normal(key_obs, (obs_size,)))
+        keys = random.split(key_sample, 2 * nsteps).reshape(nsteps, 2, -1)
+        _, (sample_state, sample_obs) = jax.lax.scan(sample_step, x0, (keys[:, 0], keys[:, 1]))
+        init_state, Vinit = x0 + random.normal(key_init, (state_size,)), jnp.ones(state_size)
+
+        def distance(a, b):
+            dist = jnp.abs(a[:, None] - b[None, :])
+            return jnp.minimum(dist, state_size - dist)
+        state_ix = jnp.arange(state_size)
+        taper_xy = ds.EnsembleKalmanFilter.gaspari_cohn(distance(state_ix, obs_ix), radius)
+
+        filters = [
+            ("enkf", ds.EnsembleKalmanFilter(fz_l96, fx_l96, q, R, "stochastic", inflation=1.05)),
+            ("etkf", ds.EnsembleKalmanFilter(fz_l96, fx_l96, q, R, "etkf", inflation=1.05)),
+            ("letkf", ds.EnsembleKalmanFilter(fz_l96, fx_l96, q, R, "etkf", taper_xy, 1.05)),
+        ]
+        if state_size <= local_max_size:
+            taper_yy = ds.EnsembleKalmanFilter.gaspari_cohn(distance(obs_ix, obs_ix), radius)
+            enkf_local = ds.EnsembleKalmanFilter(fz_l96, fx_l96, q, R, "stochastic", (taper_xy, taper_yy), 1.05)
+            filters.insert(1, ("enkf-local", enkf_local))
+        for name, enkf in filters:
+            filter_enkf = partial(enkf.filter, nensemble=nensemble, Vinit=Vinit)
+            _, time_run = time_call(filter_enkf, key_filter, init_state, sample_obs, nruns=1)
+            mu_hist = filter_enkf(key_filter, init_state, sample_obs)
+            rmse = jnp.sqrt(((mu_hist - sample_state)[burn_in:] ** 2).mean())
+            print(f"{state_size:>6} {f'{name}-{nensemble}':>16} {1e3 * time_run / nsteps:>8.3f} {rmse:>7.3f}")
+
+        if state_size <= ekf_max_size:
+            ekf = ds.ExtendedKalmanFilter(fz_l96, fx_l96, jnp.diag(q), R)
+            _, time_run = time_call(ekf.filter, init_state, sample_obs, None, jnp.diag(Vinit), nruns=1)
+            mu_hist, _ = ekf.filter(init_state, sample_obs, None, jnp.diag(Vinit))
+            rmse = jnp.sqrt(((mu_hist - sample_state)[burn_in:] ** 2).mean())
+            print(f"{state_size:>6} {'ekf':>16} {1e3 * time_run / nsteps:>8.3f} {rmse:>7.3f}")
+
+
+def benchmark_sigma_points(state_sizes=(10, 50, 200), nsteps=200):
+    """
+    Run time and accuracy (RMSE against the true states) of the UKF with each
+    sigma-point set, using per-state fz and fx vectorized over the sigma points
+    (vectorize=True). The number of points, and hence of model evaluations per
+    step, is 2d+1 (unscented), 2d (cubature) and d+2 (simplex)
+    """
+    key = random.PRNGKey(314)
+    print(f"{'d':>5} {'sigma points':>12} {'npoints':>8} {'ms/step':>8} {'rmse':>7}")
+    for state_size in state_sizes:
+        def fz_ring(x, dt=0.1):
+            return x + dt * (jnp.sin(jnp.roll(x, 1)) - 0.5 * x)
+
+        def fx_ring(x):
+            return jnp.tanh(x[::2])
+
+        Q = jnp.eye(state_size) * 0.01
+        R = jnp.eye(len(range(0, state_size, 2))) * 0.1
+        model = ds.NLDS(fz_ring, fx_ring, Q, R)
+        x0 = jnp.ones(state_size)
+        sample_state, sample_obs = model.sample(random.fold_in(key, state_size), x0, nsteps)
+        for sigma_points in ("unscented", "cubature", "simplex"):
+            ukf = ds.UnscentedKalmanFilter.from_base(model, 1, 0, 0, sigma_points=sigma_points, vectorize=True)
+            mu_hist, _ = ukf.filter(x0, sample_obs)
+            _, time_run = time_call(ukf.filter, x0, sample_obs)
+            rmse = jnp.sqrt(((mu_hist - sample_state) ** 2).mean())
+            print(f"{state_size:>5} {sigma_points:>12} {ukf.npoints:>8} {1e3 * time_run / nsteps:>8.3f} {rmse:>7.3f}")
+
+
+SUITE_FILTERS = ("ekf", "ukf", "cekf", "bootstrap")
+
+
+def _suite_case(filter_name, state_size, obs_size, nsteps, nparticles):
+    """
+    Build a model of the given dimensions and return a function of arrays
+    only that runs the filter over a simulated sequence, together
+    with its arguments. The transition couples neighbouring components
+    and the first obs_size components are observed. fz and fx act over
+    the first axis so that they also take the matrix of sigma points of the UKF
+    """
+    def fz_suite(x, dt=0.1):
+        return x + dt * jnp.sin(jnp.roll(x, 1, axis=0))
+
+    def fx_suite(x):
+        return jnp.tanh(x[:obs_size])
+
+    def drift_suite(x):
+        return jnp.sin(jnp.roll(x, 1, axis=0)) - 0.5 * x
+
+    Q = jnp.eye(state_size) * 0.001
+    R = jnp.eye(obs_size) * 0.01
+    x0 = jnp.linspace(-1, 1, state_size)
+    key = random.PRNGKey(314)
+    sample_state, sample_obs = ds.NLDS(fz_suite, fx_suite, Q, R).sample(key, x0, nsteps)
+
+    if filter_name == "ekf":
+        ekf = ds.ExtendedKalmanFilter(fz_suite, fx_suite, Q, R)
+        return ekf.filter, (x0, sample_obs)
+    elif filter_name == "ukf":
+        ukf = ds.UnscentedKalmanFilter(fz_suite, fx_suite, Q, R, 1, 0, 1)
+        return ukf.filter, (x0, sample_obs)
+    elif filter_name == "cekf":
+        # Ten integration steps of size 0.01 between observations
+        cekf = ds.ContinuousExtendedKalmanFilter(drift_suite, fx_suite, Q, R)
+        estimate = partial(cekf.estimate, jump_size=10, dt=0.01, integrator="rk4")
+        return estimate, (sample_state, sample_obs)
+    elif filter_name == "bootstrap":
+        pf = ds.BootstrapFiltering(fz_suite, fx_suite, Q, R)
+        return partial(pf.filter, nsamples=nparticles), (key, x0, sample_obs)
+    raise ValueError(f"filter must be one of {SUITE_FILTERS}, got {filter_name!r}")
+
+
+def _peak_memory(compiled):
+    """
+    Peak memory (in bytes) of a compiled computation: arguments, outputs and
+    temporary buffers as reported by XLA. None if the backend does not
+    provide a memory analysis
+    """
+    try:
+        analysis = compiled.memory_analysis()
+    except (AttributeError, NotImplementedError):
+        return None
+    if analysis is None:
+        return None
+    return (analysis.argument_size_in_bytes + analysis.output_size_in_bytes
+            + analysis.temp_size_in_bytes - analysis.alias_size_in_bytes)
+
+
+def measure(f, *args, nruns=5):
+    """
+    Trace, compile and run f(*args) ahead of time so that each
+    stage is timed separately
+
+    Returns
+    -------
+    dict
+        trace_time, compile_time and run_time (best of nruns, in seconds)
+        and peak_memory (bytes, or None)
+    """
+    tinit = perf_counter()
+    lowered = jax.jit(f).lower(*args)
+    trace_time = perf_counter() - tinit
+
+    tinit = perf_counter()
+    compiled = lowered.compile()
+    compile_time = perf_counter() - tinit
+
+    run_time = float("inf")
+    for _ in range(nruns):
+        tinit = perf_counter()
+        jax.block_until_ready(compiled(*args))
+        run_time = min(run_time, perf_counter() - tinit)
+
+    return {
+        "trace_time": trace_time,
+        "compile_time": compile_time,
+        "run_time": run_time,
+        "peak_memory": _peak_memory(compiled),
+    }
+
+
+def run_suite(filters=SUITE_FILTERS, state_sizes=(2, 10, 50), obs_sizes=(1, 2), nsteps_list=(100, 1_000),
+              nparticles_list=(100, 1_000, 10_000), nruns=5, verbose=True):
+    """
+    Run every filter over the grid of state sizes, observation sizes and
+    sequence lengths (and particle counts for the bootstrap filter).
+    Configurations with obs_size > state_size are skipped and the
+    continuous-discrete EKF observes every component of the state
+
+    Returns
+    -------
+    dict
+        Environment (jax version, backend, machine) and one entry per configuration
+        with its dimensions, the timings of measure and the steps per second
+    """
+    results = []
+    if verbose:
+        print(f"{'filter':>9} {'d':>5} {'m':>3} {'nsteps':>6} {'N':>6} {'trace (s)':>9} {'compile (s)':>11} "
+              f"{'run (ms)':>9} {'steps/s':>9} {'peak (MB)':>9}")
+    for filter_name in filters:
+        particle_grid = nparticles_list if filter_name == "bootstrap" else (None,)
+        # The continuous-discrete EKF starts from covariance R: the full state is observed
+        obs_grid = (None,) if filter_name == "cekf" else obs_sizes
+        grid = product(state_sizes, obs_grid, nsteps_list, particle_grid)
+        for state_size, obs_size, nsteps, nparticles in grid:
+            obs_size = state_size if obs_size is None else obs_size
+            if obs_size > state_size:
+                continue
+            f, args = _suite_case(filter_name, state_size, obs_size, nsteps, nparticles)
+            res = measure(f, *args, nruns=nruns)
+            res = {"filter": filter_name, "state_size": state_size, "obs_size": obs_size,
+                   "nsteps": nsteps, "nparticles": nparticles, **res,
+                   "steps_per_second": nsteps / res["run_time"]}
+            results.append(res)
+            if verbose:
+                peak = "-" if res["peak_memory"] is None else f"{res['peak_memory'] / 2 ** 20:.2f}"
+                print(f"{filter_name:>9} {state_size:>5} {obs_size:>3} {nsteps:>6} {nparticles or '-':>6} "
+                      f"{res['trace_time']:>9.3f} {res['compile_time']:>11.3f} {1e3 * res['run_time']:>9.2f} "
+                      f"{res['steps_per_second']:>9.0f} {peak:>9}")
+
+    environment = {
+        "jax_version": jax.__version__,
+        "backend": jax.default_backend(),
+        "x64": jax.config.read("jax_enable_x64"),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+    }
+    return {"environment": environment, "results": results}
+
+
+def _config_key(res):
+    return res["filter"], res["state_size"], res["obs_size"], res["nsteps"], res["nparticles"]
+
+
+def compare_to_baseline(suite, baseline, tolerance=0.2, min_time=1e-3,
+                        metrics=("run_time", "compile_time", "peak_memory"), verbose=True):
+    """
+    Compare the results of run_suite against a stored baseline. A metric
+    regresses if it is more than (1 + tolerance) times its baseline value.
+    Timings also have to increase by more than min_time seconds, so that
+    timer noise of sub-millisecond runs is not reported.
+    Configurations missing from either run are ignored
+
+    Returns
+    -------
+    list
+        (configuration, metric, baseline value, new value) of every regression
+    """
+    baseline_results = {_config_key(res): res for res in baseline["results"]}
+    regressions = []
+    for res in suite["results"]:
+        key = _config_key(res)
+        if key not in baseline_results:
+            continue
+        for metric in metrics:
+            old, new = baseline_results[key][metric], res[metric]
+            if old is None or new is None:
+                continue
+            is_time = metric.endswith("_time")
+            if new > (1 + tolerance) * old and (not is_time or new - old > min_time):
+                regressions.append((key, metric, old, new))
+
+    if verbose:
+        if baseline["environment"] != suite["environment"]:
+            print("warning: the baseline was run on a different environment")
+        for key, metric, old, new in regressions:
+            print(f"regression {key}: {metric} {old:.4g} -> {new:.4g} ({new / old:.2f}x)")
+        print(f"{len(regressions)} regressions over {len(suite['results'])} configurations")
+    return regressions
+
+
+def main(argv=None):
+    """
+    Command-line entry point. Returns 1 if the suite regressed
+    with respect to the baseline and 0 otherwise
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks for the filters in nlds_lib")
+    parser.add_argument("--suite", action="store_true",
+                        help="run the parameterized benchmark suite instead of the comparison tables")
+    parser.add_argument("--check", action="store_true",
+                        help="only run the agreement checks between equivalent filters, at small sizes")
+    parser.add_argument("--filters", nargs="+", choices=SUITE_FILTERS, default=SUITE_FILTERS)
+    parser.add_argument("--state-sizes", nargs="+", type=int, default=(2, 10, 50))
+    parser.add_argument("--obs-sizes", nargs="+", type=int, default=(1, 2))
+    parser.add_argument("--nsteps", nargs="+", type=int, default=(100, 1_000))
+    parser.add_argument("--nparticles", nargs="+", type=int, default=(100, 1_000, 10_000))
+    parser.add_argument("--nruns", type=int, default=5)
+    parser.add_argument("--output", help="store the results of the suite as JSON")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative slowdown (or memory increase) reported as a regression")
+    parser.add_argument("--min-time", type=float, default=1e-3,
+                        help="smallest slowdown (in seconds) reported as a regression")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        run_checks()
+        return 0
+    if not args.suite:
+        run_all()
+        return 0
+
+    suite = run_suite(args.filters, args.state_sizes, args.obs_sizes, args.nsteps, args.nparticles, args.nruns)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(suite, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(suite, baseline, args.tolerance, args.min_time)
+        return 1 if regressions else 0
+    return 0
+
+
+def run_all():
+    """
+    Print the comparison tables of every benchmark
+    """
+    benchmark_ekf_scan()
+    benchmark_filter_batch()
+    benchmark_sqrt_ukf()
+    benchmark_parallel_kf()
+    benchmark_streaming()
+    benchmark_continuous_ekf()
+    benchmark_iekf()
+    benchmark_fit_noise()
+    benchmark_bootstrap()
+    benchmark_structured_ekf()
+    benchmark_jacobian()
+    benchmark_rbpf()
+    benchmark_masked()
+    benchmark_monitor()
+    benchmark_float32()
+    benchmark_enkf()
+    benchmark_sigma_points()
+
+
+def run_checks():
+    """
+    Agreement checks between equivalent implementations at small sizes:
+    scan against loop EKF, parallel against sequential Kalman filter,
+    square-root against standard UKF and float32 against float64.
+    An AssertionError is raised if any pair disagrees
+    """
+    benchmark_ekf_scan(nsteps_list=(100, 1_000))
+    benchmark_parallel_kf(nsteps_list=(1_000, 10_000))
+    benchmark_sqrt_ukf(state_sizes=(10, 50))
+    benchmark_float32(nsteps=500)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,27 +11,329 @@
 
 # Author: Gerardo Durán-Martín (@gerdm)
 
+import os
 import jax
-from jax._src.random import split
+import importlib.util
 import jax.numpy as jnp
 from jax import random
-from jax.ops import index_update
 from jax.scipy import stats
-from math import ceil
+import numpy as np
+from jax.scipy.linalg import cho_solve, solve_triangular
+from jax.flatten_util import ravel_pytree
+from functools import partial
+from copy import copy
+from math import ceil, log, log2, pi
+from time import perf_counter
 
+# The resampling schemes are kept with the sequential Monte Carlo code of
+# 2022-01. The module is loaded from its path, so sys.path is left untouched
+_resampling_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "2022-01", "resampling.py")
+_resampling_spec = importlib.util.spec_from_file_location("_smc_resampling", _resampling_path)
+_resampling = importlib.util.module_from_spec(_resampling_spec)
+_resampling_spec.loader.exec_module(_resampling)
+RESAMPLING_SCHEMES = _resampling.RESAMPLING_SCHEMES
 
-class NLDS:
+
+def _logpdf_chol(x, mean, L):
+    """
+    Log-density of a multivariate Gaussian N(x | mean, L @ L.T)
+    parameterised by a (lower) Cholesky factor L
+    """
+    dim, = x.shape
+    err = solve_triangular(L, x - mean, lower=True)
+    logdet_half = jnp.log(jnp.abs(jnp.diag(L))).sum()
+    return -0.5 * (err @ err) - logdet_half - 0.5 * dim * log(2 * pi)
+
+
+def _symmetrize(M):
+    """
+    Symmetric part of a square matrix. Removes the asymmetry that
+    round-off errors introduce in covariance updates
+    """
+    return (M + M.T) / 2
+
+
+def _chol_from_params(A):
+    """
+    Lower Cholesky factor from an unconstrained square matrix:
+    the diagonal of A is the log-diagonal of the factor
+    """
+    return jnp.tril(A, -1) + jnp.diag(jnp.exp(jnp.diag(A)))
+
+
+def _params_from_cov(M):
+    """
+    Unconstrained parameters of a positive-definite matrix M.
+    Inverse of _chol_from_params followed by L @ L.T
+    """
+    L = jnp.linalg.cholesky(M)
+    return jnp.tril(L, -1) + jnp.diag(jnp.log(jnp.diag(L)))
+
+
+@jax.custom_jvp
+def _eigh(M):
+    """
+    jnp.linalg.eigh whose derivative drops the terms of pairs of tied
+    eigenvalues (the default rule divides by their difference and returns
+    nan). Suited to functions of M that only depend on the eigenspaces
+    of the tied eigenvalues, e.g., projections onto the leading eigenvectors
+    """
+    evals, evecs = jnp.linalg.eigh(M)
+    return evals, evecs
+
+
+@_eigh.defjvp
+def _eigh_jvp(primals, tangents):
+    M, = primals
+    dM, = tangents
+    evals, evecs = jnp.linalg.eigh(M)
+    dM = evecs.T @ dM @ evecs
+    gaps = evals[None, :] - evals[:, None]
+    tol = len(evals) * jnp.finfo(evals.dtype).eps * jnp.abs(evals).max()
+    distinct = jnp.abs(gaps) > tol
+    F = jnp.where(distinct, 1 / jnp.where(distinct, gaps, 1), 0)
+    return (evals, evecs), (jnp.diag(dM), evecs @ (F * dM))
+
+
+JACOBIAN_STRATEGIES = ("jacfwd", "jacrev", "jvp")
+
+
+def _resolve_jacobian(jacobian, in_size, out_size):
+    """
+    Jacobian strategy for a function from in_size to out_size entries.
+    "auto" picks reverse mode (out_size products) for functions with fewer
+    outputs than inputs, matrix-free products for square functions (the
+    covariance is propagated without forming the Jacobian) and forward
+    mode (in_size products) otherwise
+    """
+    if jacobian == "auto":
+        if out_size < in_size:
+            return "jacrev"
+        return "jvp" if out_size == in_size else "jacfwd"
+    if jacobian not in JACOBIAN_STRATEGIES:
+        raise ValueError(f"jacobian must be 'auto' or one of {JACOBIAN_STRATEGIES}, got {jacobian!r}")
+    return jacobian
+
+
+def _map_chunks(f, batch, n, chunk_size):
+    """
+    Apply f to the n entries along the leading axis of every leaf of batch,
+    chunk_size entries at a time (all at once if chunk_size is None). The
+    batch is padded so that every chunk has the same shape and f is only
+    compiled once
+    """
+    if chunk_size is None or chunk_size >= n:
+        return f(*batch)
+
+    n_chunks = ceil(n / chunk_size)
+    npad = n_chunks * chunk_size - n
+    def pad(x): return jnp.concatenate([x, jnp.repeat(x[:1], npad, axis=0)])
+    batch = jax.tree_util.tree_map(pad, batch)
+
+    out_chunks = []
+    for i in range(n_chunks):
+        chunk = jax.tree_util.tree_map(lambda x: x[i * chunk_size:(i + 1) * chunk_size], batch)
+        out_chunks.append(f(*chunk))
+    return jax.tree_util.tree_map(lambda *x: jnp.concatenate(x)[:n], *out_chunks)
+
+
+def _linearize(f, strategy, x, *args, dtype=None):
+    """
+    Evaluate f(x, *args) and return the product with its Jacobian J at x.
+    With "jacfwd" and "jacrev" the dense Jacobian is built once; with "jvp"
+    the product J @ M is computed column by column through Jacobian-vector
+    products of the linearised function and J is never formed. If dtype is
+    given, the output of f is cast to it, so that a function that promotes
+    its input (e.g. one closing over float64 arrays) keeps the filter in dtype
+
+    Returns
+    -------
+    * array(out_size): f(x, *args)
+    * function: M -> J @ M, for M of shape (in_size, k)
+    """
+    if dtype is not None:
+        f_wide = f
+        def f(x, *args): return f_wide(x, *args).astype(dtype)
+    if strategy == "jvp":
+        y, f_jvp = jax.linearize(lambda x: f(x, *args), x)
+        return y, jax.vmap(f_jvp, in_axes=1, out_axes=1)
+    jacobian = jax.jacfwd if strategy == "jacfwd" else jax.jacrev
+    J = jacobian(f)(x, *args)
+    return f(x, *args), lambda M: J @ M
+
+
+class FilterMonitor:
+    """
+    Opt-in per-step instrumentation of the compiled filters. A model copied
+    with NLDS.with_monitor reports to the monitor, through host callbacks
+    (jax.debug.callback), the host time at which each stage of every step
+    finishes, the norm of the innovation, the condition numbers of the
+    innovation and filtered covariances and whether the filtered moments
+    contain NaNs. Models without a monitor trace no callbacks at all.
+    Supported by the Extended, Iterated Extended, (square-root) Unscented
+    and Bootstrap filters.
+
+    Stage times are differences between the arrival times of consecutive
+    callbacks: they show where the time goes within a step, but include
+    the overhead of the callbacks themselves. The callbacks are ordered, so
+    stages, innovations and steps are recorded in the order of the steps of
+    the filter; a monitor should follow a single sequence (not filter_batch)
+
+    Parameters
+    ----------
+    raise_on_nan: bool
+        Raise a FloatingPointError at the first step whose filtered moments
+        contain NaNs. The error surfaces as a runtime error of the filter
+    verbose: bool
+        Print the first step whose filtered moments contain NaNs
+    """
+    def __init__(self, raise_on_nan=False, verbose=False):
+        self.raise_on_nan = raise_on_nan
+        self.verbose = verbose
+        self.reset()
+
+    def reset(self):
+        """
+        Discard every record
+        """
+        self.steps = []
+        self._current = {"stage_times": {}}
+        self._last_time = None
+
+    def record_stage(self, stage, *values):
+        """
+        Host callback: the given stage of the current step has finished.
+        The values (outputs of the stage) are only used to order the callback
+        """
+        now = perf_counter()
+        elapsed = 0.0 if self._last_time is None else now - self._last_time
+        stage_times = self._current["stage_times"]
+        stage_times[stage] = stage_times.get(stage, 0.0) + elapsed
+        self._last_time = now
+
+    def record_innovation(self, innovation_norm, innovation_cond):
+        """
+        Host callback: norm of the innovation and condition
+        number of its covariance at the current step
+        """
+        self._current["innovation_norm"] = float(innovation_norm)
+        self._current["innovation_cond"] = float(innovation_cond)
+
+    def record_step(self, mask, cov_cond, has_nan):
+        """
+        Host callback: end of the current step
+        """
+        record = {"step": len(self.steps), "innovation_norm": None, "innovation_cond": None, **self._current}
+        if not bool(mask):
+            # Prediction-only step: there is no innovation
+            record["innovation_norm"] = record["innovation_cond"] = None
+        record["cov_cond"] = float(cov_cond)
+        record["nan"] = bool(has_nan)
+        self.steps.append(record)
+        self._current = {"stage_times": {}}
+        self._last_time = perf_counter()
+
+        if record["nan"]:
+            if self.verbose and self.summary()["first_nan"] == record["step"]:
+                print(f"step {record['step']}: NaN in the filtered moments")
+            if self.raise_on_nan:
+                raise FloatingPointError(f"NaN in the filtered moments at step {record['step']}")
+
+    def summary(self):
+        """
+        Aggregate the records of every step
+
+        Returns
+        -------
+        dict
+            Number of steps ("nsteps"), total time per stage ("stage_times"),
+            largest innovation norm ("max_innovation_norm"), largest condition
+            numbers ("max_innovation_cond", "max_cov_cond") and first step
+            with NaNs ("first_nan", None if there is none)
+        """
+        stage_times = {}
+        for record in self.steps:
+            for stage, elapsed in record["stage_times"].items():
+                stage_times[stage] = stage_times.get(stage, 0.0) + elapsed
+
+        def largest(name):
+            values = [record[name] for record in self.steps if record[name] is not None]
+            return max(values, default=None)
+
+        nan_steps = [record["step"] for record in self.steps if record["nan"]]
+        return {
+            "nsteps": len(self.steps),
+            "stage_times": stage_times,
+            "max_innovation_norm": largest("innovation_norm"),
+            "max_innovation_cond": largest("innovation_cond"),
+            "max_cov_cond": largest("cov_cond"),
+            "first_nan": nan_steps[0] if nan_steps else None,
+        }
+
+
+class _PytreeModel:
+    """
+    Models are pytrees (every subclass is registered on definition): the
+    array attributes (e.g. Q and R) are the leaves, and the remaining
+    attributes (fz, fx, sizes and options) are static. The compiled methods
+    take the model as a regular argument, so they follow the current
+    attributes of the model: new arrays are passed to the compiled
+    function and new static attributes retrace it
+    """
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        jax.tree_util.register_pytree_node_class(cls)
+
+    def tree_flatten(self):
+        names = tuple(sorted(vars(self)))
+        is_leaf = tuple(isinstance(getattr(self, name), (jax.Array, np.ndarray)) for name in names)
+        leaves = tuple(getattr(self, name) for name, leaf in zip(names, is_leaf) if leaf)
+        static = tuple((name, getattr(self, name)) for name, leaf in zip(names, is_leaf) if not leaf)
+        leaf_names = tuple(name for name, leaf in zip(names, is_leaf) if leaf)
+        return leaves, (leaf_names, static)
+
+    @classmethod
+    def tree_unflatten(cls, aux_data, leaves):
+        leaf_names, static = aux_data
+        model = object.__new__(cls)
+        vars(model).update(static)
+        vars(model).update(zip(leaf_names, leaves))
+        return model
+
+
+class NLDS(_PytreeModel):
     """
     Base class for the Nonliear dynamical systems' module
     """
+    # Instance of FilterMonitor, see with_monitor
+    monitor = None
+    # Floating-point type of the filter (None: that of the inputs), see _cast
+    dtype = None
+
     def __init__(self, fz, fx, Q, R):
         self.fz = fz
         self.fx = fx
         self.Q = Q
         self.R = R
-        self.state_size, _ = Q.shape
+        # Q may be stored in a structured form (e.g., its diagonal) by subclasses
+        self.state_size = Q.shape[0]
         self.obs_size, _ = R.shape
 
+    @property
+    def Dfz(self):
+        """
+        Jacobian of the state transition function
+        """
+        return jax.jacfwd(self.fz)
+
+    @property
+    def Dfx(self):
+        """
+        Jacobian of the observation function
+        """
+        return jax.jacfwd(self.fx)
+
+    @partial(jax.jit, static_argnums=(3,))
     def sample(self, key, x0, nsteps):
         """
         Sample discrete elements of a nonlinear system
@@ -53,295 +355,799 @@ class NLDS:
         """
         key, key_system_noise, key_obs_noise = random.split(key, 3)
 
-        state_hist = jnp.zeros((nsteps, self.state_size))
-        obs_hist = jnp.zeros((nsteps, self.obs_size))
-
-        state_t = x0.copy()
-        obs_t = self.fx(state_t)
-
         state_noise = random.multivariate_normal(key_system_noise, jnp.zeros((self.state_size,)), self.Q, (nsteps,))
         obs_noise = random.multivariate_normal(key_obs_noise, jnp.zeros((self.obs_size,)), self.R, (nsteps,))
-        state_hist = index_update(state_hist, 0, state_t)
-        obs_hist = index_update(obs_hist, 0, obs_t)
 
-        for t in range(1, nsteps):
-            state_t = self.fz(state_t) + state_noise[t]
-            obs_t = self.fx(state_t) + obs_noise[t]
+        def sample_step(state_t, noise_t):
+            state_noise_t, obs_noise_t = noise_t
+            state_t = self.fz(state_t) + state_noise_t
+            obs_t = self.fx(state_t) + obs_noise_t
+            return state_t, (state_t, obs_t)
 
-            state_hist = index_update(state_hist, t, state_t)
-            obs_hist = index_update(obs_hist, t, obs_t)
+        _, (state_hist, obs_hist) = jax.lax.scan(sample_step, x0, (state_noise[1:], obs_noise[1:]))
+        state_hist = jnp.concatenate((x0[None, :], state_hist))
+        obs_hist = jnp.concatenate((self.fx(x0)[None, :], obs_hist))
         
         return state_hist, obs_hist
 
-
-class ExtendedKalmanFilter(NLDS):
-    """
-    Implementation of the Extended Kalman Filter for a nonlinear
-    dynamical system with discrete observations
-    """
-    def __init__(self, fz, fx, Q, R):
-        super().__init__(fz, fx, Q, R)
-        self.Dfz = jax.jacfwd(fz)
-        self.Dfx = jax.jacfwd(fx)
-    
-    @classmethod
-    def from_base(cls, model):
+    def _sample_trajectory(self, key, x0, nsteps, thin, obs_only):
         """
-        Initialise class from an instance of the NLDS parent class
+        Sample a single trajectory keeping every thin-th step. The noise at
+        step t is drawn from fold_in(key, t), so no noise buffers are stored.
         """
-        return cls(model.fz, model.fx, model.Q, model.R)
+        Q_half = jnp.linalg.cholesky(self.Q)
+        R_half = jnp.linalg.cholesky(self.R)
+        nkeep = ceil(nsteps / thin)
+
+        def sample_step(t, carry):
+            state_t, _ = carry
+            key_state, key_obs = random.split(random.fold_in(key, t))
+            state_t = self.fz(state_t) + Q_half @ random.normal(key_state, (self.state_size,))
+            obs_t = self.fx(state_t) + R_half @ random.normal(key_obs, (self.obs_size,))
+            return state_t, obs_t
+
+        def sample_block(carry, block):
+            tinit = 1 + block * thin
+            carry = jax.lax.fori_loop(tinit, tinit + thin, sample_step, carry)
+            state_t, obs_t = carry
+            return carry, obs_t if obs_only else (state_t, obs_t)
+
+        obs_0 = self.fx(x0)
+        _, hist = jax.lax.scan(sample_block, (x0, obs_0), jnp.arange(nkeep - 1))
+        if obs_only:
+            return None, jnp.concatenate((obs_0[None, :], hist))
+        state_hist, obs_hist = hist
+        state_hist = jnp.concatenate((x0[None, :], state_hist))
+        obs_hist = jnp.concatenate((obs_0[None, :], obs_hist))
+        return state_hist, obs_hist
+
+    @partial(jax.jit, static_argnums=(3, 4, 5))
+    def _sample_batch(self, keys, x0, nsteps, thin, obs_only):
+        sample_trajectory = partial(self._sample_trajectory, nsteps=nsteps, thin=thin, obs_only=obs_only)
+        return jax.vmap(sample_trajectory)(keys, x0)
 
-    def filter(self, init_state, sample_obs, observations=None, Vinit=None):
+    def sample_batch(self, key, x0, nsteps, n_trajectories, thin=1, obs_only=False):
         """
-        Run the Extended Kalman Filter algorithm over a set of observed samples.
+        Sample n_trajectories independent trajectories of a nonlinear
+        system in a single compiled, vectorised call.
 
         Parameters
         ----------
-        init_state: array(state_size)
-        sample_obs: array(nsamples, obs_size)
-
+        key: jax.random.PRNGKey
+        x0: array(state_size) or array(n_trajectories, state_size)
+            Initial state of each simulation
+        nsteps: int
+            Total number of steps to sample from the system
+        n_trajectories: int
+            Number of trajectories to sample
+        thin: int
+            Keep only every thin-th step (steps 0, thin, 2 * thin, ...)
+        obs_only: bool
+            If True, the state-space values are not stored
 
         Returns
         -------
-        * array(nsamples, state_size)
-            History of filtered mean terms
-        * array(nsamples, state_size, state_size)
-            History of filtered covariance terms
+        * array(n_trajectories, ceil(nsteps / thin), state_size) or None
+            State-space values
+        * array(n_trajectories, ceil(nsteps / thin), obs_size)
+            Observed-space values
         """
-        I = jnp.eye(self.state_size)
-        nsamples = len(sample_obs)
-        Vt = self.Q if Vinit is None else Vinit
-        if observations is None:
-            observations = [()] * nsamples
-        else:
-            observations = [(obs,) for obs in observations]
-
-        mu_t = init_state
+        keys = random.split(key, n_trajectories)
+        x0 = jnp.broadcast_to(x0, (n_trajectories, self.state_size))
+        return self._sample_batch(keys, x0, nsteps, thin, obs_only)
 
-        mu_hist = jnp.zeros((nsamples, self.state_size))
-        V_hist = jnp.zeros((nsamples, self.state_size, self.state_size))
+    def init(self, init_state, Vinit=None):
+        """
+        Initial state of the online (streaming) version of the filter
 
-        mu_hist = index_update(mu_hist, 0, mu_t)
-        V_hist = index_update(V_hist, 0, Vt)
+        Parameters
+        ----------
+        init_state: array(state_size)
+        Vinit: array(state_size, state_size) or None
+            Initial covariance. Defaults to Q
 
-        for t in range(nsamples):
-            Gt = self.Dfz(mu_t)
-            mu_t_cond = self.fz(mu_t)
-            Vt_cond = Gt @ Vt @ Gt + self.Q
-            Ht = self.Dfx(mu_t_cond, *observations[t])
+        Returns
+        -------
+        tuple: (init_state, Vinit)
+        """
+        Vt = self.Q if Vinit is None else Vinit
+        return self._cast((init_state, Vt))
 
-            xt_hat = self.fx(mu_t_cond, *observations[t])
-            Kt = Vt_cond @ Ht.T @ jnp.linalg.inv(Ht @ Vt_cond @ Ht.T + self.R)
-            mu_t = mu_t_cond + Kt @ (sample_obs[t] - xt_hat)
-            Vt = (I - Kt @ Ht) @ Vt_cond
+    def _cast(self, tree):
+        """
+        Cast the floating-point leaves of a pytree to the
+        dtype of the filter. No-op if the filter has no dtype
+        """
+        if self.dtype is None:
+            return tree
 
-            mu_hist = index_update(mu_hist, t, mu_t)
-            V_hist = index_update(V_hist, t, Vt)
-        
-        return mu_hist, V_hist
+        def cast(x):
+            x = jnp.asarray(x)
+            return x.astype(self.dtype) if jnp.issubdtype(x.dtype, jnp.floating) else x
+        return jax.tree_util.tree_map(cast, tree)
 
+    @staticmethod
+    def _mask_update(mask, updated, predicted):
+        """
+        Keep the predicted terms in place of the updated ones whenever
+        the observation is missing (mask=False)
+        """
+        if mask is None:
+            return updated
+        return jax.tree_util.tree_map(lambda new, old: jnp.where(mask, new, old), updated, predicted)
 
-class ContinuousExtendedKalmanFilter:
-    """
-    Extended Kalman Filter for a nonlinear continuous time
-    dynamical system with observations in discrete time.
-    """
-    def __init__(self, fz, fx, Q, R):
-        self.fz = fz
-        self.fx = fx
-        self.Dfz = jax.jacfwd(fz)
-        self.Dfx = jax.jacfwd(fx)
-        self.Q = Q
-        self.R = R
-        self.state_size, _ = Q.shape
-        self.obs_size, _ = R.shape
-        
     @staticmethod
-    def _rk2(x0, f, nsteps, dt):
+    def _mask_obs(mask, xt):
         """
-        class-independent second-order Runge-Kutta method
-        
+        Replace missing observations (mask=False) by zeros, so that
+        NaN placeholders do not propagate through the (discarded) update
+        """
+        if mask is None:
+            return xt
+        return jnp.where(mask, xt, jnp.zeros_like(xt))
+
+    @jax.jit
+    def step(self, state, obs, observation=None, mask=None, dt=None):
+        """
+        Online (streaming) version of the filter of the subclass: process
+        a single observation. The step is compiled once and does not
+        allocate any history buffers.
+
         Parameters
         ----------
-        x0: array(state_size, )
-            Initial state of the system
-        f: function
-            Function to integrate. Must return jax.numpy
-            array of size state_size
-        nsteps: int
-            Total number of steps to integrate
-        dt: float
-            integration step size
-        
+        state: tuple
+            Output of init or of a previous call to step
+        obs: array(obs_size)
+            Observation at time t
+        observation: array or None
+            Covariate passed as the second argument to fx
+        mask: bool or None
+            If False, the observation is missing and only the
+            prediction step is performed
+        dt: float or None
+            Time elapsed since the last step, passed as the second
+            argument to fz
+
         Returns
         -------
-        array(nsteps, state_size)
-            Integration history
+        * tuple: state of the filter at time t
+        * dict: moments of the filter at time t
         """
-        input_dim, *_ = x0.shape
-        simulation = jnp.zeros((nsteps, input_dim))
-        simulation = index_update(simulation, 0, x0)
-        
-        xt = x0.copy()
-        for t in range(1, nsteps):
-            k1 = f(xt)
-            k2 = f(xt + dt * k1)
-            xt = xt + dt * (k1 + k2) / 2
-            simulation = index_update(simulation, t, xt)
-        return simulation
-    
-    def sample(self, key, x0, T, nsamples, dt=0.01, noisy=False):
+        return self._filter_step(state, (obs, observation, mask, dt))
+
+    @jax.jit
+    def _step_burst(self, state, obs_burst, observations, valid):
         """
-        Run the Extended Kalman Filter algorithm. First, we integrate
-        up to time T, then we obtain nsamples equally-spaced points. Finally,
-        we transform the latent space to obtain the observations
+        Compiled scan of step over a padded burst of observations.
+        Padded steps (valid=False) leave the state unchanged
+        """
+        def step(state, xs):
+            obs, observation, valid = xs
+            state_new, hist = self._filter_step(state, (obs, observation, None, None))
+            state = jax.tree_util.tree_map(lambda new, old: jnp.where(valid, new, old), state_new, state)
+            return state, hist
+        return jax.lax.scan(step, state, (obs_burst, observations, valid))
+
+    def step_burst(self, state, obs_burst, observations=None):
+        """
+        Online (streaming) version of the filter of the subclass: absorb
+        a burst of observations in a single call. Bursts are padded to the
+        next power of two, so at most ceil(log2(max burst size)) + 1
+        versions of the step are compiled.
 
         Parameters
         ----------
-        key: jax.random.PRNGKey
-            Initial seed
-        x0: array(state_size)
-            Initial state of simulation
-        T: float
-            Final time of integration
-        nsamples: int
-            Number of observations to take from the total integration
-        dt: float
-            integration step size
-        noisy: bool
-            Whether to (naively) add noise to the state space
+        state: tuple
+            Output of init or of a previous call to step
+        obs_burst: array(nburst, obs_size)
+            Observations received since the last call
+        observations: array(nburst, ...) or None
+            Covariates passed as the second argument to fx at each step
 
         Returns
         -------
-        * array(nsamples, state_size)
-            State-space values
-        * array(nsamples, obs_size)
-            Observed-space values
-        * int
-            Number of observations skipped between one
-            datapoint and the next
+        * tuple: state of the filter after the last observation
+        * dict: moments of the filter at each step of the burst
         """
-        nsteps = ceil(T / dt)
-        jump_size = ceil(nsteps / nsamples)
-        correction = nsamples - ceil(nsteps / jump_size)
-        nsteps += correction * jump_size
+        nburst = len(obs_burst)
+        if nburst == 0:
+            return state, {}
+        npad = 2 ** ceil(log2(nburst)) - nburst
+        # Host arrays are padded on the host to avoid dispatching device
+        # operations; arrays already on the device are padded there
+        def pad(x):
+            if isinstance(x, jax.Array):
+                return jnp.concatenate([x, jnp.repeat(x[-1:], npad, axis=0)])
+            x = np.asarray(x)
+            return jax.device_put(np.concatenate([x, np.repeat(x[-1:], npad, axis=0)]))
+        obs_burst, observations = jax.tree_util.tree_map(pad, (obs_burst, observations))
+        valid = np.arange(nburst + npad) < nburst
 
-        key_state, key_obs = random.split(key)
-        state_noise = random.multivariate_normal(key_state, jnp.zeros(self.state_size), self.Q, (nsteps,))
-        obs_noise = random.multivariate_normal(key_obs, jnp.zeros(self.obs_size), self.R, (nsteps,)) 
-        simulation = self._rk2(x0, self.fz, nsteps, dt)
-        
-        if noisy:
-            simulation = simulation + jnp.sqrt(dt) * state_noise
-        
-        sample_state = simulation[::jump_size]
-        sample_obs = jnp.apply_along_axis(self.fx, 1, sample_state) + obs_noise[:len(sample_state)]
-        
-        return sample_state, sample_obs, jump_size
-    
-    def _Vt_dot(self, V, G):
-        return G @ V @ G + self.Q
-    
-    def estimate(self, sample_state, sample_obs, jump_size, dt):
+        state, hist = self._step_burst(state, obs_burst, observations, valid)
+        hist = jax.tree_util.tree_map(lambda x: x[:nburst], hist)
+        return state, hist
+
+    @partial(jax.jit, static_argnums=(7,))
+    def _filter_batch(self, init_state, sample_obs, observations, Vinit, mask, dt, full_output=False):
         """
-        Run the Extended Kalman Filter algorithm over a set of observed samples.
+        Compiled filter of the subclass vectorised over the leading axis
+        """
+        def filter_scan(*args): return self._filter_scan(*args, full_output)
+        return jax.vmap(filter_scan)(init_state, sample_obs, observations, Vinit, mask, dt)
+
+    def filter_batch(self, init_state, sample_obs, observations=None, Vinit=None, chunk_size=None,
+                     full_output=False, mask=None, dt=None):
+        """
+        Run the compiled filter of the subclass over a batch of independent
+        sequences sharing the same NLDS in a single vectorised call.
 
         Parameters
         ----------
-        sample_state: array(nsamples, state_size)
-        sample_obs: array(nsamples, obs_size)
-        jump_size: int
-        dt: float
+        init_state: array(n_sequences, state_size) or array(state_size)
+            Initial state estimate for each sequence
+        sample_obs: array(n_sequences, nsamples, obs_size)
+            Samples of the observations of each sequence
+        observations: array(n_sequences, nsamples, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(n_sequences, state_size, state_size), array(state_size, state_size) or None
+            Initial covariance for each sequence. Defaults to Q
+        chunk_size: int or None
+            If given, filter chunk_size sequences at a time to bound the peak
+            memory. Every chunk has the same shape, so the filter is only
+            compiled once.
+        full_output: bool
+            If True, return the dictionary of filtered and predicted
+            moments (see the filter method of the subclass)
+        mask: array(n_sequences, nsamples) or None
+            Whether each observation is available (see the filter
+            method of the subclass)
+        dt: array(n_sequences, nsamples) or None
+            Time elapsed since the previous step, passed as the
+            second argument to fz
 
         Returns
         -------
-        * array(nsamples, state_size)
+        * array(n_sequences, nsamples, state_size)
             History of filtered mean terms
-        * array(nsamples, state_size, state_size)
+        * array(n_sequences, nsamples, state_size, state_size)
             History of filtered covariance terms
         """
-        I = jnp.eye(self.state_size)
-        nsamples = len(sample_state)
-        Vt = self.R.copy()
-        mu_t = sample_state[0]
+        n_sequences = sample_obs.shape[0]
+        Vinit = self.Q if Vinit is None else Vinit
+        init_state = jnp.broadcast_to(init_state, (n_sequences, self.state_size))
+        Vinit = jnp.broadcast_to(Vinit, (n_sequences, *self.Q.shape))
+        batch = (init_state, sample_obs, observations, Vinit, mask, dt)
+        def filter_batch(*chunk): return self._filter_batch(*chunk, full_output)
+        return _map_chunks(filter_batch, batch, n_sequences, chunk_size)
 
-        mu_hist = jnp.zeros((nsamples, self.state_size))
-        V_hist = jnp.zeros((nsamples, self.state_size, self.state_size))
+    def replace_noise(self, Q, R):
+        """
+        Copy of the model with the state and observation noise
+        covariances replaced by Q and R
 
-        mu_hist = index_update(mu_hist, 0, mu_t)
-        V_hist = index_update(V_hist, 0, Vt)
+        Parameters
+        ----------
+        Q: array(state_size, state_size)
+        R: array(obs_size, obs_size)
+        """
+        model = copy(self)
+        model.Q, model.R = model._cast((Q, R))
+        return model
 
-        for t in range(1, nsamples):
-            for _ in range(jump_size):
-                k1 = self.fz(mu_t)
-                k2 = self.fz(mu_t + dt * k1)
-                mu_t = mu_t + dt * (k1 + k2) / 2
+    def with_monitor(self, monitor):
+        """
+        Copy of the model whose filters report per-step diagnostics to
+        monitor (an instance of FilterMonitor). The monitor is a static
+        attribute: the filters of the copy are compiled with the
+        instrumentation, and those of the model are left as they are.
+        with_monitor(None) removes the instrumentation
+        """
+        model = copy(self)
+        model.monitor = monitor
+        return model
 
-                Gt = self.Dfz(mu_t)
-                k1 = self._Vt_dot(Vt, Gt)
-                k2 = self._Vt_dot(Vt + dt * k1, Gt)
-                Vt = Vt + dt * (k1 + k2) / 2
-            
-            mu_t_cond = mu_t
-            Vt_cond = Vt
-            Ht = self.Dfx(mu_t_cond)
+    def _probe(self, stage, *values):
+        """
+        Report to the monitor that a stage of the current step has finished.
+        values are outputs of the stage, so that the callback runs once
+        they are computed. Nothing is traced without a monitor
+        """
+        if self.monitor is not None:
+            jax.debug.callback(partial(self.monitor.record_stage, stage), *values, ordered=True)
 
-            Kt = Vt_cond @ Ht.T @ jnp.linalg.inv(Ht @ Vt_cond @ Ht.T + self.R)
-            mu_t = mu_t_cond + Kt @ (sample_obs[t] - self.fx(mu_t_cond))
-            Vt = (I - Kt @ Ht) @ Vt_cond
+    def _probe_innovation(self, innovation, St):
+        """
+        Report the innovation and its covariance St to the monitor
+        """
+        if self.monitor is not None:
+            jax.debug.callback(self.monitor.record_innovation, jnp.linalg.norm(innovation), jnp.linalg.cond(St),
+                               ordered=True)
 
-            mu_hist = index_update(mu_hist, t, mu_t)
-            V_hist = index_update(V_hist, t, Vt)
-        
-        return mu_hist, V_hist
+    def _probe_step(self, mask, mu_t, Vt):
+        """
+        Report the end of a step with filtered moments (mu_t, Vt) to the monitor
+        """
+        if self.monitor is not None:
+            mask = True if mask is None else mask
+            has_nan = jnp.isnan(mu_t).any() | jnp.isnan(Vt).any()
+            jax.debug.callback(self.monitor.record_step, mask, jnp.linalg.cond(Vt), has_nan, ordered=True)
+
+    def _log_likelihood(self, init_state, sample_obs, observations, Vinit, checkpoint_every, mask=None, dt=None):
+        """
+        Total log-likelihood log p(x_{1:T}) of the filter of the subclass.
+        If checkpoint_every is not None, the sequence is split into blocks
+        of checkpoint_every steps whose internals are rematerialised
+        (jax.checkpoint) in the backward pass, so that the memory of
+        reverse-mode differentiation scales with the number of blocks
+        """
+        def loglik_step(state, xs):
+            state, hist = self._filter_step(state, xs)
+            return state, hist["loglik"]
 
+        state_init = self.init(init_state, Vinit)
+        xs = (sample_obs, observations, mask, dt)
+        if checkpoint_every is None:
+            _, loglik_hist = jax.lax.scan(loglik_step, state_init, xs)
+            return loglik_hist.sum()
 
-class UnscentedKalmanFilter(NLDS):
+        nsteps = len(sample_obs)
+        nblocks = ceil(nsteps / checkpoint_every)
+        npad = nblocks * checkpoint_every - nsteps
+        valid = jnp.arange(nblocks * checkpoint_every) < nsteps
+        def pad(x): return jnp.concatenate([x, jnp.repeat(x[-1:], npad, axis=0)])
+        def to_blocks(x): return x.reshape(nblocks, checkpoint_every, *x.shape[1:])
+        xs = jax.tree_util.tree_map(lambda x: to_blocks(pad(x)), xs), to_blocks(valid)
+
+        def masked_step(state, xs):
+            xs, valid = xs
+            state_new, loglik = loglik_step(state, xs)
+            state = jax.tree_util.tree_map(lambda new, old: jnp.where(valid, new, old), state_new, state)
+            return state, jnp.where(valid, loglik, 0.0)
+
+        @jax.checkpoint
+        def block_step(state, block):
+            state, loglik_hist = jax.lax.scan(masked_step, state, block)
+            return state, loglik_hist.sum()
+
+        _, loglik_blocks = jax.lax.scan(block_step, state_init, xs)
+        return loglik_blocks.sum()
+
+    @partial(jax.jit, static_argnums=(5,))
+    def log_likelihood(self, init_state, sample_obs, observations=None, Vinit=None, checkpoint_every=None,
+                       mask=None, dt=None):
+        """
+        Compiled total log-likelihood log p(x_{1:T}) of the filter of the
+        subclass. The per-step terms log p(x_t | x_{1:t-1}) are returned by
+        the filter with full_output=True under "loglik"
+
+        Parameters
+        ----------
+        init_state: array(state_size)
+        sample_obs: array(nsamples, obs_size)
+        observations: array(nsamples, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(state_size, state_size) or None
+            Initial covariance. Defaults to Q
+        checkpoint_every: int or None
+            Size of the rematerialised blocks (see fit_noise)
+        mask: array(nsamples) or None
+            Whether each observation is available. Missing
+            observations do not contribute to the log-likelihood
+        dt: array(nsamples) or None
+            Time elapsed since the previous step, passed as the
+            second argument to fz
+
+        Returns
+        -------
+        float: log-likelihood of the observations
+        """
+        return self._log_likelihood(init_state, sample_obs, observations, Vinit, checkpoint_every, mask, dt)
+
+    @partial(jax.jit, static_argnums=(6, 8))
+    def _fit_noise(self, params, init_state, sample_obs, observations, Vinit, n_iter, learning_rate,
+                   checkpoint_every, mask, dt):
+        """
+        Compiled Adam iterations over the unconstrained parameters of (Q, R)
+        """
+        nsteps = len(sample_obs)
+        b1, b2, eps = 0.9, 0.999, 1e-8
+
+        def loss(params):
+            model = self._noise_from_params(params)
+            loglik = model._log_likelihood(init_state, sample_obs, observations, Vinit, checkpoint_every, mask, dt)
+            return -loglik / nsteps
+
+        def adam_step(state, t):
+            params, m, v = state
+            value, grads = jax.value_and_grad(loss)(params)
+            m = jax.tree_util.tree_map(lambda m, g: b1 * m + (1 - b1) * g, m, grads)
+            v = jax.tree_util.tree_map(lambda v, g: b2 * v + (1 - b2) * g ** 2, v, grads)
+            def update(p, m, v):
+                m_hat, v_hat = m / (1 - b1 ** t), v / (1 - b2 ** t)
+                return p - learning_rate * m_hat / (jnp.sqrt(v_hat) + eps)
+            params = jax.tree_util.tree_map(update, params, m, v)
+            return (params, m, v), -value * nsteps
+
+        zeros = jax.tree_util.tree_map(jnp.zeros_like, params)
+        (params, _, _), loglik_hist = jax.lax.scan(adam_step, (params, zeros, zeros), jnp.arange(1, n_iter + 1))
+        return params, loglik_hist
+
+    def fit_noise(self, init_state, sample_obs, observations=None, Vinit=None, n_iter=100,
+                  learning_rate=0.05, checkpoint_every=None, mask=None, dt=None):
+        """
+        Learn the state and observation noise covariances (Q, R) by
+        maximising the log-likelihood of the filter of the subclass.
+        Gradients are obtained with jax.grad through the scanned filter
+        and all the Adam iterations run inside a single compiled call.
+        Q and R are parameterised through their Cholesky factors with
+        log-diagonals (see _noise_params), starting from the current
+        values of the model.
+
+        Parameters
+        ----------
+        init_state: array(state_size)
+        sample_obs: array(nsamples, obs_size)
+        observations: array(nsamples, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(state_size, state_size) or None
+            Initial covariance. Defaults to the learned Q
+        n_iter: int
+            Number of gradient steps
+        learning_rate: float
+            Adam learning rate
+        checkpoint_every: int or None
+            If not None, rematerialise (jax.checkpoint) blocks of
+            checkpoint_every steps in the backward pass. The memory of the
+            gradient then scales as nsamples / checkpoint_every +
+            checkpoint_every instead of nsamples, at the cost of an extra
+            forward pass. A block size of about sqrt(nsamples) is a good default.
+        mask: array(nsamples) or None
+            Whether each observation is available
+        dt: array(nsamples) or None
+            Time elapsed since the previous step, passed as the
+            second argument to fz
+
+        Returns
+        -------
+        * NLDS: copy of the model with the learned Q and R
+        * array(n_iter): log-likelihood at every iteration
+        """
+        params, loglik_hist = self._fit_noise(self._noise_params(), init_state, sample_obs, observations, Vinit,
+                                              n_iter, learning_rate, checkpoint_every, mask, dt)
+        return self._noise_from_params(params), loglik_hist
+
+    def _noise_params(self):
+        """
+        Unconstrained parameters of (Q, R) learned by fit_noise:
+        Cholesky factors with log-diagonals
+        """
+        return _params_from_cov(self.Q), _params_from_cov(self.R)
+
+    def _noise_from_params(self, params):
+        """
+        Copy of the model with the (Q, R) given by the
+        unconstrained parameters of _noise_params
+        """
+        Q_half, R_half = jax.tree_util.tree_map(_chol_from_params, params)
+        return self.replace_noise(Q_half @ Q_half.T, R_half @ R_half.T)
+
+    @staticmethod
+    def _smooth_step(state, xs):
+        """
+        Single backward step of the Rauch-Tung-Striebel smoother.
+        Written to be used as the body of a reversed jax.lax.scan
+
+        Parameters
+        ----------
+        state: tuple
+            (mu_smooth, V_smooth) smoothed mean and covariance at t+1
+        xs: tuple
+            (mu_t, Vt, mu_pred, V_pred, V_cross) filtered moments at t and
+            predicted moments and cross-covariance at t+1
+
+        Returns
+        -------
+        * tuple: (mu_smooth, V_smooth) smoothed mean and covariance at t
+        * tuple: (mu_smooth, V_smooth) values to store in the history
+        """
+        mu_smooth, V_smooth = state
+        mu_t, Vt, mu_pred, V_pred, V_cross = xs
+
+        # Jt = V_cross @ inv(V_pred), with V_pred symmetric
+        Jt = jnp.linalg.solve(V_pred, V_cross.T).T
+        mu_smooth = mu_t + Jt @ (mu_smooth - mu_pred)
+        V_smooth = Vt + Jt @ (V_smooth - V_pred) @ Jt.T
+
+        return (mu_smooth, V_smooth), (mu_smooth, V_smooth)
+
+    @jax.jit
+    def _smooth_scan(self, filter_hist):
+        """
+        Compiled Rauch-Tung-Striebel smoother over a single sequence
+        """
+        mu_hist, V_hist = filter_hist["mean"], filter_hist["cov"]
+        state_init = (mu_hist[-1], V_hist[-1])
+        xs = (mu_hist[:-1], V_hist[:-1], filter_hist["mean_pred"][1:],
+              filter_hist["cov_pred"][1:], filter_hist["cov_cross"][1:])
+        _, (mu_smooth_hist, V_smooth_hist) = jax.lax.scan(self._smooth_step, state_init, xs, reverse=True)
+
+        mu_smooth_hist = jnp.concatenate((mu_smooth_hist, mu_hist[-1:]))
+        V_smooth_hist = jnp.concatenate((V_smooth_hist, V_hist[-1:]))
+        return mu_smooth_hist, V_smooth_hist
+
+    def smooth(self, filter_hist):
+        """
+        Run the Rauch-Tung-Striebel smoother over the output of the filter.
+        The predicted moments and cross-covariances stored by the forward
+        pass are reused, so the model is not evaluated again.
+
+        Parameters
+        ----------
+        filter_hist: dict
+            Output of filter(..., full_output=True) or, for a batch of
+            sequences, of filter_batch(..., full_output=True)
+
+        Returns
+        -------
+        * array([n_sequences], nsamples, state_size)
+            History of smoothed mean terms
+        * array([n_sequences], nsamples, state_size, state_size)
+            History of smoothed covariance terms
+        """
+        if filter_hist["mean"].ndim == 3:
+            return jax.vmap(self._smooth_scan)(filter_hist)
+        return self._smooth_scan(filter_hist)
+
+
+class ExtendedKalmanFilter(NLDS):
     """
-    Implementation of the Unscented Kalman Filter for discrete time systems
+    Implementation of the Extended Kalman Filter for a nonlinear
+    dynamical system with discrete observations
     """
-    def __init__(self, fz, fx, Q, R, alpha, beta, kappa):
+    def __init__(self, fz, fx, Q, R, jacobian="auto", dtype=None):
+        """
+        Parameters
+        ----------
+        fz: function
+            State transition function
+        fx: function
+            Observation function
+        Q: array(state_size, state_size)
+        R: array(obs_size, obs_size)
+        jacobian: str or tuple
+            Strategy to linearise fz and fx: "jacfwd" (dense forward mode),
+            "jacrev" (dense reverse mode), "jvp" (matrix-free products of
+            the covariance with the linearised function) or "auto".
+            A tuple (fz strategy, fx strategy) sets each one separately.
+            "auto" uses "jvp" for fz, and "jacrev" for fx whenever
+            obs_size < state_size ("jvp" if equal, "jacfwd" otherwise).
+        dtype: jnp.dtype or None
+            If given (e.g. jnp.float32), inputs, noise covariances and
+            filtered moments are cast to dtype, and the update is computed in
+            its numerically stable form: Cholesky solves with the innovation
+            covariance, Joseph-form covariance update and symmetrised
+            covariances, which keeps them positive definite in single precision.
+            The outputs of fz and fx are cast to dtype as well
+        """
         super().__init__(fz, fx, Q, R)
-        self.d, _ = Q.shape
-        self.alpha = alpha
-        self.beta = beta
-        self.kappa = kappa
-        self.lmbda = alpha ** 2 * (self.d + kappa) - self.d
-        self.gamma = jnp.sqrt(self.d + self.lmbda)
+        self.dtype = dtype
+        self.Q, self.R = self._cast((Q, R))
+        jac_fz, jac_fx = (jacobian, jacobian) if isinstance(jacobian, str) else jacobian
+        self.jacobian = jacobian
+        self.jac_fz = _resolve_jacobian(jac_fz, self.state_size, self.state_size)
+        self.jac_fx = _resolve_jacobian(jac_fx, self.state_size, self.obs_size)
 
     @classmethod
-    def from_base(cls, model, alpha, beta, kappa):
+    def from_base(cls, model, jacobian="auto", dtype=None):
         """
         Initialise class from an instance of the NLDS parent class
         """
-        return cls(model.fz, model.fx, model.Q, model.R, alpha, beta, kappa)
-    
-    @staticmethod
-    def sqrtm(M):
+        return cls(model.fz, model.fx, model.Q, model.R, jacobian, dtype)
+
+    @property
+    def Dfz(self):
         """
-        Compute the matrix square-root of a hermitian
-        matrix M. i,e, R such that RR = M
-        
+        Dense Jacobian of fz (reverse mode with jac_fz="jacrev")
+        """
+        return jax.jacrev(self.fz) if self.jac_fz == "jacrev" else jax.jacfwd(self.fz)
+
+    @property
+    def Dfx(self):
+        """
+        Dense Jacobian of fx (reverse mode with jac_fx="jacrev")
+        """
+        return jax.jacrev(self.fx) if self.jac_fx == "jacrev" else jax.jacfwd(self.fx)
+
+    def _update(self, mu_t_cond, Vt_cond, xt, obs):
+        """
+        Update step of the Extended Kalman Filter: linearise fx
+        around the predicted mean
+
         Parameters
         ----------
-        M: array(m, m)
-            Hermitian matrix
-        
+        mu_t_cond: array(state_size)
+            Predicted mean at time t
+        Vt_cond: array(state_size, state_size)
+            Predicted covariance at time t
+        xt: array(obs_size)
+            Observation at time t
+        obs: tuple
+            (Optional) covariate at time t
+
         Returns
         -------
-        array(m, m): square-root matrix
+        * array(state_size): filtered mean at time t
+        * array(state_size, state_size): filtered covariance at time t
+        * dict: log p(xt | x_{1:t-1}) under the linearised model ("loglik")
         """
-        evals, evecs = jnp.linalg.eigh(M)
-        R = evecs @ jnp.sqrt(jnp.diag(evals)) @ jnp.linalg.inv(evecs)
-        return R
-    
-    def filter(self, init_state, sample_obs, observations=None, Vinit=None):
+        if self.dtype is not None:
+            return self._update_joseph(mu_t_cond, Vt_cond, xt, obs)
+        xt_hat, Ht_matmul = _linearize(self.fx, self.jac_fx, mu_t_cond, *obs, dtype=self.dtype)
+        HV = Ht_matmul(Vt_cond)
+        St = Ht_matmul(HV.T).T + self.R
+        # Kt = Vt_cond @ Ht.T @ inv(St), with St and Vt_cond symmetric
+        Kt = jnp.linalg.solve(St, HV).T
+        self._probe("gain", Kt)
+        self._probe_innovation(xt - xt_hat, St)
+        mu_t = mu_t_cond + Kt @ (xt - xt_hat)
+        # Kt @ HV is symmetric by construction, so the round-off asymmetry of
+        # Vt_cond would not be damped by the update and grow through Gt
+        Vt = _symmetrize(Vt_cond - Kt @ HV)
+        self._probe("update", mu_t, Vt)
+        loglik = stats.multivariate_normal.logpdf(xt, xt_hat, St)
+        return mu_t, Vt, {"loglik": loglik}
+
+    def _update_joseph(self, mu_t_cond, Vt_cond, xt, obs):
         """
-        Run the Unscented Kalman Filter algorithm over a set of observed samples.
+        Numerically stable version of the update step (see _update), used
+        whenever the filter has a dtype. The gain is obtained through the
+        Cholesky factor of the innovation covariance and the covariance through
+        the Joseph form (I - Kt Ht) Vt_cond (I - Kt Ht)^T + Kt R Kt^T,
+        which is positive semi-definite for any (inexact) gain
+        """
+        xt_hat, Ht_matmul = _linearize(self.fx, self.jac_fx, mu_t_cond, *obs, dtype=self.dtype)
+        HV = Ht_matmul(Vt_cond)
+        St = _symmetrize(Ht_matmul(HV.T).T + self.R)
+        St_half = jnp.linalg.cholesky(St)
+        Kt = cho_solve((St_half, True), HV).T
+        self._probe("gain", Kt)
+        self._probe_innovation(xt - xt_hat, St)
+        mu_t = mu_t_cond + Kt @ (xt - xt_hat)
+        # (I - Kt Ht) Vt_cond (I - Kt Ht)^T with A = (I - Kt Ht) Vt_cond and A Ht^T = (Ht A^T)^T
+        A = Vt_cond - Kt @ HV
+        Vt = A - Ht_matmul(A.T).T @ Kt.T + Kt @ self.R @ Kt.T
+        Vt = _symmetrize(Vt)
+        self._probe("update", mu_t, Vt)
+        loglik = _logpdf_chol(xt, xt_hat, St_half)
+        return mu_t, Vt, {"loglik": loglik}
+
+    def _filter_step(self, state, xs):
+        """
+        Single predict-update step of the Extended Kalman Filter.
+        Written to be used as the body of jax.lax.scan
+
+        Parameters
+        ----------
+        state: tuple
+            (mu_t, Vt) filtered mean and covariance at t-1
+        xs: tuple
+            (xt, obs, mask, dt) observation at time t and (optional)
+            covariate, availability of the observation and time step
+
+        Returns
+        -------
+        * tuple: (mu_t, Vt) filtered mean and covariance at t
+        * dict: filtered and predicted moments to store in the history
+        """
+        mu_t, Vt = self._cast(state)
+        xt, obs, mask, dt = self._cast(xs)
+        obs = () if obs is None else (obs,)
+        dt = () if dt is None else (dt,)
+
+        mu_t_cond, Gt_matmul = _linearize(self.fz, self.jac_fz, mu_t, *dt, dtype=self.dtype)
+        GV = Gt_matmul(Vt)
+        self._probe("jacobian", GV)
+        V_cross = GV.T
+        # Gt @ Vt @ Gt.T computed as (Gt @ (Gt @ Vt).T).T
+        Vt_cond = Gt_matmul(GV.T).T + self.Q
+        if self.dtype is not None:
+            Vt_cond = _symmetrize(Vt_cond)
+        self._probe("predict", mu_t_cond, Vt_cond)
+        mu_t, Vt, info = self._update(mu_t_cond, Vt_cond, self._mask_obs(mask, xt), obs)
+        # Prediction-only step for missing observations
+        mu_t, Vt = self._mask_update(mask, (mu_t, Vt), (mu_t_cond, Vt_cond))
+        info = self._mask_update(mask, info, jax.tree_util.tree_map(jnp.zeros_like, info))
+        self._probe_step(mask, mu_t, Vt)
+
+        hist = {
+            "mean": mu_t,
+            "cov": Vt,
+            "mean_pred": mu_t_cond,
+            "cov_pred": Vt_cond,
+            "cov_cross": V_cross,
+            **info
+        }
+        return self._cast((mu_t, Vt)), hist
+
+    @partial(jax.jit, static_argnums=(7,))
+    def _filter_scan(self, init_state, sample_obs, observations, Vinit, mask=None, dt=None, full_output=False):
+        """
+        Compiled version of the Extended Kalman Filter. The whole sequence
+        is processed on-device through jax.lax.scan; the function is traced
+        once per input shape.
+        """
+        state_init = self.init(init_state, Vinit)
+        xs = self._cast((sample_obs, observations, mask, dt))
+        _, hist = jax.lax.scan(self._filter_step, state_init, xs)
+        if full_output:
+            return hist
+        return hist["mean"], hist["cov"]
+
+    def _filter_loop(self, init_state, sample_obs, observations=None, Vinit=None):
+        """
+        Python-loop version of the Extended Kalman Filter. Kept as
+        a reference implementation for the compiled version.
+        """
+        I = jnp.eye(self.state_size)
+        nsamples = len(sample_obs)
+        Vt = self.Q if Vinit is None else Vinit
+        if observations is None:
+            observations = [()] * nsamples
+        else:
+            observations = [(obs,) for obs in observations]
+
+        mu_t = init_state
+
+        mu_hist = jnp.zeros((nsamples, self.state_size))
+        V_hist = jnp.zeros((nsamples, self.state_size, self.state_size))
+
+        mu_hist = mu_hist.at[0].set(mu_t)
+        V_hist = V_hist.at[0].set(Vt)
+
+        for t in range(nsamples):
+            Gt = self.Dfz(mu_t)
+            mu_t_cond = self.fz(mu_t)
+            Vt_cond = Gt @ Vt @ Gt.T + self.Q
+            Ht = self.Dfx(mu_t_cond, *observations[t])
+
+            xt_hat = self.fx(mu_t_cond, *observations[t])
+            Kt = Vt_cond @ Ht.T @ jnp.linalg.inv(Ht @ Vt_cond @ Ht.T + self.R)
+            mu_t = mu_t_cond + Kt @ (sample_obs[t] - xt_hat)
+            Vt = (I - Kt @ Ht) @ Vt_cond
+
+            mu_hist = mu_hist.at[t].set(mu_t)
+            V_hist = V_hist.at[t].set(Vt)
+        
+        return mu_hist, V_hist
+
+    def filter(self, init_state, sample_obs, observations=None, Vinit=None, method="scan", full_output=False,
+               mask=None, dt=None):
+        """
+        Run the Extended Kalman Filter algorithm over a set of observed samples.
 
         Parameters
         ----------
+        init_state: array(state_size)
         sample_obs: array(nsamples, obs_size)
+        observations: array(nsamples, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(state_size, state_size) or None
+            Initial covariance. Defaults to Q
+        method: str
+            "scan" runs the jit-compiled jax.lax.scan version;
+            "loop" runs the (slower) Python-loop version.
+        full_output: bool
+            If True (only with method="scan"), return a dictionary with the
+            filtered moments ("mean", "cov"), the predicted moments
+            ("mean_pred", "cov_pred"), the cross-covariance between
+            consecutive states ("cov_cross"), as required by smooth, and
+            the log-likelihood terms log p(x_t | x_{1:t-1}) ("loglik").
+        mask: array(nsamples) or None
+            Whether each observation is available. Steps with mask=False
+            (missing observations) only perform the prediction step
+        dt: array(nsamples) or None
+            Time elapsed since the previous step, passed as the second
+            argument to fz (irregularly-sampled observations)
 
         Returns
         -------
@@ -350,99 +1156,2826 @@ class UnscentedKalmanFilter(NLDS):
         * array(nsamples, state_size, state_size)
             History of filtered covariance terms
         """
-        wm_vec = jnp.array([1 / (2 * (self.d + self.lmbda)) if i > 0
-                            else self.lmbda / (self.d + self.lmbda)
-                            for i in range(2 * self.d + 1)])
-        wc_vec = jnp.array([1 / (2 * (self.d + self.lmbda)) if i > 0
-                            else self.lmbda / (self.d + self.lmbda) + (1 - self.alpha ** 2 + self.beta)
-                            for i in range(2 * self.d + 1)])
-        nsteps, *_ = sample_obs.shape
-        mu_t = init_state
-        Sigma_t = self.Q if Vinit is None else Vinit
-        if observations is None:
-            observations = [()] * nsteps
+        if method == "scan":
+            return self._filter_scan(init_state, sample_obs, observations, Vinit, mask, dt, full_output)
+        elif full_output or mask is not None or dt is not None:
+            raise ValueError("full_output, mask and dt are only available with method='scan'")
+        elif method == "loop":
+            return self._filter_loop(init_state, sample_obs, observations, Vinit)
         else:
-            observations = [(obs,) for obs in observations]
+            raise ValueError(f"method must be 'scan' or 'loop', got {method!r}")
 
-        mu_hist = jnp.zeros((nsteps, self.d))
-        Sigma_hist = jnp.zeros((nsteps, self.d, self.d))
 
-        mu_hist = index_update(mu_hist, 0, mu_t)
-        Sigma_hist = index_update(Sigma_hist, 0, Sigma_t)
+class IteratedExtendedKalmanFilter(ExtendedKalmanFilter):
+    """
+    Implementation of the Iterated Extended Kalman Filter. The update step
+    is the Gauss-Newton minimisation of the MAP objective
+        (xt - fx(z))^T R^-1 (xt - fx(z)) + (z - mu_pred)^T V_pred^-1 (z - mu_pred)
+    relinearising fx around the latest iterate. Iterations stop once the
+    norm of the change in the iterate falls below tol or after max_iter
+    iterations, so only strongly nonlinear steps pay for extra iterations.
+    With max_iter=1 the filter reduces to the Extended Kalman Filter.
+    See: Bell and Cathey (1993), "The iterated Kalman filter update
+    as a Gauss-Newton method"
+    """
+    # If True, the Gauss-Newton iterations run as a fixed number of steps
+    # (reverse-mode differentiable) rather than under jax.lax.while_loop
+    differentiable = False
 
-        for t in range(nsteps):
-            # TO-DO: use jax.scipy.linalg.sqrtm when it gets added to lib
-            comp1 = mu_t[:, None] + self.gamma * self.sqrtm(Sigma_t)
-            comp2 = mu_t[:, None] - self.gamma * self.sqrtm(Sigma_t)
-            #sigma_points = jnp.c_[mu_t, comp1, comp2]
-            sigma_points = jnp.concatenate((mu_t[:, None], comp1, comp2), axis=1)
+    def __init__(self, fz, fx, Q, R, max_iter=10, tol=1e-6, jacobian="auto"):
+        super().__init__(fz, fx, Q, R, jacobian)
+        self.max_iter = max_iter
+        self.tol = tol
 
-            z_bar = self.fz(sigma_points)
-            mu_bar = z_bar @ wm_vec
-            Sigma_bar = (z_bar - mu_bar[:, None])
-            Sigma_bar = jnp.einsum("i,ji,ki->jk", wc_vec, Sigma_bar, Sigma_bar) + self.Q
+    @classmethod
+    def from_base(cls, model, max_iter=10, tol=1e-6, jacobian="auto"):
+        """
+        Initialise class from an instance of the NLDS parent class
+        """
+        return cls(model.fz, model.fx, model.Q, model.R, max_iter, tol, jacobian)
 
-            Sigma_bar_half = self.sqrtm(Sigma_bar)
-            comp1 = mu_bar[:, None] + self.gamma * Sigma_bar_half
-            comp2 = mu_bar[:, None] - self.gamma * Sigma_bar_half
-            #sigma_points = jnp.c_[mu_bar, comp1, comp2]
-            sigma_points = jnp.concatenate((mu_bar[:, None], comp1, comp2), axis=1)
+    def _update(self, mu_t_cond, Vt_cond, xt, obs):
+        """
+        Iterated (Gauss-Newton) update step. The iterations run
+        under jax.lax.while_loop or, if self.differentiable, as max_iter
+        steps of jax.lax.fori_loop that leave the iterate unchanged
+        once it has converged
 
-            x_bar = self.fx(sigma_points, *observations[t])
-            x_hat = x_bar @ wm_vec
-            St = x_bar - x_hat[:, None]
-            St = jnp.einsum("i,ji,ki->jk", wc_vec, St, St) + self.R
+        Returns
+        -------
+        * array(state_size): filtered mean at time t
+        * array(state_size, state_size): filtered covariance at time t
+        * dict: number of Gauss-Newton iterations ("n_iter") and
+          log p(xt | x_{1:t-1}) under the last linearisation ("loglik")
+        """
+        def gauss_newton_step(carry):
+            i, mu_t, *_ = carry
+            xt_hat, Ht_matmul = _linearize(self.fx, self.jac_fx, mu_t, *obs, dtype=self.dtype)
+            xt_hat = xt_hat + Ht_matmul((mu_t_cond - mu_t)[:, None])[:, 0]
+            HV = Ht_matmul(Vt_cond)
+            St = Ht_matmul(HV.T).T + self.R
+            Kt = jnp.linalg.solve(St, HV).T
+            mu_next = mu_t_cond + Kt @ (xt - xt_hat)
+            return i + 1, mu_next, jnp.linalg.norm(mu_next - mu_t), Kt, HV, xt_hat, St
 
-            mu_hat_component = z_bar - mu_bar[:, None]
-            x_hat_component = x_bar - x_hat[:, None]
-            Sigma_bar_y = jnp.einsum("i,ji,ki->jk", wc_vec, mu_hat_component, x_hat_component)
-            Kt = Sigma_bar_y @ jnp.linalg.inv(St)
+        def not_converged(carry):
+            i, _, step_norm, *_ = carry
+            return (i < self.max_iter) & (step_norm > self.tol)
 
-            mu_t = mu_bar + Kt @ (sample_obs[t] - x_hat)
-            Sigma_t = Sigma_bar - Kt @ St @ Kt.T
-            
-            mu_hist = index_update(mu_hist, t, mu_t)
-            Sigma_hist = index_update(Sigma_hist, t, Sigma_t)
+        def frozen_step(_, carry):
+            return jax.lax.cond(not_converged(carry), gauss_newton_step, lambda carry: carry, carry)
 
-        return mu_hist, Sigma_hist
+        # The first iteration is the EKF update
+        carry = gauss_newton_step((0, mu_t_cond))
+        if self.differentiable:
+            carry = jax.lax.fori_loop(0, self.max_iter - 1, frozen_step, carry)
+        else:
+            carry = jax.lax.while_loop(not_converged, gauss_newton_step, carry)
+        n_iter, mu_t, _, Kt, HV, xt_hat, St = carry
+        self._probe("gain", Kt)
+        self._probe_innovation(xt - xt_hat, St)
+        Vt = _symmetrize(Vt_cond - Kt @ HV)
+        self._probe("update", mu_t, Vt)
+        loglik = stats.multivariate_normal.logpdf(xt, xt_hat, St)
+        return mu_t, Vt, {"n_iter": n_iter, "loglik": loglik}
 
+    def _log_likelihood(self, *args):
+        """
+        Total log-likelihood of the filter (see NLDS._log_likelihood). It is
+        the function that log_likelihood and fit_noise differentiate, so the
+        Gauss-Newton iterations run as a fixed-trip loop; the filter keeps
+        the jax.lax.while_loop
+        """
+        model = copy(self)
+        model.differentiable = True
+        return super(IteratedExtendedKalmanFilter, model)._log_likelihood(*args)
 
-class BootstrapFiltering(NLDS):
-    def __init__(self, fz, fx, Q, R):
+    def filter(self, init_state, sample_obs, observations=None, Vinit=None, full_output=False, mask=None, dt=None):
         """
-        Implementation of the Bootrstrap Filter for discrete time systems
-        **This implementation considers the case of multivariate normals**
+        Run the (compiled) Iterated Extended Kalman Filter over a set
+        of observed samples.
 
-        to-do: extend to general case
+        Parameters
+        ----------
+        init_state: array(state_size)
+        sample_obs: array(nsamples, obs_size)
+        observations: array(nsamples, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(state_size, state_size) or None
+            Initial covariance. Defaults to Q
+        full_output: bool
+            If True, return a dictionary with the filtered moments ("mean", "cov"),
+            the predicted moments ("mean_pred", "cov_pred"), the cross-covariance
+            between consecutive states ("cov_cross"), the number of
+            Gauss-Newton iterations ("n_iter") and the log-likelihood terms
+            log p(x_t | x_{1:t-1}) ("loglik") at every step
+        mask: array(nsamples) or None
+            Whether each observation is available. Steps with mask=False
+            (missing observations) only perform the prediction step
+        dt: array(nsamples) or None
+            Time elapsed since the previous step, passed as the second
+            argument to fz (irregularly-sampled observations)
+
+        Returns
+        -------
+        * array(nsamples, state_size)
+            History of filtered mean terms
+        * array(nsamples, state_size, state_size)
+            History of filtered covariance terms
+        """
+        return self._filter_scan(init_state, sample_obs, observations, Vinit, mask, dt, full_output)
+
+
+class DecoupledExtendedKalmanFilter(NLDS):
+    """
+    Implementation of the decoupled Extended Kalman Filter. The state is
+    split into consecutive blocks of block_size entries and the covariance
+    is approximated as block-diagonal, so that memory and per-step cost are
+    linear in the state size. With block_size=1 the covariance is diagonal
+    (fully decoupled EKF). Suited to states of high-dimensional parameters,
+    e.g., the weights of a neural network.
+    The state transition fz must not couple different blocks (e.g., a
+    random walk fz(z) = z). The observation function is linearised
+    with reverse-mode differentiation.
+    See: Puskorius and Feldkamp (1991), "Decoupled extended Kalman filter
+    training of feedforward layered networks"
+    """
+    def __init__(self, fz, fx, Q, R, diag_history=False):
+        """
+        Parameters
+        ----------
+        fz: function
+            State transition function
+        fx: function
+            Observation function
+        Q: array(nblocks, block_size, block_size) or array(state_size,)
+            Diagonal blocks of the state noise. A vector is taken to be
+            the diagonal of the state noise (block_size=1)
+        R: array(obs_size, obs_size)
+        diag_history: bool
+            If True, store only the diagonal of the covariance at every step
         """
+        Q = Q[:, None, None] if Q.ndim == 1 else Q
         super().__init__(fz, fx, Q, R)
-    
-    def filter(self, key, init_state, sample_obs, nsamples=2000):
+        self.nblocks, self.block_size, _ = Q.shape
+        self.state_size = self.nblocks * self.block_size
+        self.diag_history = diag_history
+
+    @classmethod
+    def from_base(cls, model, block_size=1, diag_history=False):
         """
-        init_state: array(state_size,)
-            Initial state estimate
-        sample_obs: array(nsamples, obs_size)
-            Samples of the observations
+        Initialise class from an instance of the NLDS parent class.
+        Only the diagonal blocks of model.Q are kept
         """
-        nsteps = sample_obs.shape[0]
-        mu_hist = jnp.zeros((nsteps, 2))
-        keys = split(key, nsteps)
-        for t, key_t in enumerate(keys):
-            if t == 0:
-                zt_rvs = random.multivariate_normal(key_t, init_state, self.Q, (nsamples,))
-            else:
-                zt_rvs = random.multivariate_normal(key_t, self.fz(zt_rvs), self.Q)
-                
-            xt_rvs = random.multivariate_normal(key_t, self.fx(zt_rvs), self.R)
-            
-            weights_t = stats.multivariate_normal.pdf(sample_obs[t], xt_rvs, self.Q)
-            weights_t = weights_t / weights_t.sum()
-            
-            mu_t = (zt_rvs * weights_t[:, None]).sum(axis=0)
-            mu_hist = index_update(mu_hist, t, mu_t)
-        return mu_hist
+        nblocks = model.state_size // block_size
+        Q = model.Q.reshape(nblocks, block_size, nblocks, block_size)
+        Q = Q[jnp.arange(nblocks), :, jnp.arange(nblocks)]
+        return cls(model.fz, model.fx, Q, model.R, diag_history)
+
+    @property
+    def Dfx(self):
+        """
+        Jacobian of fx in reverse mode (fx has fewer outputs than inputs)
+        """
+        return jax.jacrev(self.fx)
 
+    def replace_noise(self, Q, R):
+        """
+        Copy of the model with the state and observation noise
+        covariances replaced by Q and R
 
-class RaoBlackwellParticleFilter(NLDS):
-    def __init__(self, fz, fx, Q, R):
-        super().__init__(self, fz, fx, Q, R)
\ No newline at end of file
+        Parameters
+        ----------
+        Q: array(nblocks, block_size, block_size) or array(state_size,)
+            Diagonal blocks (or diagonal) of the state noise
+        R: array(obs_size, obs_size)
+        """
+        return super().replace_noise(self._to_blocks(Q), R)
+
+    def _noise_params(self):
+        """
+        Unconstrained parameters of (Q, R) learned by fit_noise:
+        Cholesky factors with log-diagonals of every block of Q and of R
+        """
+        return jax.vmap(_params_from_cov)(self.Q), _params_from_cov(self.R)
+
+    def _noise_from_params(self, params):
+        """
+        Copy of the model with the (Q, R) given by the
+        unconstrained parameters of _noise_params
+        """
+        Q_params, R_params = params
+        Q_half = jax.vmap(_chol_from_params)(Q_params)
+        R_half = _chol_from_params(R_params)
+        return self.replace_noise(Q_half @ Q_half.transpose(0, 2, 1), R_half @ R_half.T)
+
+    def _to_blocks(self, V):
+        """
+        Block-diagonal representation of the initial covariance
+        """
+        if V.ndim == 1:
+            return V.reshape(self.nblocks, self.block_size, 1) * jnp.eye(self.block_size)
+        return V
+
+    def init(self, init_state, Vinit=None):
+        """
+        Initial state of the online (streaming) version of the filter
+
+        Parameters
+        ----------
+        init_state: array(state_size)
+        Vinit: array(nblocks, block_size, block_size), array(state_size,) or None
+            Diagonal blocks (or diagonal) of the initial covariance. Defaults to Q
+
+        Returns
+        -------
+        tuple: (init_state, diagonal blocks of Vinit)
+        """
+        Vinit = None if Vinit is None else self._to_blocks(Vinit)
+        return super().init(init_state, Vinit)
+
+    def _block_jacobian(self, mu_t, *dt):
+        """
+        Diagonal blocks of the Jacobian of fz evaluated at mu_t, obtained
+        with block_size forward-mode products (exact whenever fz does not
+        couple different blocks)
+
+        Returns
+        -------
+        * array(state_size): fz(mu_t)
+        * array(nblocks, block_size, block_size): diagonal blocks of the Jacobian
+        """
+        tangents = jnp.tile(jnp.eye(self.block_size), (1, self.nblocks))
+        jvp = lambda tangent: jax.jvp(lambda z: self.fz(z, *dt), (mu_t,), (tangent,))
+        mu_t_cond, columns = jax.vmap(jvp)(tangents)
+        Gt = columns.reshape(self.block_size, self.nblocks, self.block_size).transpose(1, 2, 0)
+        return mu_t_cond[0], Gt
+
+    def _filter_step(self, state, xs):
+        """
+        Single predict-update step of the decoupled Extended Kalman Filter.
+        Written to be used as the body of jax.lax.scan
+
+        Parameters
+        ----------
+        state: tuple
+            (mu_t, Vt) filtered mean and diagonal blocks of the
+            filtered covariance at t-1
+        xs: tuple
+            (xt, obs, mask, dt) observation at time t and (optional)
+            covariate, availability of the observation and time step
+
+        Returns
+        -------
+        * tuple: (mu_t, Vt) filtered mean and covariance blocks at t
+        * dict: filtered mean ("mean"), covariance blocks or diagonal ("cov")
+          and log p(xt | x_{1:t-1}) ("loglik")
+        """
+        mu_t, Vt = state
+        xt, obs, mask, dt = xs
+        obs = () if obs is None else (obs,)
+        dt = () if dt is None else (dt,)
+        xt = self._mask_obs(mask, xt)
+
+        mu_t_cond, Gt = self._block_jacobian(mu_t, *dt)
+        Vt_cond = jnp.einsum("kij,kjl,kml->kim", Gt, Vt, Gt) + self.Q
+
+        Ht = self.Dfx(mu_t_cond, *obs)
+        Ht = Ht.reshape(self.obs_size, self.nblocks, self.block_size).transpose(1, 0, 2)
+        HV = jnp.einsum("kmi,kij->kmj", Ht, Vt_cond)
+        St = jnp.einsum("kmi,kni->mn", HV, Ht) + self.R
+        HV_flat = HV.transpose(1, 0, 2).reshape(self.obs_size, self.state_size)
+        # Kt = Vt_cond @ Ht.T @ inv(St), computed blockwise
+        Kt = jnp.linalg.solve(St, HV_flat).T
+
+        xt_hat = self.fx(mu_t_cond, *obs)
+        mu_t = mu_t_cond + Kt @ (xt - xt_hat)
+        Kt = Kt.reshape(self.nblocks, self.block_size, self.obs_size)
+        Vt = Vt_cond - jnp.einsum("kim,kmj->kij", Kt, HV)
+        mu_t, Vt = self._mask_update(mask, (mu_t, Vt), (mu_t_cond, Vt_cond))
+        loglik = self._mask_update(mask, stats.multivariate_normal.logpdf(xt, xt_hat, St), 0.0)
+
+        cov = jnp.diagonal(Vt, axis1=1, axis2=2).ravel() if self.diag_history else Vt
+        hist = {
+            "mean": mu_t,
+            "cov": cov,
+            "loglik": loglik
+        }
+        return (mu_t, Vt), hist
+
+    @partial(jax.jit, static_argnums=(7,))
+    def _filter_scan(self, init_state, sample_obs, observations, Vinit, mask=None, dt=None, full_output=False):
+        """
+        Compiled version of the decoupled Extended Kalman Filter.
+        """
+        state_init = self.init(init_state, Vinit)
+        xs = (sample_obs, observations, mask, dt)
+        _, hist = jax.lax.scan(self._filter_step, state_init, xs)
+        if full_output:
+            return hist
+        return hist["mean"], hist["cov"]
+
+    def filter(self, init_state, sample_obs, observations=None, Vinit=None, full_output=False, mask=None, dt=None):
+        """
+        Run the (compiled) decoupled Extended Kalman Filter over
+        a set of observed samples.
+
+        Parameters
+        ----------
+        init_state: array(state_size)
+        sample_obs: array(nsamples, obs_size)
+        observations: array(nsamples, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(nblocks, block_size, block_size), array(state_size,) or None
+            Diagonal blocks (or diagonal) of the initial covariance. Defaults to Q
+        full_output: bool
+            If True, return a dictionary with the filtered moments ("mean", "cov")
+            and the log-likelihood terms log p(x_t | x_{1:t-1}) ("loglik")
+        mask: array(nsamples) or None
+            Whether each observation is available. Steps with mask=False
+            (missing observations) only perform the prediction step
+        dt: array(nsamples) or None
+            Time elapsed since the previous step, passed as the second
+            argument to fz (irregularly-sampled observations)
+
+        Returns
+        -------
+        * array(nsamples, state_size)
+            History of filtered mean terms
+        * array(nsamples, nblocks, block_size, block_size) or array(nsamples, state_size)
+            History of diagonal blocks of the filtered covariance
+            (or of its diagonal if diag_history=True)
+        """
+        return self._filter_scan(init_state, sample_obs, observations, Vinit, mask, dt, full_output)
+
+    def smooth(self, filter_hist):
+        """
+        Not available: the filter does not store the dense predicted
+        moments and cross-covariances used by the Rauch-Tung-Striebel smoother
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not store the dense predicted moments "
+                                  "needed by smooth")
+
+
+class LowRankExtendedKalmanFilter(NLDS):
+    """
+    Implementation of the Extended Kalman Filter with a diagonal plus
+    low-rank precision matrix
+        inv(Vt) = diag(Upsilon_t) + W_t @ W_t.T,    W_t: array(state_size, rank)
+    Memory and per-step cost are linear in the state size, and dense
+    covariances are never formed. The predict step is exact whenever
+    fz acts elementwise (e.g., a random walk fz(z) = z, or a decay
+    fz(z) = gamma * z). After the update, the precision has rank
+    rank + obs_size and is projected back onto rank through an SVD
+    (computed from the eigendecomposition of its Gram matrix);
+    the diagonal of the discarded part is kept in Upsilon_t.
+    See: Chang, Durán-Martín, Shestopaloff, Jones and Murphy (2023),
+    "Low-rank extended Kalman filtering for online learning of neural
+    networks from streaming data"
+    """
+    def __init__(self, fz, fx, Q, R, rank, diag_history=False):
+        """
+        Parameters
+        ----------
+        fz: function
+            Elementwise state transition function
+        fx: function
+            Observation function
+        Q: array(state_size,)
+            Diagonal of the state noise
+        R: array(obs_size, obs_size)
+        rank: int
+            Rank of the low-rank part of the precision matrix
+        diag_history: bool
+            If True, store only the diagonal of the covariance at every step
+        """
+        super().__init__(fz, fx, Q, R)
+        self.rank = rank
+        self.diag_history = diag_history
+
+    @classmethod
+    def from_base(cls, model, rank, diag_history=False):
+        """
+        Initialise class from an instance of the NLDS parent class.
+        Only the diagonal of model.Q is kept
+        """
+        return cls(model.fz, model.fx, jnp.diag(model.Q), model.R, rank, diag_history)
+
+    @property
+    def Dfx(self):
+        """
+        Jacobian of fx in reverse mode (fx has fewer outputs than inputs)
+        """
+        return jax.jacrev(self.fx)
+
+    def _noise_params(self):
+        """
+        Unconstrained parameters of (Q, R) learned by fit_noise:
+        log-diagonal of Q and Cholesky factor with log-diagonal of R
+        """
+        return jnp.log(self.Q), _params_from_cov(self.R)
+
+    def _noise_from_params(self, params):
+        """
+        Copy of the model with the (Q, R) given by the
+        unconstrained parameters of _noise_params
+        """
+        log_Q, R_params = params
+        R_half = _chol_from_params(R_params)
+        return self.replace_noise(jnp.exp(log_Q), R_half @ R_half.T)
+
+    def init(self, init_state, Vinit=None):
+        """
+        Initial state of the online (streaming) version of the filter
+
+        Parameters
+        ----------
+        init_state: array(state_size)
+        Vinit: array(state_size,) or None
+            Diagonal of the initial covariance. Defaults to Q
+
+        Returns
+        -------
+        tuple: (init_state, diagonal of the precision, zero low-rank factor)
+        """
+        init_state, Vt = super().init(init_state, Vinit)
+        W = jnp.zeros((self.state_size, self.rank), Vt.dtype)
+        return init_state, 1 / Vt, W
+
+    @staticmethod
+    def _cov_matmul(Upsilon, W, M):
+        """
+        Compute inv(diag(Upsilon) + W @ W.T) @ M via the Woodbury identity
+        """
+        W_scaled = W / Upsilon[:, None]
+        M_scaled = M / Upsilon[:, None]
+        inner = jnp.eye(W.shape[1]) + W.T @ W_scaled
+        return M_scaled - W_scaled @ jnp.linalg.solve(inner, W.T @ M_scaled)
+
+    @staticmethod
+    def cov_diag(Upsilon, W):
+        """
+        Diagonal of the covariance inv(diag(Upsilon) + W @ W.T)
+
+        Parameters
+        ----------
+        Upsilon: array(state_size,)
+            Diagonal part of the precision
+        W: array(state_size, rank)
+            Low-rank part of the precision
+
+        Returns
+        -------
+        array(state_size)
+        """
+        W_scaled = W / Upsilon[:, None]
+        L = jnp.linalg.cholesky(jnp.eye(W.shape[1]) + W.T @ W_scaled)
+        Z = solve_triangular(L, W_scaled.T, lower=True)
+        return 1 / Upsilon - (Z ** 2).sum(axis=0)
+
+    def _predict(self, mu_t, Upsilon, W, *dt):
+        """
+        Predict step in precision form for an elementwise fz with
+        (diagonal) Jacobian g and diagonal state noise q:
+            inv(g V g + q) = diag(Upsilon_pred) + W_pred @ W_pred.T
+        """
+        ones = jnp.ones(self.state_size)
+        mu_t_cond, g = jax.jvp(lambda z: self.fz(z, *dt), (mu_t,), (ones,))
+        Upsilon = Upsilon / g ** 2
+        W = W / g[:, None]
+
+        shrink = 1 + self.Q * Upsilon
+        Upsilon_cond = Upsilon / shrink
+        inner = jnp.eye(self.rank) + W.T @ (W * (self.Q / shrink)[:, None])
+        W_cond = (W / shrink[:, None]) @ jnp.linalg.cholesky(jnp.linalg.inv(inner))
+        return mu_t_cond, Upsilon_cond, W_cond
+
+    def _filter_step(self, state, xs):
+        """
+        Single predict-update step of the low-rank Extended Kalman Filter.
+        Written to be used as the body of jax.lax.scan
+
+        Parameters
+        ----------
+        state: tuple
+            (mu_t, Upsilon_t, W_t) filtered mean and diagonal and
+            low-rank parts of the filtered precision at t-1
+        xs: tuple
+            (xt, obs, mask, dt) observation at time t and (optional)
+            covariate, availability of the observation and time step
+
+        Returns
+        -------
+        * tuple: (mu_t, Upsilon_t, W_t) at time t
+        * dict: filtered mean ("mean"), diagonal ("prec_diag") and low-rank
+          ("prec_lowrank") parts of the precision, or the diagonal of the
+          covariance ("cov") if diag_history=True, and log p(xt | x_{1:t-1})
+          ("loglik")
+        """
+        mu_t, Upsilon, W = state
+        xt, obs, mask, dt = xs
+        obs = () if obs is None else (obs,)
+        dt = () if dt is None else (dt,)
+        xt = self._mask_obs(mask, xt)
+
+        mu_t_cond, Upsilon_cond, W_cond = self._predict(mu_t, Upsilon, W, *dt)
+
+        Ht = self.Dfx(mu_t_cond, *obs)
+        xt_hat = self.fx(mu_t_cond, *obs)
+        VH = self._cov_matmul(Upsilon_cond, W_cond, Ht.T)
+        St = Ht @ VH + self.R
+        # Kt = Vt_cond @ Ht.T @ inv(St), with St symmetric
+        Kt = jnp.linalg.solve(St, VH.T).T
+        mu_t = mu_t_cond + Kt @ (xt - xt_hat)
+
+        # inv(Vt) = inv(Vt_cond) + Ht.T @ inv(R) @ Ht, projected onto the given rank
+        R_half = jnp.linalg.cholesky(self.R)
+        W_full = jnp.concatenate((W_cond, solve_triangular(R_half, Ht, lower=True).T), axis=1)
+        # Leading right-singular vectors of W_full. Through _eigh, so that the
+        # filter can be differentiated when singular values are tied (e.g. W_cond = 0)
+        _, V = _eigh(W_full.T @ W_full)
+        W = W_full @ V[:, -self.rank:]
+        Upsilon = Upsilon_cond + (W_full ** 2).sum(axis=1) - (W ** 2).sum(axis=1)
+        mu_t, Upsilon, W = self._mask_update(mask, (mu_t, Upsilon, W), (mu_t_cond, Upsilon_cond, W_cond))
+        loglik = self._mask_update(mask, stats.multivariate_normal.logpdf(xt, xt_hat, St), 0.0)
+
+        hist = {"mean": mu_t, "loglik": loglik}
+        if self.diag_history:
+            hist["cov"] = self.cov_diag(Upsilon, W)
+        else:
+            hist["prec_diag"] = Upsilon
+            hist["prec_lowrank"] = W
+        return (mu_t, Upsilon, W), hist
+
+    @partial(jax.jit, static_argnums=(7,))
+    def _filter_scan(self, init_state, sample_obs, observations, Vinit, mask=None, dt=None, full_output=False):
+        """
+        Compiled version of the low-rank Extended Kalman Filter.
+        """
+        state_init = self.init(init_state, Vinit)
+        xs = (sample_obs, observations, mask, dt)
+        _, hist = jax.lax.scan(self._filter_step, state_init, xs)
+        if full_output:
+            return hist
+        if self.diag_history:
+            return hist["mean"], hist["cov"]
+        return hist["mean"], (hist["prec_diag"], hist["prec_lowrank"])
+
+    def filter(self, init_state, sample_obs, observations=None, Vinit=None, full_output=False, mask=None, dt=None):
+        """
+        Run the (compiled) low-rank Extended Kalman Filter over
+        a set of observed samples.
+
+        Parameters
+        ----------
+        init_state: array(state_size)
+        sample_obs: array(nsamples, obs_size)
+        observations: array(nsamples, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(state_size,) or None
+            Diagonal of the initial covariance. Defaults to Q
+        full_output: bool
+            If True, return the dictionary of histories (see _filter_step)
+        mask: array(nsamples) or None
+            Whether each observation is available. Steps with mask=False
+            (missing observations) only perform the prediction step
+        dt: array(nsamples) or None
+            Time elapsed since the previous step, passed as the second
+            argument to fz (irregularly-sampled observations)
+
+        Returns
+        -------
+        * array(nsamples, state_size)
+            History of filtered mean terms
+        * array(nsamples, state_size) if diag_history=True, else the tuple
+          (array(nsamples, state_size), array(nsamples, state_size, rank))
+            History of the diagonal of the filtered covariance, or of the
+            diagonal and low-rank parts of the filtered precision
+        """
+        return self._filter_scan(init_state, sample_obs, observations, Vinit, mask, dt, full_output)
+
+    def smooth(self, filter_hist):
+        """
+        Not available: the filter does not store the dense predicted
+        moments and cross-covariances used by the Rauch-Tung-Striebel smoother
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not store the dense predicted moments "
+                                  "needed by smooth")
+
+
+class ParallelExtendedKalmanFilter(NLDS):
+    """
+    Parallel-in-time (iterated) Extended Kalman filter and RTS smoother.
+    The model is linearised around a nominal trajectory and the resulting
+    linear-Gaussian filtering and smoothing recursions are computed with
+    jax.lax.associative_scan, which has O(log T) depth instead of the
+    O(T) depth of the sequential filters.
+
+    For linear-Gaussian models (fz, fx linear) the linearisation is exact
+    and a single iteration recovers the Kalman filter and RTS smoother.
+    For nonlinear models, every iteration relinearises around the smoothed
+    means of the previous one (iterated extended Kalman smoother).
+
+    See:
+    * Särkkä and García-Fernández (2021), "Temporal parallelization of
+      Bayesian smoothers"
+    * Yaghoobi et al. (2021), "Parallel iterated extended and sigma-point
+      Kalman smoothers"
+    """
+    @classmethod
+    def from_base(cls, model):
+        """
+        Initialise class from an instance of the NLDS parent class
+        """
+        return cls(model.fz, model.fx, model.Q, model.R)
+
+    def _linearize(self, init_state, nominal, observations):
+        """
+        First-order Taylor expansion of fz and fx around a nominal trajectory,
+        i.e., fz(z) ≈ F z + c and fx(z) ≈ H z + d
+
+        Parameters
+        ----------
+        init_state: array(state_size)
+        nominal: array(nsamples, state_size)
+        observations: array(nsamples, ...) or None
+
+        Returns
+        -------
+        * array(nsamples, state_size, state_size): F
+        * array(nsamples, state_size): c
+        * array(nsamples, obs_size, state_size): H
+        * array(nsamples, obs_size): d
+        """
+        obs = () if observations is None else (observations,)
+        nominal_prev = jnp.concatenate((init_state[None], nominal[:-1]))
+
+        F = jax.vmap(self.Dfz)(nominal_prev)
+        c = jax.vmap(self.fz)(nominal_prev) - jnp.einsum("tij,tj->ti", F, nominal_prev)
+        H = jax.vmap(self.Dfx)(nominal, *obs)
+        d = jax.vmap(self.fx)(nominal, *obs) - jnp.einsum("tij,tj->ti", H, nominal)
+        return F, c, H, d
+
+    def _filter_elements(self, init_state, Vinit, sample_obs, F, c, H, d):
+        """
+        Elements (A, b, C, eta, J) of the parallel Kalman filter.
+        The first element conditions on the prior N(init_state, Vinit)
+        """
+        I = jnp.eye(self.state_size)
+
+        def element(F, c, H, d, xt):
+            St = H @ self.Q @ H.T + self.R
+            Kt = jnp.linalg.solve(St, H @ self.Q).T
+            A = (I - Kt @ H) @ F
+            b = c + Kt @ (xt - H @ c - d)
+            C = (I - Kt @ H) @ self.Q
+            HF = H @ F
+            eta = HF.T @ jnp.linalg.solve(St, xt - H @ c - d)
+            J = HF.T @ jnp.linalg.solve(St, HF)
+            return A, b, C, eta, J
+
+        A, b, C, eta, J = jax.vmap(element)(F, c, H, d, sample_obs)
+
+        mu_cond = F[0] @ init_state + c[0]
+        V_cond = F[0] @ Vinit @ F[0].T + self.Q
+        St = H[0] @ V_cond @ H[0].T + self.R
+        Kt = jnp.linalg.solve(St, H[0] @ V_cond).T
+        A = A.at[0].set(jnp.zeros_like(I))
+        b = b.at[0].set(mu_cond + Kt @ (sample_obs[0] - H[0] @ mu_cond - d[0]))
+        C = C.at[0].set(V_cond - Kt @ St @ Kt.T)
+        eta = eta.at[0].set(jnp.zeros(self.state_size))
+        J = J.at[0].set(jnp.zeros_like(I))
+        return A, b, C, eta, J
+
+    @staticmethod
+    def _filter_operator(elem1, elem2):
+        """
+        Associative operator of the parallel Kalman filter
+        """
+        A1, b1, C1, eta1, J1 = elem1
+        A2, b2, C2, eta2, J2 = elem2
+        I = jnp.eye(len(b1))
+
+        # A2 @ inv(I + C1 @ J2) and A1.T @ inv(I + J2 @ C1)
+        A2M = jnp.linalg.solve((I + C1 @ J2).T, A2.T).T
+        A1N = jnp.linalg.solve((I + J2 @ C1).T, A1).T
+
+        A = A2M @ A1
+        b = A2M @ (b1 + C1 @ eta2) + b2
+        C = A2M @ C1 @ A2.T + C2
+        eta = A1N @ (eta2 - J2 @ b1) + eta1
+        J = A1N @ J2 @ A1 + J1
+        return A, b, (C + C.T) / 2, eta, (J + J.T) / 2
+
+    def _smoother_elements(self, mu_hist, V_hist, F, c):
+        """
+        Elements (E, g, L) of the parallel RTS smoother. The last
+        element is given by the last filtered moments
+        """
+        def element(mu_t, Vt, F_next, c_next):
+            V_cond = F_next @ Vt @ F_next.T + self.Q
+            Et = jnp.linalg.solve(V_cond, F_next @ Vt).T
+            g = mu_t - Et @ (F_next @ mu_t + c_next)
+            L = Vt - Et @ F_next @ Vt
+            return Et, g, L
+
+        E, g, L = jax.vmap(element)(mu_hist[:-1], V_hist[:-1], F[1:], c[1:])
+        E = jnp.concatenate((E, jnp.zeros((1, self.state_size, self.state_size))))
+        g = jnp.concatenate((g, mu_hist[-1:]))
+        L = jnp.concatenate((L, V_hist[-1:]))
+        return E, g, L
+
+    @staticmethod
+    def _smoother_operator(elem1, elem2):
+        """
+        Associative operator of the parallel RTS smoother
+        (used with a reversed associative scan)
+        """
+        E1, g1, L1 = elem1
+        E2, g2, L2 = elem2
+        E = E2 @ E1
+        g = E2 @ g1 + g2
+        L = E2 @ L1 @ E2.T + L2
+        return E, g, (L + L.T) / 2
+
+    def _filter_smooth_linear(self, init_state, Vinit, sample_obs, F, c, H, d):
+        """
+        Parallel filter and smoother of the linearised model
+        """
+        elems = self._filter_elements(init_state, Vinit, sample_obs, F, c, H, d)
+        _, mu_hist, V_hist, _, _ = jax.lax.associative_scan(jax.vmap(self._filter_operator), elems)
+
+        elems = self._smoother_elements(mu_hist, V_hist, F, c)
+        _, mu_smooth_hist, V_smooth_hist = jax.lax.associative_scan(jax.vmap(self._smoother_operator),
+                                                                    elems, reverse=True)
+        return (mu_hist, V_hist), (mu_smooth_hist, V_smooth_hist)
+
+    @partial(jax.jit, static_argnums=(6,))
+    def _filter_smooth(self, init_state, sample_obs, observations, Vinit, nominal, n_iter):
+        """
+        Compiled iterated parallel filter and smoother. Every iteration
+        relinearises the model around the previous smoothed means
+        """
+        nsamples = len(sample_obs)
+        Vinit = self.Q if Vinit is None else Vinit
+        nominal = jnp.broadcast_to(init_state, (nsamples, self.state_size)) if nominal is None else nominal
+
+        def iteration(_, nominal):
+            linearisation = self._linearize(init_state, nominal, observations)
+            _, (mu_smooth_hist, _) = self._filter_smooth_linear(init_state, Vinit, sample_obs, *linearisation)
+            return mu_smooth_hist
+
+        nominal = jax.lax.fori_loop(0, n_iter - 1, iteration, nominal)
+        linearisation = self._linearize(init_state, nominal, observations)
+        return self._filter_smooth_linear(init_state, Vinit, sample_obs, *linearisation)
+
+    def filter(self, init_state, sample_obs, observations=None, Vinit=None, nominal=None, n_iter=1):
+        """
+        Run the parallel-in-time (iterated) Extended Kalman Filter
+        over a set of observed samples.
+
+        Parameters
+        ----------
+        init_state: array(state_size)
+        sample_obs: array(nsamples, obs_size)
+        observations: array(nsamples, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(state_size, state_size) or None
+            Initial covariance. Defaults to Q
+        nominal: array(nsamples, state_size) or None
+            Initial trajectory to linearise the model. Defaults to init_state
+            at every step
+        n_iter: int
+            Number of linearisations. Use 1 for linear-Gaussian models
+
+        Returns
+        -------
+        * array(nsamples, state_size)
+            History of filtered mean terms
+        * array(nsamples, state_size, state_size)
+            History of filtered covariance terms
+        """
+        filter_hist, _ = self._filter_smooth(init_state, sample_obs, observations, Vinit, nominal, n_iter)
+        return filter_hist
+
+    def smooth(self, init_state, sample_obs, observations=None, Vinit=None, nominal=None, n_iter=1):
+        """
+        Run the parallel-in-time (iterated) Extended RTS smoother
+        over a set of observed samples.
+
+        Parameters
+        ----------
+        init_state: array(state_size)
+        sample_obs: array(nsamples, obs_size)
+        observations: array(nsamples, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(state_size, state_size) or None
+            Initial covariance. Defaults to Q
+        nominal: array(nsamples, state_size) or None
+            Initial trajectory to linearise the model. Defaults to init_state
+            at every step
+        n_iter: int
+            Number of linearisations. Use 1 for linear-Gaussian models
+
+        Returns
+        -------
+        * array(nsamples, state_size)
+            History of smoothed mean terms
+        * array(nsamples, state_size, state_size)
+            History of smoothed covariance terms
+        """
+        _, smooth_hist = self._filter_smooth(init_state, sample_obs, observations, Vinit, nominal, n_iter)
+        return smooth_hist
+
+
+class ContinuousExtendedKalmanFilter(_PytreeModel):
+    """
+    Extended Kalman Filter for a nonlinear continuous time
+    dynamical system with observations in discrete time.
+    """
+    def __init__(self, fz, fx, Q, R):
+        self.fz = fz
+        self.fx = fx
+        self.Q = Q
+        self.R = R
+        self.state_size, _ = Q.shape
+        self.obs_size, _ = R.shape
+
+    Dfz = NLDS.Dfz
+    Dfx = NLDS.Dfx
+        
+    @staticmethod
+    def _rk2(x0, f, nsteps, dt):
+        """
+        class-independent second-order Runge-Kutta method
+        
+        Parameters
+        ----------
+        x0: array(state_size, )
+            Initial state of the system
+        f: function
+            Function to integrate. Must return jax.numpy
+            array of size state_size
+        nsteps: int
+            Total number of steps to integrate
+        dt: float
+            integration step size
+        
+        Returns
+        -------
+        array(nsteps, state_size)
+            Integration history
+        """
+        def rk2_step(xt, _):
+            xt = ContinuousExtendedKalmanFilter._rk2_step(f, xt, dt)
+            return xt, xt
+
+        _, simulation = jax.lax.scan(rk2_step, x0, None, length=nsteps - 1)
+        simulation = jnp.concatenate((x0[None, :], simulation))
+        return simulation
+
+    @staticmethod
+    def _rk2_step(f, y, dt):
+        """
+        Single step of the second-order Runge-Kutta (Heun) method
+        """
+        k1 = f(y)
+        k2 = f(y + dt * k1)
+        return y + dt * (k1 + k2) / 2
+
+    @staticmethod
+    def _rk4_step(f, y, dt):
+        """
+        Single step of the classical fourth-order Runge-Kutta method
+        """
+        k1 = f(y)
+        k2 = f(y + dt * k1 / 2)
+        k3 = f(y + dt * k2 / 2)
+        k4 = f(y + dt * k3)
+        return y + dt * (k1 + 2 * k2 + 2 * k3 + k4) / 6
+
+    @staticmethod
+    def _dopri5_step(f, y, dt):
+        """
+        Single step of the Dormand-Prince 5(4) method
+
+        Returns
+        -------
+        * array: fifth-order solution
+        * array: difference between the fifth- and fourth-order solutions
+        """
+        k1 = f(y)
+        k2 = f(y + dt * (k1 / 5))
+        k3 = f(y + dt * (3 * k1 / 40 + 9 * k2 / 40))
+        k4 = f(y + dt * (44 * k1 / 45 - 56 * k2 / 15 + 32 * k3 / 9))
+        k5 = f(y + dt * (19372 * k1 / 6561 - 25360 * k2 / 2187 + 64448 * k3 / 6561 - 212 * k4 / 729))
+        k6 = f(y + dt * (9017 * k1 / 3168 - 355 * k2 / 33 + 46732 * k3 / 5247 + 49 * k4 / 176
+                         - 5103 * k5 / 18656))
+        y_next = y + dt * (35 * k1 / 384 + 500 * k3 / 1113 + 125 * k4 / 192 - 2187 * k5 / 6784 + 11 * k6 / 84)
+        k7 = f(y_next)
+        y_err = dt * (71 * k1 / 57600 - 71 * k3 / 16695 + 71 * k4 / 1920 - 17253 * k5 / 339200
+                      + 22 * k6 / 525 - k7 / 40)
+        return y_next, y_err
+    
+    def sample(self, key, x0, T, nsamples, dt=0.01, noisy=False):
+        """
+        Run the Extended Kalman Filter algorithm. First, we integrate
+        up to time T, then we obtain nsamples equally-spaced points. Finally,
+        we transform the latent space to obtain the observations
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+            Initial seed
+        x0: array(state_size)
+            Initial state of simulation
+        T: float
+            Final time of integration
+        nsamples: int
+            Number of observations to take from the total integration
+        dt: float
+            integration step size
+        noisy: bool
+            Whether to (naively) add noise to the state space
+
+        Returns
+        -------
+        * array(nsamples, state_size)
+            State-space values
+        * array(nsamples, obs_size)
+            Observed-space values
+        * int
+            Number of observations skipped between one
+            datapoint and the next
+        """
+        nsteps = ceil(T / dt)
+        jump_size = ceil(nsteps / nsamples)
+        correction = nsamples - ceil(nsteps / jump_size)
+        nsteps += correction * jump_size
+
+        key_state, key_obs = random.split(key)
+        state_noise = random.multivariate_normal(key_state, jnp.zeros(self.state_size), self.Q, (nsteps,))
+        obs_noise = random.multivariate_normal(key_obs, jnp.zeros(self.obs_size), self.R, (nsteps,)) 
+        simulation = self._rk2(x0, self.fz, nsteps, dt)
+        
+        if noisy:
+            simulation = simulation + jnp.sqrt(dt) * state_noise
+        
+        sample_state = simulation[::jump_size]
+        sample_obs = jnp.apply_along_axis(self.fx, 1, sample_state) + obs_noise[:len(sample_state)]
+        
+        return sample_state, sample_obs, jump_size
+    
+    def _Vt_dot(self, V, G):
+        return G @ V + V @ G.T + self.Q
+
+    def _moments_dot(self, y, unravel):
+        """
+        Joint time-derivative of the (flattened) mean and covariance
+        """
+        mu, V = unravel(y)
+        Gt = self.Dfz(mu)
+        y_dot, _ = ravel_pytree((self.fz(mu), self._Vt_dot(V, Gt)))
+        return y_dot
+
+    def _predict(self, mu_t, Vt, dt_t, jump_size, dt, integrator, rtol, atol):
+        """
+        Integrate the mean and covariance of the state jointly from one
+        observation to the next, i.e., over a time interval jump_size * dt.
+
+        Parameters
+        ----------
+        mu_t: array(state_size)
+        Vt: array(state_size, state_size)
+        dt_t: float
+            Initial step size of the adaptive integrator
+        jump_size: int
+            Number of integration steps between observations. It can be
+            a traced integer for irregularly-sampled observations
+        dt: float
+            Integration step size
+        integrator: str
+            "rk2", "rk4" (fixed step size dt) or "adaptive" (Dormand-Prince 5(4)
+            with error control)
+        rtol, atol: float
+            Relative and absolute tolerances of the adaptive integrator
+
+        Returns
+        -------
+        * array(state_size): predicted mean
+        * array(state_size, state_size): predicted covariance
+        * float: last accepted step size of the adaptive integrator
+        """
+        y, unravel = ravel_pytree((mu_t, Vt))
+        f = partial(self._moments_dot, unravel=unravel)
+
+        if integrator in ("rk2", "rk4"):
+            step = self._rk2_step if integrator == "rk2" else self._rk4_step
+            y = jax.lax.fori_loop(0, jump_size, lambda _, y: step(f, y, dt), y)
+            return (*unravel(y), dt_t)
+        elif integrator != "adaptive":
+            raise ValueError(f"integrator must be 'rk2', 'rk4' or 'adaptive', got {integrator!r}")
+
+        horizon = jump_size * dt
+        # Guard against non-terminating loops (e.g., diverging moments)
+        max_steps = 100 * jnp.maximum(jump_size, 1)
+
+        def not_done(carry):
+            t, _, _, nsteps = carry
+            return (t < horizon) & (nsteps < max_steps)
+
+        def adaptive_step(carry):
+            t, y, h, nsteps = carry
+            h_step = jnp.minimum(h, horizon - t)
+            y_next, y_err = self._dopri5_step(f, y, h_step)
+            scale = atol + rtol * jnp.maximum(jnp.abs(y), jnp.abs(y_next))
+            err = jnp.sqrt(jnp.mean((y_err / scale) ** 2))
+            accept = err <= 1.0
+            # Standard step-size controller for a fifth-order method. If the
+            # step was only shortened to hit the end of the interval, keep h
+            h_new = h_step * jnp.clip(0.9 * err ** (-1 / 5), 0.2, 5.0)
+            h_new = jnp.where(accept & (h_step < h), jnp.maximum(h, h_new), h_new)
+            t = jnp.where(accept, t + h_step, t)
+            y = jnp.where(accept, y_next, y)
+            return t, y, h_new, nsteps + 1
+
+        _, y, dt_t, _ = jax.lax.while_loop(not_done, adaptive_step, (0.0, y, dt_t, 0))
+        return (*unravel(y), dt_t)
+
+    def _estimate_step(self, state, xs, jump_size, dt, integrator, rtol, atol):
+        """
+        Single predict-update step of the continuous-discrete Extended
+        Kalman Filter. Written to be used as the body of jax.lax.scan
+
+        Parameters
+        ----------
+        state: tuple
+            (mu_t, Vt, dt_t) filtered mean, covariance and adaptive step size
+        xs: tuple
+            (xt, mask, obs_dt) observation at time t and (optional) availability
+            of the observation and time elapsed since the last observation
+        """
+        mu_t, Vt, dt_t = state
+        xt, mask, obs_dt = xs
+        if obs_dt is not None:
+            # Integrate over obs_dt with the largest step size not above dt
+            # (the tolerance avoids an extra step from rounding errors)
+            jump_size = jnp.maximum(jnp.ceil(obs_dt / dt - 1e-6), 1).astype(int)
+            dt = obs_dt / jump_size
+        mu_t_cond, Vt_cond, dt_t = self._predict(mu_t, Vt, dt_t, jump_size, dt, integrator, rtol, atol)
+        Ht = self.Dfx(mu_t_cond)
+
+        St = Ht @ Vt_cond @ Ht.T + self.R
+        Kt = jnp.linalg.solve(St, Ht @ Vt_cond).T
+        mu_t = mu_t_cond + Kt @ (xt - self.fx(mu_t_cond))
+        Vt = Vt_cond - Kt @ Ht @ Vt_cond
+        if mask is not None:
+            mu_t = jnp.where(mask, mu_t, mu_t_cond)
+            Vt = jnp.where(mask, Vt, Vt_cond)
+
+        return (mu_t, Vt, dt_t), (mu_t, Vt)
+
+    @partial(jax.jit, static_argnums=(3, 5))
+    def _estimate_scan(self, sample_state, sample_obs, jump_size, dt, integrator, rtol, atol, mask, obs_dt, Vinit):
+        """
+        Compiled version of the continuous-discrete Extended Kalman Filter
+        """
+        Vt = self.Q if Vinit is None else Vinit
+        mu_t = sample_state[0]
+        step = partial(self._estimate_step, jump_size=jump_size, dt=dt,
+                       integrator=integrator, rtol=rtol, atol=atol)
+        sample_obs = jnp.where(mask[:, None], sample_obs, 0.0) if mask is not None else sample_obs
+        mask = mask[1:] if mask is not None else None
+        xs = (sample_obs[1:], mask, obs_dt)
+        _, (mu_hist, V_hist) = jax.lax.scan(step, (mu_t, Vt, dt), xs)
+
+        mu_hist = jnp.concatenate((mu_t[None, :], mu_hist))
+        V_hist = jnp.concatenate((Vt[None, ...], V_hist))
+        return mu_hist, V_hist
+
+    def estimate(self, sample_state, sample_obs, jump_size, dt, integrator="rk2", rtol=1e-6, atol=1e-8,
+                 mask=None, obs_dt=None, Vinit=None):
+        """
+        Run the Extended Kalman Filter algorithm over a set of observed samples.
+
+        Parameters
+        ----------
+        sample_state: array(nsamples, state_size)
+        sample_obs: array(nsamples, obs_size)
+        jump_size: int
+            Number of integration steps between observations
+        dt: float
+            Integration step size. With the adaptive integrator, this
+            is the initial step size
+        integrator: str
+            "rk2" or "rk4" integrate the mean and covariance with a fixed
+            step size dt; "adaptive" uses the Dormand-Prince 5(4) method
+            with error control over each interval of length jump_size * dt
+        rtol, atol: float
+            Relative and absolute tolerances of the adaptive integrator
+        mask: array(nsamples) or None
+            Whether each observation is available. Steps with mask=False
+            (missing observations) only integrate the moments forward.
+            The first observation is not used
+        obs_dt: array(nsamples - 1) or None
+            Time elapsed between consecutive observations (irregularly-sampled
+            observations). Each interval is integrated with
+            ceil(obs_dt / dt) equal steps and replaces jump_size * dt
+        Vinit: array(state_size, state_size) or None
+            Initial covariance. Defaults to Q
+
+        Returns
+        -------
+        * array(nsamples, state_size)
+            History of filtered mean terms
+        * array(nsamples, state_size, state_size)
+            History of filtered covariance terms
+        """
+        return self._estimate_scan(sample_state, sample_obs, jump_size, dt, integrator, rtol, atol, mask, obs_dt,
+                                   Vinit)
+
+
+class UnscentedKalmanFilter(NLDS):
+    """
+    Implementation of the Unscented Kalman Filter for discrete time systems
+    """
+    def __init__(self, fz, fx, Q, R, alpha, beta, kappa, dtype=None, sigma_points="unscented",
+                 vectorize=False):
+        """
+        Parameters
+        ----------
+        fz: function
+            State transition function, evaluated over the
+            matrix of sigma points (state_size, npoints)
+        fx: function
+            Observation function, evaluated over the matrix of sigma points
+        Q: array(state_size, state_size)
+        R: array(obs_size, obs_size)
+        alpha, beta, kappa: float
+            Parameters of the unscented sigma points
+        dtype: jnp.dtype or None
+            If given (e.g. jnp.float32), inputs, noise covariances and
+            filtered moments are cast to dtype, the gain is obtained through
+            a Cholesky solve, the covariance through the Joseph form (with the
+            statistically linearised observation function) and the covariances
+            are symmetrised, which keeps them positive definite in single precision
+        sigma_points: str
+            Set of sigma points:
+            * "unscented": 2 * state_size + 1 points given by alpha, beta, kappa
+            * "cubature": 2 * state_size equally-weighted points
+              (third-degree spherical-radial rule)
+            * "simplex": state_size + 2 equally-weighted points
+              (spherical simplex of Julier, 2003)
+        vectorize: bool
+            If True, fz and fx are functions of a single state
+            (state_size,) and are vmapped over the sigma points
+        """
+        if sigma_points not in ("unscented", "cubature", "simplex"):
+            raise ValueError(f"sigma_points must be 'unscented', 'cubature' or 'simplex', got {sigma_points!r}")
+        super().__init__(fz, fx, Q, R)
+        self.dtype = dtype
+        self.Q, self.R = self._cast((Q, R))
+        self.d, _ = Q.shape
+        self.alpha = alpha
+        self.beta = beta
+        self.kappa = kappa
+        self.sigma_points = sigma_points
+        self.vectorize = vectorize
+        self.lmbda = alpha ** 2 * (self.d + kappa) - self.d
+        # Weights and unit sigma points depend only on the model: built once here
+        self.gamma, self.unit_points, self.wm_vec, self.wc_vec = self._cast(self._sigma_point_set())
+        self.npoints, = self.wm_vec.shape
+
+    @classmethod
+    def from_base(cls, model, alpha, beta, kappa, dtype=None, sigma_points="unscented", vectorize=False):
+        """
+        Initialise class from an instance of the NLDS parent class
+        """
+        return cls(model.fz, model.fx, model.Q, model.R, alpha, beta, kappa, dtype, sigma_points, vectorize)
+    
+    @staticmethod
+    def sqrtm(M):
+        """
+        Compute the matrix square-root of a hermitian
+        matrix M. i,e, R such that RR = M
+        
+        Parameters
+        ----------
+        M: array(m, m)
+            Hermitian matrix
+        
+        Returns
+        -------
+        array(m, m): square-root matrix
+        """
+        evals, evecs = jnp.linalg.eigh(M)
+        R = evecs @ jnp.sqrt(jnp.diag(evals)) @ jnp.linalg.inv(evecs)
+        return R
+    
+    def _sigma_point_set(self):
+        """
+        Scale and weights of the sigma points to compute the mean (wm_vec)
+        and the covariance (wc_vec) of the transformed points. For the
+        symmetric sets ("unscented", "cubature") the points are
+        mu ± gamma * columns of the Cholesky factor (preceded by mu for
+        "unscented"); the "simplex" points are mu + L @ unit_points
+
+        Returns
+        -------
+        * float: gamma (None for "simplex")
+        * array(state_size, state_size + 2) or None: unit_points
+        * array(npoints): wm_vec
+        * array(npoints): wc_vec
+        """
+        d = self.d
+        if self.sigma_points == "unscented":
+            wm_vec = jnp.full(2 * d + 1, 1 / (2 * (d + self.lmbda)))
+            wm_vec = wm_vec.at[0].set(self.lmbda / (d + self.lmbda))
+            wc_vec = wm_vec.at[0].add(1 - self.alpha ** 2 + self.beta)
+            return jnp.sqrt(d + self.lmbda), None, wm_vec, wc_vec
+        elif self.sigma_points == "cubature":
+            wm_vec = jnp.full(2 * d, 1 / (2 * d))
+            return jnp.sqrt(d), None, wm_vec, wm_vec
+
+        # Spherical simplex with equal weights w. Row j (dimension j + 1)
+        # of the points is 0 at the centre, -c_j for the following j + 1 points,
+        # (j + 1) c_j for the next one and zero afterwards
+        w = 1 / (d + 2)
+        j = jnp.arange(1, d + 1)[:, None]
+        i = jnp.arange(d + 2)[None, :]
+        c = 1 / jnp.sqrt(j * (j + 1) * w)
+        unit_points = jnp.where((i >= 1) & (i <= j), -c, jnp.where(i == j + 1, j * c, 0.0))
+        wm_vec = jnp.full(d + 2, w)
+        return None, unit_points, wm_vec, wm_vec
+
+    def _sigma_points(self, mu, L):
+        """
+        Sigma points of a Gaussian with mean mu and covariance L @ L.T
+
+        Parameters
+        ----------
+        mu: array(state_size)
+        L: array(state_size, state_size)
+            Square root of the covariance (L @ L.T), e.g., its lower
+            Cholesky factor
+
+        Returns
+        -------
+        array(state_size, npoints)
+        """
+        if self.unit_points is not None:
+            return mu[:, None] + L @ self.unit_points
+        points = (mu[:, None] + self.gamma * L, mu[:, None] - self.gamma * L)
+        if self.sigma_points == "unscented":
+            points = (mu[:, None], *points)
+        return jnp.concatenate(points, axis=1)
+
+    def _fz_points(self, sigma_points, *dt):
+        """
+        Transition function evaluated over the matrix of sigma points,
+        cast to the dtype of the filter
+        """
+        if self.vectorize:
+            points = jax.vmap(lambda z: self.fz(z, *dt), in_axes=1, out_axes=1)(sigma_points)
+        else:
+            points = self.fz(sigma_points, *dt)
+        return self._cast(points)
+
+    def _fx_points(self, sigma_points, *obs):
+        """
+        Observation function evaluated over the matrix of sigma points,
+        cast to the dtype of the filter
+        """
+        if self.vectorize:
+            points = jax.vmap(lambda z: self.fx(z, *obs), in_axes=1, out_axes=1)(sigma_points)
+        else:
+            points = self.fx(sigma_points, *obs)
+        return self._cast(points)
+
+    def _filter_step(self, state, xs):
+        """
+        Single predict-update step of the Unscented Kalman Filter.
+        Written to be used as the body of jax.lax.scan
+
+        Parameters
+        ----------
+        state: tuple
+            (mu_t, Sigma_t) filtered mean and covariance at t-1
+        xs: tuple
+            (xt, obs, mask, dt) observation at time t and (optional)
+            covariate, availability of the observation and time step
+
+        Returns
+        -------
+        * tuple: (mu_t, Sigma_t) filtered mean and covariance at t
+        * dict: filtered and predicted moments to store in the history
+        """
+        mu_t, Sigma_t = self._cast(state)
+        xt, obs, mask, dt = self._cast(xs)
+        obs = () if obs is None else (obs,)
+        dt = () if dt is None else (dt,)
+        xt = self._mask_obs(mask, xt)
+        wm_vec, wc_vec = self.wm_vec, self.wc_vec
+
+        sigma_points = self._sigma_points(mu_t, jnp.linalg.cholesky(Sigma_t))
+        z_bar = self._fz_points(sigma_points, *dt)
+        self._probe("sigma_points", z_bar)
+        mu_bar = z_bar @ wm_vec
+        Sigma_cross = jnp.einsum("i,ji,ki->jk", wc_vec, sigma_points - mu_t[:, None], z_bar - mu_bar[:, None])
+        Sigma_bar = z_bar - mu_bar[:, None]
+        Sigma_bar = jnp.einsum("i,ji,ki->jk", wc_vec, Sigma_bar, Sigma_bar) + self.Q
+        if self.dtype is not None:
+            Sigma_bar = _symmetrize(Sigma_bar)
+        self._probe("predict", mu_bar, Sigma_bar)
+
+        Sigma_bar_half = jnp.linalg.cholesky(Sigma_bar)
+        sigma_points = self._sigma_points(mu_bar, Sigma_bar_half)
+        x_bar = self._fx_points(sigma_points, *obs)
+        x_hat = x_bar @ wm_vec
+        x_hat_component = x_bar - x_hat[:, None]
+        St = jnp.einsum("i,ji,ki->jk", wc_vec, x_hat_component, x_hat_component) + self.R
+
+        mu_hat_component = sigma_points - mu_bar[:, None]
+        Sigma_bar_y = jnp.einsum("i,ji,ki->jk", wc_vec, mu_hat_component, x_hat_component)
+        if self.dtype is None:
+            # Kt = Sigma_bar_y @ inv(St), with St symmetric
+            Kt = jnp.linalg.solve(St, Sigma_bar_y.T).T
+            Sigma_t = Sigma_bar - Kt @ St @ Kt.T
+            loglik = stats.multivariate_normal.logpdf(xt, x_hat, St)
+        else:
+            # Cholesky solve and Joseph-form update with the statistically
+            # linearised observation matrix Ht = Sigma_bar_y.T @ inv(Sigma_bar).
+            # R_eff adds to R the covariance of the linearisation residuals
+            # (St - Ht Sigma_bar Ht^T without its cancellation) and the first
+            # term is the Gram matrix of (I - Kt Ht) Sigma_bar_half
+            St_half = jnp.linalg.cholesky(_symmetrize(St))
+            Kt = cho_solve((St_half, True), Sigma_bar_y.T).T
+            Ht = cho_solve((Sigma_bar_half, True), Sigma_bar_y).T
+            residuals = x_hat_component - Ht @ mu_hat_component
+            R_eff = jnp.einsum("i,ji,ki->jk", wc_vec, residuals, residuals) + self.R
+            M_half = Sigma_bar_half - Kt @ (Ht @ Sigma_bar_half)
+            Sigma_t = _symmetrize(M_half @ M_half.T + Kt @ R_eff @ Kt.T)
+            loglik = _logpdf_chol(xt, x_hat, St_half)
+        self._probe("gain", Kt)
+        self._probe_innovation(xt - x_hat, St)
+
+        mu_t = mu_bar + Kt @ (xt - x_hat)
+        mu_t, Sigma_t = self._mask_update(mask, (mu_t, Sigma_t), (mu_bar, Sigma_bar))
+        self._probe("update", mu_t, Sigma_t)
+        self._probe_step(mask, mu_t, Sigma_t)
+        loglik = self._mask_update(mask, loglik, 0.0)
+
+        hist = {
+            "mean": mu_t,
+            "cov": Sigma_t,
+            "mean_pred": mu_bar,
+            "cov_pred": Sigma_bar,
+            "cov_cross": Sigma_cross,
+            "loglik": loglik
+        }
+        return self._cast((mu_t, Sigma_t)), hist
+
+    @partial(jax.jit, static_argnums=(7,))
+    def _filter_scan(self, init_state, sample_obs, observations, Vinit, mask=None, dt=None, full_output=False):
+        """
+        Compiled version of the Unscented Kalman Filter. The whole sequence
+        is processed on-device through jax.lax.scan; the function is traced
+        once per input shape.
+        """
+        state_init = self.init(init_state, Vinit)
+        xs = self._cast((sample_obs, observations, mask, dt))
+        _, hist = jax.lax.scan(self._filter_step, state_init, xs)
+        if full_output:
+            return hist
+        return hist["mean"], hist["cov"]
+
+    def _filter_loop(self, init_state, sample_obs, observations=None, Vinit=None):
+        """
+        Python-loop version of the Unscented Kalman Filter. Kept as
+        a reference implementation for the compiled version: it forms
+        the sigma points from the symmetric square root (sqrtm) of the
+        covariances instead of their Cholesky factors. Both are valid
+        square roots, so the two versions agree for linear models.
+        """
+        wm_vec, wc_vec = self.wm_vec, self.wc_vec
+        nsteps, *_ = sample_obs.shape
+        mu_t = init_state
+        Sigma_t = self.Q if Vinit is None else Vinit
+        if observations is None:
+            observations = [()] * nsteps
+        else:
+            observations = [(obs,) for obs in observations]
+
+        mu_hist = jnp.zeros((nsteps, self.d))
+        Sigma_hist = jnp.zeros((nsteps, self.d, self.d))
+
+        mu_hist = mu_hist.at[0].set(mu_t)
+        Sigma_hist = Sigma_hist.at[0].set(Sigma_t)
+
+        for t in range(nsteps):
+            # TO-DO: use jax.scipy.linalg.sqrtm when it gets added to lib
+            sigma_points = self._sigma_points(mu_t, self.sqrtm(Sigma_t))
+            z_bar = self._fz_points(sigma_points)
+            mu_bar = z_bar @ wm_vec
+            Sigma_bar = (z_bar - mu_bar[:, None])
+            Sigma_bar = jnp.einsum("i,ji,ki->jk", wc_vec, Sigma_bar, Sigma_bar) + self.Q
+
+            Sigma_bar_half = self.sqrtm(Sigma_bar)
+            sigma_points = self._sigma_points(mu_bar, Sigma_bar_half)
+            x_bar = self._fx_points(sigma_points, *observations[t])
+            x_hat = x_bar @ wm_vec
+            St = x_bar - x_hat[:, None]
+            St = jnp.einsum("i,ji,ki->jk", wc_vec, St, St) + self.R
+
+            mu_hat_component = sigma_points - mu_bar[:, None]
+            x_hat_component = x_bar - x_hat[:, None]
+            Sigma_bar_y = jnp.einsum("i,ji,ki->jk", wc_vec, mu_hat_component, x_hat_component)
+            Kt = Sigma_bar_y @ jnp.linalg.inv(St)
+
+            mu_t = mu_bar + Kt @ (sample_obs[t] - x_hat)
+            Sigma_t = Sigma_bar - Kt @ St @ Kt.T
+            
+            mu_hist = mu_hist.at[t].set(mu_t)
+            Sigma_hist = Sigma_hist.at[t].set(Sigma_t)
+
+        return mu_hist, Sigma_hist
+
+    def filter(self, init_state, sample_obs, observations=None, Vinit=None, method="scan", full_output=False,
+               mask=None, dt=None):
+        """
+        Run the Unscented Kalman Filter algorithm over a set of observed samples.
+
+        Parameters
+        ----------
+        init_state: array(state_size)
+        sample_obs: array(nsamples, obs_size)
+        observations: array(nsamples, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(state_size, state_size) or None
+            Initial covariance. Defaults to Q
+        method: str
+            "scan" runs the jit-compiled jax.lax.scan version;
+            "loop" runs the (slower) Python-loop reference version, which
+            uses the symmetric square root of the covariances.
+        full_output: bool
+            If True (only with method="scan"), return a dictionary with the
+            filtered moments ("mean", "cov"), the predicted moments
+            ("mean_pred", "cov_pred"), the cross-covariance between
+            consecutive states ("cov_cross"), as required by smooth, and
+            the log-likelihood terms log p(x_t | x_{1:t-1}) ("loglik").
+        mask: array(nsamples) or None
+            Whether each observation is available. Steps with mask=False
+            (missing observations) only perform the prediction step
+        dt: array(nsamples) or None
+            Time elapsed since the previous step, passed as the second
+            argument to fz (irregularly-sampled observations)
+
+        Returns
+        -------
+        * array(nsamples, state_size)
+            History of filtered mean terms
+        * array(nsamples, state_size, state_size)
+            History of filtered covariance terms
+        """
+        if method == "scan":
+            return self._filter_scan(init_state, sample_obs, observations, Vinit, mask, dt, full_output)
+        elif full_output or mask is not None or dt is not None:
+            raise ValueError("full_output, mask and dt are only available with method='scan'")
+        elif method == "loop":
+            return self._filter_loop(init_state, sample_obs, observations, Vinit)
+        else:
+            raise ValueError(f"method must be 'scan' or 'loop', got {method!r}")
+
+
+class SquareRootUnscentedKalmanFilter(UnscentedKalmanFilter):
+    """
+    Square-root implementation of the Unscented Kalman Filter for
+    discrete time systems. Instead of the covariance matrix, we propagate
+    its lower Cholesky factor through QR decompositions (a rank-one
+    Cholesky downdate is only needed when the weight of the central
+    sigma point is negative), which guarantees positive semi-definite
+    covariances.
+    This makes it suitable for single precision: with dtype=jnp.float32
+    the inputs and filtered moments are cast to float32.
+    See: van der Merwe and Wan (2001), "The square-root unscented
+    Kalman filter for state and parameter-estimation"
+    """
+    def __init__(self, fz, fx, Q, R, alpha, beta, kappa, dtype=None, sigma_points="unscented",
+                 vectorize=False):
+        super().__init__(fz, fx, Q, R, alpha, beta, kappa, dtype, sigma_points, vectorize)
+        # A negative weight cannot enter the QR decomposition: the term of the
+        # first sigma point is then removed by a rank-one Cholesky downdate
+        self.negative_w0 = bool(self.wc_vec[0] < 0)
+
+    @property
+    def Q_half(self):
+        """
+        Lower Cholesky factor of the state noise
+        """
+        return jnp.linalg.cholesky(self.Q)
+
+    @property
+    def R_half(self):
+        """
+        Lower Cholesky factor of the observation noise
+        """
+        return jnp.linalg.cholesky(self.R)
+
+    @staticmethod
+    def _cholupdate(L, x, sign):
+        """
+        Rank-one update of a lower Cholesky factor, i.e., compute
+        L_new such that L_new L_new^T = L L^T + sign * x x^T
+
+        Parameters
+        ----------
+        L: array(m, m)
+            Lower-triangular Cholesky factor
+        x: array(m)
+            Update vector
+        sign: float
+            1.0 for an update, -1.0 for a downdate
+
+        Returns
+        -------
+        array(m, m): updated lower Cholesky factor
+        """
+        m, _ = L.shape
+        ix = jnp.arange(m)
+
+        def update_column(k, carry):
+            L, x = carry
+            Lkk, xk = L[k, k], x[k]
+            r = jnp.sqrt(Lkk ** 2 + sign * xk ** 2)
+            c, s = r / Lkk, xk / Lkk
+            below = ix > k
+            col = jnp.where(below, (L[:, k] + sign * s * x) / c, L[:, k])
+            col = col.at[k].set(r)
+            x = jnp.where(below, c * x - s * col, x)
+            L = L.at[:, k].set(col)
+            return L, x
+
+        L, _ = jax.lax.fori_loop(0, m, update_column, (L, x))
+        return L
+
+    def _sqrt_cov(self, deviations, wc_vec, noise_half):
+        """
+        Lower Cholesky factor of the weighted covariance of a set of
+        transformed sigma points plus an additive noise term.
+
+        Parameters
+        ----------
+        deviations: array(m, npoints)
+            Transformed sigma points minus their weighted mean
+        wc_vec: array(npoints)
+        noise_half: array(m, k)
+            Square root of the additive noise, e.g., its lower Cholesky factor
+
+        Returns
+        -------
+        array(m, m): lower Cholesky factor
+        """
+        first = 1 if self.negative_w0 else 0
+        compound = jnp.concatenate((jnp.sqrt(wc_vec[first:]) * deviations[:, first:], noise_half), axis=1)
+        R = jnp.linalg.qr(compound.T, mode="r")
+        # Fix the sign of the columns so that the factor has a positive diagonal
+        S = R.T * jnp.sign(jnp.diag(R))
+        if self.negative_w0:
+            S = self._cholupdate(S, jnp.sqrt(-wc_vec[0]) * deviations[:, 0], -1.0)
+        return S
+
+    def init(self, init_state, Vinit=None):
+        """
+        Initial state of the online (streaming) version of the filter
+
+        Parameters
+        ----------
+        init_state: array(state_size)
+        Vinit: array(state_size, state_size) or None
+            Initial covariance. Defaults to Q
+
+        Returns
+        -------
+        tuple: (init_state, lower Cholesky factor of Vinit)
+        """
+        S_t = self.Q_half if Vinit is None else jnp.linalg.cholesky(Vinit)
+        return self._cast((init_state, S_t))
+
+    def _filter_step(self, state, xs):
+        """
+        Single predict-update step of the square-root Unscented Kalman Filter.
+        Written to be used as the body of jax.lax.scan
+
+        Parameters
+        ----------
+        state: tuple
+            (mu_t, S_t) filtered mean and lower Cholesky factor of the
+            filtered covariance at t-1
+        xs: tuple
+            (xt, obs, mask, dt) observation at time t and (optional)
+            covariate, availability of the observation and time step
+
+        Returns
+        -------
+        * tuple: (mu_t, S_t) filtered mean and Cholesky factor at t
+        * dict: filtered and predicted moments to store in the history
+        """
+        mu_t, S_t = self._cast(state)
+        xt, obs, mask, dt = self._cast(xs)
+        obs = () if obs is None else (obs,)
+        dt = () if dt is None else (dt,)
+        xt = self._mask_obs(mask, xt)
+        wm_vec, wc_vec = self.wm_vec, self.wc_vec
+
+        sigma_points = self._sigma_points(mu_t, S_t)
+        z_bar = self._fz_points(sigma_points, *dt)
+        self._probe("sigma_points", z_bar)
+        mu_bar = z_bar @ wm_vec
+        Sigma_cross = jnp.einsum("i,ji,ki->jk", wc_vec, sigma_points - mu_t[:, None], z_bar - mu_bar[:, None])
+        S_bar = self._sqrt_cov(z_bar - mu_bar[:, None], wc_vec, self.Q_half)
+        self._probe("predict", mu_bar, S_bar)
+
+        sigma_points = self._sigma_points(mu_bar, S_bar)
+        x_bar = self._fx_points(sigma_points, *obs)
+        x_hat = x_bar @ wm_vec
+        x_hat_component = x_bar - x_hat[:, None]
+        mu_hat_component = sigma_points - mu_bar[:, None]
+
+        # Lower Cholesky factor of the joint covariance of (x_t, z_t),
+        # [[St_half, 0], [L_zx, S_t]], from a single QR decomposition:
+        # Sigma_bar_y = L_zx @ St_half.T and S_t @ S_t.T is the filtered covariance
+        obs_size, state_size = len(x_hat), len(mu_bar)
+        deviations = jnp.concatenate((x_hat_component, mu_hat_component), axis=0)
+        noise_half = jnp.concatenate((self.R_half, jnp.zeros((state_size, obs_size), self.R_half.dtype)), axis=0)
+        S_joint = self._sqrt_cov(deviations, wc_vec, noise_half)
+        St_half = S_joint[:obs_size, :obs_size]
+        L_zx = S_joint[obs_size:, :obs_size]
+        S_t = S_joint[obs_size:, obs_size:]
+        # Kt = Sigma_bar_y @ inv(St_half @ St_half.T) = L_zx @ inv(St_half)
+        Kt = solve_triangular(St_half, L_zx.T, lower=True, trans="T").T
+        self._probe("gain", Kt)
+        self._probe_innovation(xt - x_hat, St_half @ St_half.T)
+
+        mu_t = mu_bar + Kt @ (xt - x_hat)
+        mu_t, S_t = self._mask_update(mask, (mu_t, S_t), (mu_bar, S_bar))
+        self._probe("update", mu_t, S_t)
+        self._probe_step(mask, mu_t, S_t @ S_t.T)
+        loglik = self._mask_update(mask, _logpdf_chol(xt, x_hat, St_half), 0.0)
+
+        hist = {
+            "mean": mu_t,
+            "cov": S_t @ S_t.T,
+            "mean_pred": mu_bar,
+            "cov_pred": S_bar @ S_bar.T,
+            "cov_cross": Sigma_cross,
+            "loglik": loglik
+        }
+        return self._cast((mu_t, S_t)), hist
+
+    @partial(jax.jit, static_argnums=(7,))
+    def _filter_scan(self, init_state, sample_obs, observations, Vinit, mask=None, dt=None, full_output=False):
+        """
+        Compiled version of the square-root Unscented Kalman Filter.
+        """
+        state_init = self.init(init_state, Vinit)
+        xs = self._cast((sample_obs, observations, mask, dt))
+        _, hist = jax.lax.scan(self._filter_step, state_init, xs)
+        if full_output:
+            return hist
+        return hist["mean"], hist["cov"]
+
+    def filter(self, init_state, sample_obs, observations=None, Vinit=None, full_output=False, mask=None, dt=None):
+        """
+        Run the square-root Unscented Kalman Filter algorithm over
+        a set of observed samples.
+
+        Parameters
+        ----------
+        init_state: array(state_size)
+        sample_obs: array(nsamples, obs_size)
+        observations: array(nsamples, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(state_size, state_size) or None
+            Initial covariance. Defaults to Q
+        full_output: bool
+            If True, return a dictionary with the filtered and predicted
+            moments, as required by smooth, and the log-likelihood terms
+            log p(x_t | x_{1:t-1}) ("loglik").
+        mask: array(nsamples) or None
+            Whether each observation is available. Steps with mask=False
+            (missing observations) only perform the prediction step
+        dt: array(nsamples) or None
+            Time elapsed since the previous step, passed as the second
+            argument to fz (irregularly-sampled observations)
+
+        Returns
+        -------
+        * array(nsamples, state_size)
+            History of filtered mean terms
+        * array(nsamples, state_size, state_size)
+            History of filtered covariance terms
+        """
+        return self._filter_scan(init_state, sample_obs, observations, Vinit, mask, dt, full_output)
+
+
+class BootstrapFiltering(NLDS):
+    def __init__(self, fz, fx, Q, R, resampling="systematic", ess_threshold=0.5):
+        """
+        Implementation of the Bootrstrap Filter for discrete time systems
+        **This implementation considers the case of multivariate normals**
+
+        Parameters
+        ----------
+        fz: function
+            State transition function (for a single state)
+        fx: function
+            Observation function (for a single state)
+        Q: array(state_size, state_size)
+        R: array(obs_size, obs_size)
+        resampling: str
+            One of "multinomial", "systematic", "stratified" or "residual"
+        ess_threshold: float
+            Particles are resampled whenever the effective sample size
+            falls below ess_threshold * nsamples. Use 1.0 to resample
+            at every step.
+
+        to-do: extend to general case
+        """
+        super().__init__(fz, fx, Q, R)
+        if resampling not in RESAMPLING_SCHEMES:
+            raise ValueError(f"resampling must be one of {list(RESAMPLING_SCHEMES)}, got {resampling!r}")
+        self.resampling = resampling
+        self.resample = RESAMPLING_SCHEMES[resampling]
+        self.ess_threshold = ess_threshold
+
+    @classmethod
+    def from_base(cls, model, resampling="systematic", ess_threshold=0.5):
+        """
+        Initialise class from an instance of the NLDS parent class
+        """
+        return cls(model.fz, model.fx, model.Q, model.R, resampling, ess_threshold)
+    
+    def init(self, key, init_state, nsamples=2000):
+        """
+        Initial state of the online (streaming) version of the filter
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+        init_state: array(state_size,)
+            Initial state estimate
+        nsamples: int
+            Number of particles
+
+        Returns
+        -------
+        tuple: (key, particles, log_weights)
+        """
+        key, key_particles = random.split(key)
+        particles = random.multivariate_normal(key_particles, init_state, self.Q, (nsamples,))
+        log_weights = jnp.zeros(nsamples)
+        return key, particles, log_weights
+
+    def _resample_indices(self, key, log_weights):
+        """
+        Indices of the particles to propagate. Particles are resampled only
+        if their effective sample size is below the threshold; otherwise
+        the resampling step is skipped altogether
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+        log_weights: array(nsamples)
+            Log-unnormalised weights
+
+        Returns
+        -------
+        * array(nsamples): indices of the particles
+        * array(nsamples): log-normalised weights of the selected particles
+        """
+        nsamples = len(log_weights)
+        log_weights = log_weights - jax.nn.logsumexp(log_weights)
+        weights = jnp.exp(log_weights)
+        ess = 1 / (weights ** 2).sum()
+        do_resample = ess < self.ess_threshold * nsamples
+        ix_sampled, log_weights = jax.lax.cond(
+            do_resample,
+            lambda: (self.resample(key, weights), jnp.full_like(log_weights, -log(nsamples))),
+            lambda: (jnp.arange(nsamples), log_weights)
+        )
+        return ix_sampled, log_weights
+
+    def _filter_step(self, state, xs):
+        """
+        Single resample-propagate-weight step of the Bootstrap filter.
+        Particles are resampled according to the weights of the previous
+        step only if their effective sample size is below the threshold.
+
+        Parameters
+        ----------
+        state: tuple
+            (key, particles, log_weights) at t-1
+        xs: tuple
+            (xt, obs, mask, dt) observation at time t and (optional)
+            covariate, availability of the observation and time step
+
+        Returns
+        -------
+        * tuple: (key, particles, log_weights) at time t
+        * dict: weighted mean of the particles ("mean"), effective sample
+          size ("ess") and log p(xt | x_{1:t-1}) estimate ("loglik") at time t
+        """
+        key, particles, log_weights = state
+        xt, obs, mask, dt = xs
+        obs = () if obs is None else (obs,)
+        dt = () if dt is None else (dt,)
+        xt = self._mask_obs(mask, xt)
+        nsamples, _ = particles.shape
+        key, key_resample, key_state = random.split(key, 3)
+
+        # 1. Resample (if required)
+        ix_sampled, log_weights = self._resample_indices(key_resample, log_weights)
+        self._probe("resample", ix_sampled)
+
+        # 2. Propagate
+        particles = jax.vmap(lambda z: self.fz(z, *dt))(particles[ix_sampled])
+        particles = particles + random.multivariate_normal(key_state, jnp.zeros(self.state_size), self.Q, (nsamples,))
+        self._probe("predict", particles)
+
+        # 3. Weight
+        xt_hat = jax.vmap(lambda z: self.fx(z, *obs))(particles)
+        log_lik = stats.multivariate_normal.logpdf(xt, xt_hat, self.R)
+        # Missing observations leave the weights unchanged
+        log_lik = self._mask_update(mask, log_lik, jnp.zeros(nsamples))
+        loglik_t = jax.nn.logsumexp(log_weights + log_lik)
+        log_weights = log_weights + log_lik
+
+        weights = jnp.exp(log_weights - loglik_t)
+        self._probe("update", weights)
+        if self.monitor is not None:
+            # Moments of the predictive distribution of xt and of the filtering distribution
+            weights_pred = jax.nn.softmax(log_weights - log_lik)
+            xt_pred = weights_pred @ xt_hat
+            St = jnp.cov(xt_hat, rowvar=False, aweights=weights_pred).reshape(self.obs_size, self.obs_size) + self.R
+            self._probe_innovation(xt - xt_pred, St)
+            Vt = jnp.cov(particles, rowvar=False, aweights=weights).reshape(self.state_size, self.state_size)
+            self._probe_step(mask, weights @ particles, Vt)
+        hist = {
+            "mean": weights @ particles,
+            "ess": 1 / (weights ** 2).sum(),
+            "loglik": loglik_t
+        }
+        return (key, particles, log_weights), hist
+
+    @partial(jax.jit, static_argnums=(4, 8))
+    def _filter_scan(self, key, init_state, sample_obs, nsamples, observations, mask, dt, full_output):
+        """
+        Compiled version of the Bootstrap filter
+        """
+        state_init = self.init(key, init_state, nsamples)
+        xs = (sample_obs, observations, mask, dt)
+        _, hist = jax.lax.scan(self._filter_step, state_init, xs)
+        if full_output:
+            return hist
+        return hist["mean"]
+
+    def filter(self, key, init_state, sample_obs, nsamples=2000, observations=None, full_output=False,
+               mask=None, dt=None):
+        """
+        Run the (compiled) Bootstrap filter over a set of observed samples.
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+        init_state: array(state_size,)
+            Initial state estimate
+        sample_obs: array(nsteps, obs_size)
+            Samples of the observations
+        nsamples: int
+            Number of particles
+        observations: array(nsteps, ...) or None
+            Covariates passed as the second argument to fx at each step
+        full_output: bool
+            If True, return a dictionary with the weighted means ("mean"),
+            the effective sample size ("ess") and the estimates of
+            log p(x_t | x_{1:t-1}) ("loglik") at every step
+        mask: array(nsteps) or None
+            Whether each observation is available. Missing observations
+            leave the weights unchanged (prediction-only step)
+        dt: array(nsteps) or None
+            Time elapsed since the previous step, passed as the second
+            argument to fz (irregularly-sampled observations)
+
+        Returns
+        -------
+        array(nsteps, state_size)
+            History of weighted means of the particles
+        """
+        return self._filter_scan(key, init_state, sample_obs, nsamples, observations, mask, dt, full_output)
+
+    @partial(jax.jit, static_argnums=(7, 8))
+    def _filter_batch(self, keys, init_state, sample_obs, observations, mask, dt, nsamples, full_output):
+        """
+        Compiled Bootstrap filter vectorised over the leading axis
+        """
+        def filter_scan(key, init_state, sample_obs, observations, mask, dt):
+            return self._filter_scan(key, init_state, sample_obs, nsamples, observations, mask, dt, full_output)
+        return jax.vmap(filter_scan)(keys, init_state, sample_obs, observations, mask, dt)
+
+    def filter_batch(self, key, init_state, sample_obs, nsamples=2000, observations=None, chunk_size=None,
+                     full_output=False, mask=None, dt=None):
+        """
+        Run the compiled Bootstrap filter over a batch of independent
+        sequences in a single vectorised call. Every sequence is filtered
+        with its own key, split from key.
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+        init_state: array(n_sequences, state_size) or array(state_size)
+            Initial state estimate for each sequence
+        sample_obs: array(n_sequences, nsteps, obs_size)
+            Samples of the observations of each sequence
+        nsamples: int
+            Number of particles
+        observations: array(n_sequences, nsteps, ...) or None
+            Covariates passed as the second argument to fx at each step
+        chunk_size: int or None
+            If given, filter chunk_size sequences at a time to bound the peak
+            memory. Every chunk has the same shape, so the filter is only
+            compiled once.
+        full_output: bool
+            If True, return the dictionary of the filter (see filter)
+        mask: array(n_sequences, nsteps) or None
+            Whether each observation is available
+        dt: array(n_sequences, nsteps) or None
+            Time elapsed since the previous step, passed as the
+            second argument to fz
+
+        Returns
+        -------
+        array(n_sequences, nsteps, state_size)
+            History of weighted means of the particles
+        """
+        n_sequences = sample_obs.shape[0]
+        keys = random.split(key, n_sequences)
+        init_state = jnp.broadcast_to(init_state, (n_sequences, self.state_size))
+        batch = (keys, init_state, sample_obs, observations, mask, dt)
+        def filter_batch(*chunk): return self._filter_batch(*chunk, nsamples, full_output)
+        return _map_chunks(filter_batch, batch, n_sequences, chunk_size)
+
+    def log_likelihood(self, key, init_state, sample_obs, nsamples=2000, observations=None, mask=None, dt=None):
+        """
+        Particle estimate of the total log-likelihood log p(x_{1:T}):
+        the sum of the estimates of log p(x_t | x_{1:t-1}) of the filter
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+        init_state: array(state_size,)
+            Initial state estimate
+        sample_obs: array(nsteps, obs_size)
+            Samples of the observations
+        nsamples: int
+            Number of particles
+        observations: array(nsteps, ...) or None
+            Covariates passed as the second argument to fx at each step
+        mask: array(nsteps) or None
+            Whether each observation is available
+        dt: array(nsteps) or None
+            Time elapsed since the previous step, passed as the
+            second argument to fz
+
+        Returns
+        -------
+        float: estimate of the log-likelihood of the observations
+        """
+        hist = self._filter_scan(key, init_state, sample_obs, nsamples, observations, mask, dt, True)
+        return hist["loglik"].sum()
+
+    def fit_noise(self, *args, **kwargs):
+        """
+        Not available: the log-likelihood of the filter is a random
+        estimate that depends on the key and is not differentiable through
+        the resampling step, so it cannot be maximised by gradient ascent
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support fit_noise: its log-likelihood "
+                                  "is a random estimate that depends on the key")
+
+    def smooth(self, filter_hist):
+        """
+        Not available: the filter does not store the predicted moments
+        and cross-covariances used by the Rauch-Tung-Striebel smoother
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not store the predicted moments "
+                                  "needed by smooth")
+
+
+class RaoBlackwellParticleFilter(BootstrapFiltering):
+    def __init__(self, fz, fx, Q, R, linear_size, resampling="systematic", ess_threshold=0.5):
+        """
+        Implementation of the Rao-Blackwellised particle filter for
+        conditionally linear-Gaussian (mixed linear/nonlinear) models.
+        The state is split as z = (zn, zl), where zl are the last linear_size
+        entries of the state. Both fz and fx must be affine in zl given zn:
+            fz(zn, zl) = bz(zn) + Az(zn) @ zl
+            fx(zn, zl) = bx(zn) + Ax(zn) @ zl
+        The nonlinear block zn is sampled with particles, while each particle
+        carries a Kalman filter for the linear block zl. The affine terms
+        are obtained exactly through jax.jacfwd with respect to zl.
+        See: Schön, Gustafsson and Nordlund (2005), "Marginalized particle
+        filters for mixed linear/nonlinear state-space models"
+
+        Parameters
+        ----------
+        fz: function
+            State transition function (for a single state)
+        fx: function
+            Observation function (for a single state)
+        Q: array(state_size, state_size)
+            State noise. The nonlinear block must be positive definite
+        R: array(obs_size, obs_size)
+        linear_size: int
+            Number of conditionally linear entries (at the end of the state)
+        resampling: str
+            One of "multinomial", "systematic", "stratified" or "residual"
+        ess_threshold: float
+            Particles are resampled whenever the effective sample size
+            falls below ess_threshold * nsamples
+        """
+        super().__init__(fz, fx, Q, R, resampling, ess_threshold)
+        self.linear_size = linear_size
+        self.nonlinear_size = self.state_size - linear_size
+
+    @classmethod
+    def from_base(cls, model, linear_size, resampling="systematic", ess_threshold=0.5):
+        """
+        Initialise class from an instance of the NLDS parent class
+        """
+        return cls(model.fz, model.fx, model.Q, model.R, linear_size, resampling, ess_threshold)
+
+    def _condition_linear(self, zn, mu, Sigma):
+        """
+        Condition a joint Gaussian over (zn, zl) with moments (mu, Sigma)
+        on the value of the nonlinear block zn
+
+        Returns
+        -------
+        * array(linear_size): conditional mean of zl
+        * array(linear_size, linear_size): conditional covariance of zl
+        """
+        nn = self.nonlinear_size
+        S_nn, S_nl, S_ll = Sigma[:nn, :nn], Sigma[:nn, nn:], Sigma[nn:, nn:]
+        # Gt = S_ln @ inv(S_nn)
+        Gt = jnp.linalg.solve(S_nn, S_nl).T
+        m = mu[nn:] + Gt @ (zn - mu[:nn])
+        P = S_ll - Gt @ S_nl
+        return m, P
+
+    def _affine(self, f, zn, *args):
+        """
+        Affine decomposition f(zn, zl) = b + A @ zl of a function
+        of the state that is linear in the linear block zl
+        """
+        def f_linear(zl): return f(jnp.concatenate((zn, zl)), *args)
+        zl = jnp.zeros(self.linear_size)
+        return f_linear(zl), jax.jacfwd(f_linear)(zl)
+
+    def init(self, key, init_state, nsamples=2000, Vinit=None):
+        """
+        Initial state of the online (streaming) version of the filter
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+        init_state: array(state_size,)
+            Initial state estimate
+        nsamples: int
+            Number of particles
+        Vinit: array(state_size, state_size) or None
+            Initial covariance. Defaults to Q
+
+        Returns
+        -------
+        tuple: (key, zn particles, zl means, zl covariances, log_weights)
+        """
+        Vinit = self.Q if Vinit is None else Vinit
+        nn = self.nonlinear_size
+        key, key_particles = random.split(key)
+        zn = random.multivariate_normal(key_particles, init_state[:nn], Vinit[:nn, :nn], (nsamples,))
+        m, P = jax.vmap(self._condition_linear, (0, None, None))(zn, init_state, Vinit)
+        log_weights = jnp.zeros(nsamples)
+        return key, zn, m, P, log_weights
+
+    def _particle_predict(self, key, zn, m, P, dt):
+        """
+        Prediction step of a single particle: propagate the joint
+        (zn, zl), sample the nonlinear block and condition the linear
+        block on it
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+        zn: array(nonlinear_size)
+            Nonlinear block of the particle at t-1
+        m: array(linear_size)
+            Mean of the linear block at t-1
+        P: array(linear_size, linear_size)
+            Covariance of the linear block at t-1
+        dt: tuple
+            (Optional) time elapsed since the previous step
+
+        Returns
+        -------
+        * array(nonlinear_size): nonlinear block at t
+        * array(linear_size): predicted mean of the linear block at t
+        * array(linear_size, linear_size): predicted covariance of the linear block at t
+        """
+        bz, Az = self._affine(self.fz, zn, *dt)
+        mu = bz + Az @ m
+        Sigma = Az @ P @ Az.T + self.Q
+        zn = random.multivariate_normal(key, mu[:self.nonlinear_size],
+                                        Sigma[:self.nonlinear_size, :self.nonlinear_size])
+        m, P = self._condition_linear(zn, mu, Sigma)
+        return zn, m, P
+
+    def _particle_update(self, zn, m, P, xt, obs, mask):
+        """
+        Weight and Kalman update of the linear block of a single particle
+
+        Parameters
+        ----------
+        zn: array(nonlinear_size)
+            Nonlinear block of the particle at t
+        m: array(linear_size)
+            Predicted mean of the linear block at t
+        P: array(linear_size, linear_size)
+            Predicted covariance of the linear block at t
+        xt: array(obs_size)
+            Observation at time t
+        obs: tuple
+            (Optional) covariate at time t
+        mask: bool or None
+            (Optional) availability of the observation
+
+        Returns
+        -------
+        * array(linear_size): filtered mean of the linear block at t
+        * array(linear_size, linear_size): filtered covariance of the linear block at t
+        * float: log p(xt | zn_{0:t}, x_{1:t-1})
+        * array(obs_size): predicted observation
+        * array(obs_size, obs_size): covariance of the predicted observation
+        """
+        bx, Ax = self._affine(self.fx, zn, *obs)
+        xt_hat = bx + Ax @ m
+        St = Ax @ P @ Ax.T + self.R
+        log_lik = stats.multivariate_normal.logpdf(xt, xt_hat, St)
+        Kt = jnp.linalg.solve(St, Ax @ P).T
+        m_t = m + Kt @ (xt - xt_hat)
+        P_t = P - Kt @ Ax @ P
+        m_t, P_t = self._mask_update(mask, (m_t, P_t), (m, P))
+        log_lik = self._mask_update(mask, log_lik, 0.0)
+        return m_t, P_t, log_lik, xt_hat, St
+
+    def _filter_step(self, state, xs):
+        """
+        Single resample-propagate-weight step of the Rao-Blackwellised
+        particle filter. Kalman updates are vectorised over particles
+
+        Parameters
+        ----------
+        state: tuple
+            (key, zn particles, zl means, zl covariances, log_weights) at t-1
+        xs: tuple
+            (xt, obs, mask, dt) observation at time t and (optional)
+            covariate, availability of the observation and time step
+
+        Returns
+        -------
+        * tuple: (key, zn particles, zl means, zl covariances, log_weights) at time t
+        * dict: weighted mean of the state ("mean"), effective sample
+          size ("ess") and log p(xt | x_{1:t-1}) estimate ("loglik") at time t
+        """
+        key, zn, m, P, log_weights = state
+        xt, obs, mask, dt = xs
+        obs = () if obs is None else (obs,)
+        dt = () if dt is None else (dt,)
+        xt = self._mask_obs(mask, xt)
+        nsamples, _ = zn.shape
+        key, key_resample, key_particles = random.split(key, 3)
+
+        # 1. Resample (if required)
+        ix_sampled, log_weights = self._resample_indices(key_resample, log_weights)
+        zn, m, P = zn[ix_sampled], m[ix_sampled], P[ix_sampled]
+        self._probe("resample", ix_sampled)
+
+        # 2. Predict the joint (zn, zl) and sample the nonlinear block
+        keys = random.split(key_particles, nsamples)
+        zn, m, P = jax.vmap(lambda key, zn, m, P: self._particle_predict(key, zn, m, P, dt))(keys, zn, m, P)
+        self._probe("predict", zn, m, P)
+
+        # 3. Weight and update the linear block with the observation
+        particle_update = lambda zn, m, P: self._particle_update(zn, m, P, xt, obs, mask)
+        m, P, log_lik, xt_hat, St = jax.vmap(particle_update)(zn, m, P)
+        loglik_t = jax.nn.logsumexp(log_weights + log_lik)
+        log_weights = log_weights + log_lik
+
+        weights = jnp.exp(log_weights - loglik_t)
+        mean = weights @ jnp.concatenate((zn, m), axis=1)
+        self._probe("update", weights, m, P)
+        if self.monitor is not None:
+            # Moments of the (Gaussian-mixture) predictive distribution of xt
+            # and of the filtering distribution
+            weights_pred = jax.nn.softmax(log_weights - log_lik)
+            xt_pred = weights_pred @ xt_hat
+            St_pred = jnp.einsum("i,ijk->jk", weights_pred, St)
+            St_pred = St_pred + jnp.cov(xt_hat, rowvar=False, aweights=weights_pred).reshape(self.obs_size,
+                                                                                             self.obs_size)
+            self._probe_innovation(xt - xt_pred, St_pred)
+            Vt = jnp.cov(jnp.concatenate((zn, m), axis=1), rowvar=False, aweights=weights)
+            Vt = Vt.reshape(self.state_size, self.state_size)
+            Vt = Vt.at[self.nonlinear_size:, self.nonlinear_size:].add(jnp.einsum("i,ijk->jk", weights, P))
+            self._probe_step(mask, mean, Vt)
+        hist = {
+            "mean": mean,
+            "ess": 1 / (weights ** 2).sum(),
+            "loglik": loglik_t
+        }
+        return (key, zn, m, P, log_weights), hist
+
+    @partial(jax.jit, static_argnums=(4, 9))
+    def _filter_scan(self, key, init_state, sample_obs, nsamples, observations, Vinit, mask, dt, full_output):
+        """
+        Compiled version of the Rao-Blackwellised particle filter
+        """
+        state_init = self.init(key, init_state, nsamples, Vinit)
+        xs = (sample_obs, observations, mask, dt)
+        _, hist = jax.lax.scan(self._filter_step, state_init, xs)
+        if full_output:
+            return hist
+        return hist["mean"]
+
+    def filter(self, key, init_state, sample_obs, nsamples=2000, observations=None, Vinit=None,
+               full_output=False, mask=None, dt=None):
+        """
+        Run the (compiled) Rao-Blackwellised particle filter over a set
+        of observed samples.
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+        init_state: array(state_size,)
+            Initial state estimate
+        sample_obs: array(nsteps, obs_size)
+            Samples of the observations
+        nsamples: int
+            Number of particles
+        observations: array(nsteps, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(state_size, state_size) or None
+            Initial covariance. Defaults to Q
+        full_output: bool
+            If True, return a dictionary with the weighted means ("mean"),
+            the effective sample size ("ess") and the estimates of
+            log p(x_t | x_{1:t-1}) ("loglik") at every step
+        mask: array(nsteps) or None
+            Whether each observation is available. Missing observations
+            leave the weights unchanged (prediction-only step)
+        dt: array(nsteps) or None
+            Time elapsed since the previous step, passed as the second
+            argument to fz (irregularly-sampled observations)
+
+        Returns
+        -------
+        array(nsteps, state_size)
+            History of weighted means of the state
+        """
+        return self._filter_scan(key, init_state, sample_obs, nsamples, observations, Vinit, mask, dt, full_output)
+
+    @partial(jax.jit, static_argnums=(8, 9))
+    def _filter_batch(self, keys, init_state, sample_obs, observations, mask, dt, Vinit, nsamples, full_output):
+        """
+        Compiled Rao-Blackwellised particle filter vectorised over the leading axis
+        """
+        def filter_scan(key, init_state, sample_obs, observations, mask, dt):
+            return self._filter_scan(key, init_state, sample_obs, nsamples, observations, Vinit, mask, dt, full_output)
+        return jax.vmap(filter_scan)(keys, init_state, sample_obs, observations, mask, dt)
+
+    def filter_batch(self, key, init_state, sample_obs, nsamples=2000, observations=None, Vinit=None,
+                     chunk_size=None, full_output=False, mask=None, dt=None):
+        """
+        Run the compiled Rao-Blackwellised particle filter over a batch of independent
+        sequences in a single vectorised call. Every sequence is filtered
+        with its own key, split from key.
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+        init_state: array(n_sequences, state_size) or array(state_size)
+            Initial state estimate for each sequence
+        sample_obs: array(n_sequences, nsteps, obs_size)
+            Samples of the observations of each sequence
+        nsamples: int
+            Number of particles
+        observations: array(n_sequences, nsteps, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(state_size, state_size) or None
+            Initial covariance, shared by every sequence. Defaults to Q
+        chunk_size: int or None
+            If given, filter chunk_size sequences at a time to bound the peak
+            memory. Every chunk has the same shape, so the filter is only
+            compiled once.
+        full_output: bool
+            If True, return the dictionary of the filter (see filter)
+        mask: array(n_sequences, nsteps) or None
+            Whether each observation is available
+        dt: array(n_sequences, nsteps) or None
+            Time elapsed since the previous step, passed as the
+            second argument to fz
+
+        Returns
+        -------
+        array(n_sequences, nsteps, state_size)
+            History of weighted means of the state
+        """
+        n_sequences = sample_obs.shape[0]
+        keys = random.split(key, n_sequences)
+        init_state = jnp.broadcast_to(init_state, (n_sequences, self.state_size))
+        batch = (keys, init_state, sample_obs, observations, mask, dt)
+        def filter_batch(*chunk): return self._filter_batch(*chunk, Vinit, nsamples, full_output)
+        return _map_chunks(filter_batch, batch, n_sequences, chunk_size)
+
+    def log_likelihood(self, key, init_state, sample_obs, nsamples=2000, observations=None, Vinit=None,
+                       mask=None, dt=None):
+        """
+        Particle estimate of the total log-likelihood log p(x_{1:T}):
+        the sum of the estimates of log p(x_t | x_{1:t-1}) of the filter
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+        init_state: array(state_size,)
+            Initial state estimate
+        sample_obs: array(nsteps, obs_size)
+            Samples of the observations
+        nsamples: int
+            Number of particles
+        observations: array(nsteps, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(state_size, state_size) or None
+            Initial covariance. Defaults to Q
+        mask: array(nsteps) or None
+            Whether each observation is available
+        dt: array(nsteps) or None
+            Time elapsed since the previous step, passed as the
+            second argument to fz
+
+        Returns
+        -------
+        float: estimate of the log-likelihood of the observations
+        """
+        hist = self._filter_scan(key, init_state, sample_obs, nsamples, observations, Vinit, mask, dt, True)
+        return hist["loglik"].sum()
+
+
+class EnsembleKalmanFilter(NLDS):
+    """
+    Implementation of the Ensemble Kalman Filter. The filtering distribution
+    is represented by an ensemble of states propagated through fz (vectorised
+    with jax.vmap); the update uses the ensemble covariances, so memory
+    and cost are linear in the state size and dense state covariances
+    are never formed. Two variants are available:
+    * "stochastic": each member is updated with a perturbed observation.
+      See: Burgers, van Leeuwen and Evensen (1998), "Analysis scheme
+      in the ensemble Kalman filter"
+    * "etkf": deterministic square-root update in the space of the ensemble
+      (Ensemble Transform Kalman Filter). See: Hunt, Kostelich and Szunyogh
+      (2007), "Efficient data assimilation for spatiotemporal chaos:
+      A local ensemble transform Kalman filter"
+    Covariance localisation tapers the state-observation and observation
+    covariances ("stochastic") or the inverse observation noise of each
+    state entry ("etkf", local ETKF; R must be diagonal)
+    """
+    def __init__(self, fz, fx, Q, R, variant="stochastic", localization=None, inflation=1.0):
+        """
+        Parameters
+        ----------
+        fz: function
+            State transition function (for a single state)
+        fx: function
+            Observation function (for a single state)
+        Q: array(state_size,) or array(state_size, state_size)
+            State noise, or its diagonal
+        R: array(obs_size, obs_size)
+        variant: str
+            "stochastic" or "etkf"
+        localization: array(state_size, obs_size) or tuple or None
+            Taper between every entry of the state and every observation,
+            e.g. EnsembleKalmanFilter.gaspari_cohn(distance, radius).
+            For the stochastic variant, a tuple (state-observation taper,
+            array(obs_size, obs_size) observation-observation taper) also
+            localises the covariance of the predicted observations
+        inflation: float
+            Multiplicative inflation of the forecast anomalies
+        """
+        if variant not in ("stochastic", "etkf"):
+            raise ValueError(f"variant must be 'stochastic' or 'etkf', got {variant!r}")
+        self.fz = fz
+        self.fx = fx
+        self.Q = Q
+        self.R = R
+        self.state_size = Q.shape[0]
+        self.obs_size, _ = R.shape
+        self.variant = variant
+        self.localization, self.obs_localization = (localization if isinstance(localization, tuple)
+                                                    else (localization, None))
+        self.inflation = inflation
+        if variant == "etkf" and self.localization is not None:
+            # Observations within the support of the taper of every entry of the state
+            nlocal = int((np.asarray(self.localization) > 0).sum(axis=1).max())
+            self.local_obs = jnp.argsort(-self.localization, axis=1)[:, :nlocal]
+
+    @classmethod
+    def from_base(cls, model, variant="stochastic", localization=None, inflation=1.0):
+        """
+        Initialise class from an instance of the NLDS parent class
+        """
+        return cls(model.fz, model.fx, model.Q, model.R, variant, localization, inflation)
+
+    @property
+    def Q_half(self):
+        """
+        Lower Cholesky factor (or square root of the diagonal) of the state noise
+        """
+        return self._cov_half(self.Q)
+
+    @property
+    def R_half(self):
+        """
+        Lower Cholesky factor of the observation noise
+        """
+        return jnp.linalg.cholesky(self.R)
+
+    @staticmethod
+    def gaspari_cohn(distance, radius):
+        """
+        Compactly-supported fifth-order taper of Gaspari and Cohn (1999).
+        It equals one at distance zero and vanishes beyond 2 * radius
+
+        Parameters
+        ----------
+        distance: array
+            Distances between the entries of the state and the observations
+        radius: float
+            Half-width of the support of the taper
+        """
+        r = jnp.abs(distance) / radius
+        # The second branch is evaluated at r >= 1 to avoid the division by zero
+        r_outer = jnp.maximum(r, 1.0)
+        inner = -r ** 5 / 4 + r ** 4 / 2 + 5 * r ** 3 / 8 - 5 * r ** 2 / 3 + 1
+        outer = (r_outer ** 5 / 12 - r_outer ** 4 / 2 + 5 * r_outer ** 3 / 8 + 5 * r_outer ** 2 / 3
+                 - 5 * r_outer + 4 - 2 / (3 * r_outer))
+        return jnp.where(r <= 1, inner, jnp.where(r < 2, outer, 0.0))
+
+    @staticmethod
+    def _cov_half(cov):
+        """
+        Lower Cholesky factor of a covariance matrix, or
+        square root of a diagonal covariance
+        """
+        return jnp.sqrt(cov) if cov.ndim == 1 else jnp.linalg.cholesky(cov)
+
+    @staticmethod
+    def _sample_noise(key, cov_half, nsamples):
+        """
+        Zero-mean Gaussian noise given the output of _cov_half
+
+        Returns
+        -------
+        array(nsamples, size)
+        """
+        noise = random.normal(key, (nsamples, cov_half.shape[0]))
+        return cov_half * noise if cov_half.ndim == 1 else noise @ cov_half.T
+
+    def _innovation_solve(self, obs_anomalies, M):
+        """
+        Solve St @ X = M, with St = obs_anomalies.T @ obs_anomalies / (nensemble - 1) + R
+        the covariance of the predicted observations. When the ensemble is
+        smaller than the observation, the solve is carried out in the space
+        of the ensemble through the Woodbury identity
+
+        Returns
+        -------
+        * array(obs_size, ...): solution X
+        * float: log-determinant of St
+        """
+        nensemble, obs_size = obs_anomalies.shape
+        if nensemble >= obs_size:
+            St_half = jnp.linalg.cholesky(obs_anomalies.T @ obs_anomalies / (nensemble - 1) + self.R)
+            return cho_solve((St_half, True), M), 2 * jnp.log(jnp.diag(St_half)).sum()
+
+        R_inv_M = cho_solve((self.R_half, True), M)
+        R_inv_Y = cho_solve((self.R_half, True), obs_anomalies.T)
+        inner_half = jnp.linalg.cholesky((nensemble - 1) * jnp.eye(nensemble) + obs_anomalies @ R_inv_Y)
+        X = R_inv_M - R_inv_Y @ cho_solve((inner_half, True), obs_anomalies @ R_inv_M)
+        logdet = (2 * jnp.log(jnp.diag(self.R_half)).sum() + 2 * jnp.log(jnp.diag(inner_half)).sum()
+                  - nensemble * jnp.log(nensemble - 1))
+        return X, logdet
+
+    def init(self, key, init_state, nensemble=100, Vinit=None):
+        """
+        Initial state of the online (streaming) version of the filter
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+        init_state: array(state_size,)
+            Initial state estimate
+        nensemble: int
+            Number of members of the ensemble
+        Vinit: array(state_size,) or array(state_size, state_size) or None
+            Initial covariance, or its diagonal. Defaults to Q
+
+        Returns
+        -------
+        tuple: (key, ensemble)
+        """
+        V_half = self.Q_half if Vinit is None else self._cov_half(Vinit)
+        key, key_ensemble = random.split(key)
+        ensemble = init_state + self._sample_noise(key_ensemble, V_half, nensemble)
+        return key, ensemble
+
+    def _update_stochastic(self, key, ensemble, anomalies, xt_hat, obs_anomalies, xt):
+        """
+        Update of the ensemble with perturbed observations. The gain is
+        K = (rho_xy * P_xy) @ inv(rho_yy * P_yy + R), with rho_xy and
+        rho_yy the localisation tapers. Without localisation the gain is
+        never formed, and the (obs_size, obs_size) covariance of the
+        predicted observations is only formed when the ensemble is at least
+        as large as the observation (see _innovation_solve)
+        """
+        nensemble, _ = ensemble.shape
+        obs_perturbed = xt + self._sample_noise(key, self.R_half, nensemble)
+        innovations = obs_perturbed - xt_hat
+        if self.obs_localization is None:
+            St_inv_innovations, _ = self._innovation_solve(obs_anomalies, innovations.T)
+        else:
+            P_yy = obs_anomalies.T @ obs_anomalies / (nensemble - 1)
+            St_half = jnp.linalg.cholesky(self.obs_localization * P_yy + self.R)
+            St_inv_innovations = cho_solve((St_half, True), innovations.T)
+
+        # (K @ innovation.T).T = innovation @ inv(St) @ P_xy.T
+        if self.localization is None:
+            weights = St_inv_innovations.T @ obs_anomalies.T / (nensemble - 1)
+            return ensemble + weights @ anomalies
+        P_xy = self.localization * (anomalies.T @ obs_anomalies) / (nensemble - 1)
+        return ensemble + St_inv_innovations.T @ P_xy.T
+
+    @staticmethod
+    def _transform(obs_anomalies, C, innovation):
+        """
+        Weights of the ETKF in the space of the ensemble: the mean update
+        w_mean and the square-root transform W, so that the updated ensemble
+        is mean + (w_mean + W) @ anomalies
+
+        Parameters
+        ----------
+        obs_anomalies: array(nensemble, obs_size)
+        C: array(nensemble, obs_size)
+            obs_anomalies @ inv(R), with R the (localised) observation noise
+        innovation: array(obs_size)
+        """
+        nensemble, _ = obs_anomalies.shape
+        evals, evecs = jnp.linalg.eigh((nensemble - 1) * jnp.eye(nensemble) + C @ obs_anomalies.T)
+        P_ens = (evecs / evals) @ evecs.T
+        w_mean = P_ens @ (C @ innovation)
+        W = (evecs * jnp.sqrt((nensemble - 1) / evals)) @ evecs.T
+        return w_mean, W
+
+    def _update_etkf(self, mean, anomalies, xt_hat, obs_anomalies, xt):
+        """
+        Deterministic square-root update. With localisation, every entry
+        of the state is updated with its own transform, obtained from the
+        observations within the support of its row of the localisation
+        and their noise precision tapered by it
+        """
+        innovation = xt - xt_hat.mean(axis=0)
+        if self.localization is None:
+            C = cho_solve((self.R_half, True), obs_anomalies.T).T
+            w_mean, W = self._transform(obs_anomalies, C, innovation)
+            return mean + (w_mean[None, :] + W) @ anomalies
+
+        R_inv_diag = 1 / jnp.diag(self.R)
+
+        def update_entry(mean_i, anomalies_i, taper_i, local_obs_i):
+            obs_anomalies_i = obs_anomalies[:, local_obs_i]
+            C = obs_anomalies_i * (taper_i[local_obs_i] * R_inv_diag[local_obs_i])
+            w_mean, W = self._transform(obs_anomalies_i, C, innovation[local_obs_i])
+            return mean_i + (w_mean[None, :] + W) @ anomalies_i
+
+        return jax.vmap(update_entry, (0, 1, 0, 0), 1)(mean, anomalies, self.localization, self.local_obs)
+
+    def _filter_step(self, state, xs):
+        """
+        Single forecast-update step of the Ensemble Kalman Filter.
+        Written to be used as the body of jax.lax.scan
+
+        Parameters
+        ----------
+        state: tuple
+            (key, ensemble) at t-1
+        xs: tuple
+            (xt, obs, mask, dt) observation at time t and (optional)
+            covariate, availability of the observation and time step
+
+        Returns
+        -------
+        * tuple: (key, ensemble) at time t
+        * dict: ensemble mean ("mean") and standard deviation ("std") and
+          log p(xt | x_{1:t-1}) under the Gaussian approximation ("loglik")
+        """
+        key, ensemble = state
+        xt, obs, mask, dt = xs
+        obs = () if obs is None else (obs,)
+        dt = () if dt is None else (dt,)
+        xt = self._mask_obs(mask, xt)
+        nensemble, _ = ensemble.shape
+        key, key_state, key_obs = random.split(key, 3)
+
+        # 1. Forecast
+        ensemble = jax.vmap(lambda z: self.fz(z, *dt))(ensemble)
+        ensemble = ensemble + self._sample_noise(key_state, self.Q_half, nensemble)
+        mean_pred = ensemble.mean(axis=0)
+        anomalies = self.inflation * (ensemble - mean_pred)
+        ensemble_pred = mean_pred + anomalies
+
+        # 2. Update
+        xt_hat = jax.vmap(lambda z: self.fx(z, *obs))(ensemble_pred)
+        obs_anomalies = xt_hat - xt_hat.mean(axis=0)
+        if self.variant == "stochastic":
+            ensemble = self._update_stochastic(key_obs, ensemble_pred, anomalies, xt_hat, obs_anomalies, xt)
+        else:
+            ensemble = self._update_etkf(mean_pred, anomalies, xt_hat, obs_anomalies, xt)
+        ensemble = self._mask_update(mask, ensemble, ensemble_pred)
+
+        innovation = xt - xt_hat.mean(axis=0)
+        St_inv_innovation, logdet = self._innovation_solve(obs_anomalies, innovation)
+        loglik = -0.5 * (innovation @ St_inv_innovation + logdet + self.obs_size * log(2 * pi))
+        loglik = self._mask_update(mask, loglik, 0.0)
+        hist = {
+            "mean": ensemble.mean(axis=0),
+            "std": ensemble.std(axis=0, ddof=1),
+            "loglik": loglik
+        }
+        return (key, ensemble), hist
+
+    @partial(jax.jit, static_argnums=(4, 9))
+    def _filter_scan(self, key, init_state, sample_obs, nensemble, observations, Vinit, mask, dt, full_output):
+        """
+        Compiled version of the Ensemble Kalman Filter
+        """
+        state_init = self.init(key, init_state, nensemble, Vinit)
+        xs = (sample_obs, observations, mask, dt)
+        _, hist = jax.lax.scan(self._filter_step, state_init, xs)
+        if full_output:
+            return hist
+        return hist["mean"]
+
+    def filter(self, key, init_state, sample_obs, nensemble=100, observations=None, Vinit=None,
+               full_output=False, mask=None, dt=None):
+        """
+        Run the (compiled) Ensemble Kalman Filter over a set of observed samples.
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+        init_state: array(state_size,)
+            Initial state estimate
+        sample_obs: array(nsteps, obs_size)
+            Samples of the observations
+        nensemble: int
+            Number of members of the ensemble
+        observations: array(nsteps, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(state_size,) or array(state_size, state_size) or None
+            Initial covariance, or its diagonal. Defaults to Q
+        full_output: bool
+            If True, return a dictionary with the ensemble means ("mean"),
+            standard deviations ("std") and the log-likelihood terms
+            log p(x_t | x_{1:t-1}) under the Gaussian approximation
+            ("loglik") at every step
+        mask: array(nsteps) or None
+            Whether each observation is available. Steps with mask=False
+            (missing observations) only perform the forecast step
+        dt: array(nsteps) or None
+            Time elapsed since the previous step, passed as the second
+            argument to fz (irregularly-sampled observations)
+
+        Returns
+        -------
+        array(nsteps, state_size)
+            History of ensemble means
+        """
+        return self._filter_scan(key, init_state, sample_obs, nensemble, observations, Vinit, mask, dt, full_output)
+
+    @partial(jax.jit, static_argnums=(8, 9))
+    def _filter_batch(self, keys, init_state, sample_obs, observations, mask, dt, Vinit, nensemble, full_output):
+        """
+        Compiled Ensemble Kalman Filter vectorised over the leading axis
+        """
+        def filter_scan(key, init_state, sample_obs, observations, mask, dt):
+            return self._filter_scan(key, init_state, sample_obs, nensemble, observations, Vinit, mask, dt, full_output)
+        return jax.vmap(filter_scan)(keys, init_state, sample_obs, observations, mask, dt)
+
+    def filter_batch(self, key, init_state, sample_obs, nensemble=100, observations=None, Vinit=None,
+                     chunk_size=None, full_output=False, mask=None, dt=None):
+        """
+        Run the compiled Ensemble Kalman Filter over a batch of independent
+        sequences in a single vectorised call. Every sequence is filtered
+        with its own key, split from key.
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+        init_state: array(n_sequences, state_size) or array(state_size)
+            Initial state estimate for each sequence
+        sample_obs: array(n_sequences, nsteps, obs_size)
+            Samples of the observations of each sequence
+        nensemble: int
+            Number of members of the ensemble
+        observations: array(n_sequences, nsteps, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(state_size,) or array(state_size, state_size) or None
+            Initial covariance, or its diagonal, shared by every
+            sequence. Defaults to Q
+        chunk_size: int or None
+            If given, filter chunk_size sequences at a time to bound the peak
+            memory. Every chunk has the same shape, so the filter is only
+            compiled once.
+        full_output: bool
+            If True, return the dictionary of the filter (see filter)
+        mask: array(n_sequences, nsteps) or None
+            Whether each observation is available
+        dt: array(n_sequences, nsteps) or None
+            Time elapsed since the previous step, passed as the
+            second argument to fz
+
+        Returns
+        -------
+        array(n_sequences, nsteps, state_size)
+            History of ensemble means
+        """
+        n_sequences = sample_obs.shape[0]
+        keys = random.split(key, n_sequences)
+        init_state = jnp.broadcast_to(init_state, (n_sequences, self.state_size))
+        batch = (keys, init_state, sample_obs, observations, mask, dt)
+        def filter_batch(*chunk): return self._filter_batch(*chunk, Vinit, nensemble, full_output)
+        return _map_chunks(filter_batch, batch, n_sequences, chunk_size)
+
+    def log_likelihood(self, key, init_state, sample_obs, nensemble=100, observations=None, Vinit=None,
+                       mask=None, dt=None):
+        """
+        Ensemble estimate of the total log-likelihood log p(x_{1:T}): the sum
+        of log p(x_t | x_{1:t-1}) under the Gaussian approximation of the filter
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+        init_state: array(state_size,)
+            Initial state estimate
+        sample_obs: array(nsteps, obs_size)
+            Samples of the observations
+        nensemble: int
+            Number of members of the ensemble
+        observations: array(nsteps, ...) or None
+            Covariates passed as the second argument to fx at each step
+        Vinit: array(state_size,) or array(state_size, state_size) or None
+            Initial covariance, or its diagonal. Defaults to Q
+        mask: array(nsteps) or None
+            Whether each observation is available
+        dt: array(nsteps) or None
+            Time elapsed since the previous step, passed as the
+            second argument to fz
+
+        Returns
+        -------
+        float: estimate of the log-likelihood of the observations
+        """
+        hist = self._filter_scan(key, init_state, sample_obs, nensemble, observations, Vinit, mask, dt, True)
+        return hist["loglik"].sum()
+
+    def fit_noise(self, *args, **kwargs):
+        """
+        Not available: the log-likelihood of the filter is a random
+        estimate that depends on the key, so it cannot be maximised by gradient ascent
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support fit_noise: its log-likelihood "
+                                  "is a random estimate that depends on the key")
+
+    def smooth(self, filter_hist):
+        """
+        Not available: the filter does not store the predicted moments
+        and cross-covariances used by the Rauch-Tung-Striebel smoother
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not store the predicted moments "
+                                  "needed by smooth")
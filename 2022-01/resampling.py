@@ -0,0 +1,142 @@
+# Resampling schemes of the particle filters
+# Usage: every scheme maps a PRNGKey and an array of normalised weights
+# to the indices of the resampled particles. RESAMPLING_SCHEMES maps the
+# names accepted by the filters to each scheme.
+# Cost for N particles: systematic and stratified resampling run in O(N).
+# Multinomial and residual resampling run in O(N log N): both match N values
+# against N sorted ones with a binary search (jnp.searchsorted). Multinomial
+# resampling draws its uniforms already sorted, which avoids an extra sort
+# but not the search.
+# Used by 2022-01/sequential_monte_carlo.py and 2021-07/nlds_lib.py
+
+# Author: Gerardo Durán-Martín (@gerdm)
+
+import jax
+import jax.numpy as jnp
+
+
+def _indices_from_counts(cumcounts):
+    """
+    Indices of the resampled particles given the cumulative number of
+    copies of each particle. Runs in O(n_particles)
+
+    Parameters
+    ----------
+    cumcounts: array(n_particles)
+        Non-decreasing number of copies of particles 0, ..., i
+
+    Returns
+    -------
+    array(n_particles): indices of the resampled particles
+    """
+    n = len(cumcounts)
+    cumcounts = jnp.clip(cumcounts, 0, n).at[-1].set(n)
+    ncopies = jnp.diff(cumcounts, prepend=0)
+    return jnp.repeat(jnp.arange(n), ncopies, total_repeat_length=n)
+
+
+def multinomial_resampling(key, weights):
+    """
+    Multinomial resampling. Sample len(weights) indices independently
+    with probabilities given by the weights. The uniforms are sampled
+    already sorted (as normalised cumulative sums of exponentials), so
+    that no sort is needed. Runs in O(n_particles log n_particles) through
+    a binary search of each cumulative weight among the uniforms
+
+    Parameters
+    ----------
+    key: jax.random.PRNGKey
+    weights: array(n_particles)
+        Normalised weights
+
+    Returns
+    -------
+    array(n_particles): indices of the resampled particles
+    """
+    n = len(weights)
+    exponentials = jnp.cumsum(jax.random.exponential(key, (n + 1,)))
+    uniforms = exponentials[:-1] / exponentials[-1]
+    cumcounts = jnp.searchsorted(uniforms, jnp.cumsum(weights))
+    return _indices_from_counts(cumcounts)
+
+
+def stratified_resampling(key, weights):
+    """
+    Stratified resampling: one uniform draw in each of the
+    n_particles strata [i / n, (i + 1) / n). Runs in O(n_particles)
+
+    Parameters
+    ----------
+    key: jax.random.PRNGKey
+    weights: array(n_particles)
+        Normalised weights
+
+    Returns
+    -------
+    array(n_particles): indices of the resampled particles
+    """
+    n = len(weights)
+    uniforms = jax.random.uniform(key, (n,))
+    # number of points (i + u_i) / n below each cumulative weight
+    cdf = n * jnp.cumsum(weights)
+    nstrata = jnp.floor(cdf).astype(jnp.int32)
+    cumcounts = nstrata + (uniforms[jnp.clip(nstrata, 0, n - 1)] < cdf - nstrata)
+    return _indices_from_counts(cumcounts)
+
+
+def systematic_resampling(key, weights):
+    """
+    Systematic resampling: a single uniform draw shifted across
+    the n_particles strata [i / n, (i + 1) / n). Runs in O(n_particles)
+
+    Parameters
+    ----------
+    key: jax.random.PRNGKey
+    weights: array(n_particles)
+        Normalised weights
+
+    Returns
+    -------
+    array(n_particles): indices of the resampled particles
+    """
+    n = len(weights)
+    u = jax.random.uniform(key)
+    # number of points (i + u) / n below each cumulative weight
+    cumcounts = jnp.ceil(n * jnp.cumsum(weights) - u).astype(jnp.int32)
+    return _indices_from_counts(cumcounts)
+
+
+def residual_resampling(key, weights):
+    """
+    Residual resampling: particle i is copied floor(n * w_i) times; the
+    remaining particles are sampled multinomially from the residual weights.
+    Runs in O(n_particles log n_particles) through a binary search of each
+    uniform among the cumulative residual weights
+
+    Parameters
+    ----------
+    key: jax.random.PRNGKey
+    weights: array(n_particles)
+        Normalised weights
+
+    Returns
+    -------
+    array(n_particles): indices of the resampled particles
+    """
+    n = len(weights)
+    ncopies = jnp.floor(n * weights).astype(jnp.int32)
+    ix_deterministic = _indices_from_counts(jnp.cumsum(ncopies))
+
+    residuals = n * weights - ncopies
+    cdf = jnp.cumsum(residuals) / jnp.maximum(residuals.sum(), 1e-30)
+    ix_residual = jnp.searchsorted(cdf, jax.random.uniform(key, (n,)))
+    ix_residual = jnp.clip(ix_residual, 0, n - 1)
+    return jnp.where(jnp.arange(n) < ncopies.sum(), ix_deterministic, ix_residual)
+
+
+RESAMPLING_SCHEMES = {
+    "multinomial": multinomial_resampling,
+    "systematic": systematic_resampling,
+    "stratified": stratified_resampling,
+    "residual": residual_resampling,
+}
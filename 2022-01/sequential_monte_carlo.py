@@ -1,10 +1,24 @@
 import jax
 import jax.numpy as jnp
 from jax.scipy.stats import norm
+from functools import partial
+from resampling import RESAMPLING_SCHEMES
 
+
+PROPOSALS = ("transition", "optimal")
+
+
+def _check_proposal(proposal):
+    if proposal not in PROPOSALS:
+        raise ValueError(f"proposal must be one of {list(PROPOSALS)}, got {proposal!r}")
+
+
+@jax.tree_util.register_pytree_node_class
 class NonMarkovianSM:
     """
-    Non-Markovian Gaussian Sequence Model
+    Non-Markovian Gaussian Sequence Model. The model is a pytree whose
+    leaves are its parameters (phi, beta, q, r), so compiled methods
+    follow the current parameters of the model
     """
     def __init__(self, phi, beta, q, r):
         """
@@ -23,6 +37,28 @@ class NonMarkovianSM:
         self.beta = beta
         self.q = q
         self.r = r
+
+    @classmethod
+    def from_unconstrained(cls, theta):
+        """
+        Initialise the model from the unconstrained parameters
+        theta = (phi, beta, log q, log r)
+        """
+        phi, beta, log_q, log_r = theta
+        return cls(phi, beta, jnp.exp(log_q), jnp.exp(log_r))
+
+    def unconstrained_params(self):
+        """
+        Unconstrained parameters (phi, beta, log q, log r) of the model
+        """
+        return jnp.array([self.phi, self.beta, jnp.log(self.q), jnp.log(self.r)])
+
+    def tree_flatten(self):
+        return (self.phi, self.beta, self.q, self.r), None
+
+    @classmethod
+    def tree_unflatten(cls, aux_data, params):
+        return cls(*params)
     
     @staticmethod
     def _obtain_weights(log_weights):
@@ -30,7 +66,7 @@ class NonMarkovianSM:
         return weights
 
     def sample_latent_step(self, key, x_prev):
-        x_next = jax.random.normal(key) * jnp.sqrt(self.q) + self.phi * x_prev
+        x_next = jax.random.normal(key, jnp.shape(x_prev)) * jnp.sqrt(self.q) + self.phi * x_prev
         return x_next
     
     def sample_observed_step(self, key, mu, x_curr):
@@ -91,7 +127,53 @@ class NonMarkovianSM:
         
         return simulations
     
-    def _sis_step(self, key, log_weights_prev, mu_prev, xparticles_prev, yobs):
+    def _propose(self, key, mu_prev, xparticles_prev, yobs, proposal):
+        """
+        Sample the particles at time t from the proposal and compute
+        their incremental log-weights.
+
+        * "transition": x_t ~ p(x_t | x_{t-1}), with incremental weight
+          p(y_t | x_t, mu_{t-1}).
+        * "optimal": x_t ~ p(x_t | x_{t-1}, mu_{t-1}, y_t), the locally
+          optimal proposal, with incremental weight p(y_t | x_{t-1}, mu_{t-1}).
+          Since y_t = beta * mu_{t-1} + x_t + v_t, both are Gaussian:
+          x_t | ... ~ N(s2 * (phi * x_{t-1} / q + (y_t - beta * mu_{t-1}) / r), s2)
+          with s2 = q * r / (q + r), and y_t | ... ~ N(beta * mu_{t-1} + phi * x_{t-1}, q + r).
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+            key to sample the particles.
+        mu_prev: array(n_particles)
+            Term carrying past cumulate values.
+        xparticles_prev: array(n_particles)
+            Samples / particles from the latent space at t-1
+        yobs: float
+            Observation at time t.
+        proposal: str
+            "transition" or "optimal"
+
+        Returns
+        -------
+        * array(n_particles): particles at time t
+        * array(n_particles): cumulative term mu at time t
+        * array(n_particles): incremental log-weights
+        """
+        if proposal == "transition":
+            xparticles = self.sample_latent_step(key, xparticles_prev)
+            mu = self.beta * mu_prev + xparticles
+            log_weights = norm.logpdf(yobs, loc=mu, scale=jnp.sqrt(self.r))
+            return xparticles, mu, log_weights
+
+        residual = yobs - self.beta * mu_prev
+        var_proposal = self.q * self.r / (self.q + self.r)
+        mean_proposal = var_proposal * (self.phi * xparticles_prev / self.q + residual / self.r)
+        xparticles = mean_proposal + jnp.sqrt(var_proposal) * jax.random.normal(key, jnp.shape(xparticles_prev))
+        mu = self.beta * mu_prev + xparticles
+        log_weights = norm.logpdf(residual, loc=self.phi * xparticles_prev, scale=jnp.sqrt(self.q + self.r))
+        return xparticles, mu, log_weights
+
+    def _sis_step(self, key, log_weights_prev, mu_prev, xparticles_prev, yobs, proposal="transition"):
         """
         Compute one step of the sequential-importance-sampling algorithm
         at time t.
@@ -106,25 +188,21 @@ class NonMarkovianSM:
             Samples / particles from the latent space at t-1
         yobs: float
             Observation at time t.
+        proposal: str
+            "transition" or "optimal" (see _propose)
         """
-        
-        key_particles = jax.random.split(key, len(xparticles_prev))
-        
-        # 1. Sample from proposal
-        xparticles = jax.vmap(self.sample_latent_step)(key_particles, xparticles_prev)
-        # 2. Evaluate unnormalised weights
-        # 2.1 Compute new mean
-        mu = self.beta * mu_prev + xparticles
-        # 2.2 Compute log-unnormalised weights
-        
-        log_weights = log_weights_prev + norm.logpdf(yobs, loc=mu, scale=jnp.sqrt(self.q))
+        # 1. Sample from proposal and compute the new mean
+        xparticles, mu, log_weights_increment = self._propose(key, mu_prev, xparticles_prev, yobs, proposal)
+        # 2. Compute log-unnormalised weights
+        log_weights = log_weights_prev + log_weights_increment
         
         return (log_weights, mu, xparticles), log_weights
     
-    def sequential_importance_sample(self, key, observations, n_particles=10):
+    def sequential_importance_sample(self, key, observations, n_particles=10, proposal="transition"):
         """
         Apply sequential importance sampling to a series of observations. Sampling
-        considers the transition distribution as the proposal.
+        considers the transition distribution as the proposal, or the locally
+        optimal proposal p(x_t | x_{t-1}, mu_{t-1}, y_t).
         
         Parameters
         ----------
@@ -134,7 +212,10 @@ class NonMarkovianSM:
             one-array of observed values.
         n_particles: int (default: 10)
             Total number of particles to consider in the SIS filter.
+        proposal: str (default: "transition")
+            "transition" or "optimal"
         """
+        _check_proposal(proposal)
         T = len(observations)
         key, key_init_particles = jax.random.split(key)
         keys = jax.random.split(key, T)
@@ -146,38 +227,153 @@ class NonMarkovianSM:
         carry_init = (init_log_weights, init_mu, init_xparticles)
         xs_tuple = (keys, observations)
         
-        _, log_weights = jax.lax.scan(lambda carry, xs: self._sis_step(xs[0], *carry, xs[1]), carry_init, xs_tuple)
+        _, log_weights = jax.lax.scan(lambda carry, xs: self._sis_step(xs[0], *carry, xs[1], proposal),
+                                      carry_init, xs_tuple)
         return log_weights
     
-    def _smc_step(self, key, log_weights_prev, mu_prev, xparticles_prev, yobs):
-        n_particles = len(xparticles_prev)
+    @staticmethod
+    def _resample_indices(key, log_weights, resample, ess_threshold):
+        """
+        Indices of the particles to propagate. Particles are resampled only
+        if their effective sample size is below ess_threshold * n_particles;
+        otherwise the resampling step is skipped altogether
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+        log_weights: array(n_particles)
+            Log-unnormalised weights
+        resample: function
+            Resampling scheme, one of RESAMPLING_SCHEMES
+        ess_threshold: float
+
+        Returns
+        -------
+        * array(n_particles): indices of the particles
+        * array(n_particles): log-normalised weights of the selected particles
+        * float: effective sample size before resampling
+        """
+        n_particles = len(log_weights)
+        log_weights = log_weights - jax.nn.logsumexp(log_weights)
+        weights = jnp.exp(log_weights)
+        ess = 1 / (weights ** 2).sum()
+        do_resample = ess < ess_threshold * n_particles
+        ix_sampled, log_weights = jax.lax.cond(
+            do_resample,
+            lambda: (resample(key, weights), jnp.full(n_particles, -jnp.log(n_particles))),
+            lambda: (jnp.arange(n_particles), log_weights)
+        )
+        return ix_sampled, log_weights, ess
+
+    def _smc_step(self, key, log_weights_prev, mu_prev, xparticles_prev, yobs, resample, ess_threshold,
+                  proposal="transition"):
+        """
+        Compute one step of the sequential Monte Carlo algorithm at time t:
+        (adaptive) resampling, propagation through the transition and
+        reweighting with the observation.
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+            key to resample and sample the particles.
+        log_weights_prev: array(n_particles)
+            Log-unnormalised weights at t-1
+        mu_prev: array(n_particles)
+            Term carrying past cumulate values.
+        xparticles_prev: array(n_particles)
+            Samples / particles from the latent space at t-1
+        yobs: float
+            Observation at time t.
+        resample: function
+            Resampling scheme, one of RESAMPLING_SCHEMES
+        ess_threshold: float
+            Resample whenever the effective sample size falls
+            below ess_threshold * n_particles
+        proposal: str
+            "transition" or "optimal" (see _propose)
+        """
         key, key_particles = jax.random.split(key)
-        key_particles = jax.random.split(key_particles, n_particles)
         
         # 1. Resample particles
-        weights = self._obtain_weights(log_weights_prev)
-        ix_sampled = jax.random.choice(key, n_particles, p=weights, shape=(n_particles,))
+        ix_sampled, log_weights_prev, ess = self._resample_indices(key, log_weights_prev, resample, ess_threshold)
         xparticles_prev_sampled = xparticles_prev[ix_sampled]
         mu_prev_sampled = mu_prev[ix_sampled]
-        # 2. Propagate particles
-        xparticles = jax.vmap(self.sample_latent_step)(key_particles, xparticles_prev_sampled)
-        # 3. Concatenate
-        mu = self.beta * mu_prev_sampled + xparticles
+        # 2. Propagate particles and concatenate
+        xparticles, mu, log_weights_increment = self._propose(key_particles, mu_prev_sampled,
+                                                              xparticles_prev_sampled, yobs, proposal)
 
-        # ToDo: return dictionary of log_weights and sampled indices
-        log_weights = norm.logpdf(yobs, loc=mu, scale=jnp.sqrt(self.q))
+        log_weights = log_weights_prev + log_weights_increment
+        # log_weights_prev are normalised: log p(y_t | y_{1:t-1}) estimate
+        log_evidence = jax.nn.logsumexp(log_weights)
         dict_carry = {
             "log_weights": log_weights,
-            "indices": ix_sampled
+            "indices": ix_sampled.astype(jnp.int32),
+            "particles": xparticles,
+            "ess": ess,
+            "log_evidence": log_evidence
         }
-        return (log_weights, mu, xparticles_prev_sampled), dict_carry
+        return (log_weights, mu, xparticles), dict_carry
 
-    
-    def sequential_monte_carlo(self, key, observations, n_particles=10):
+    def sequential_monte_carlo(self, key, observations, n_particles=10, resampling="multinomial",
+                               ess_threshold=1.0, store_weights=True, proposal="transition"):
         """
         Apply sequential Monte Carlo (SCM), a.k.a sequential importance resampling (SIR),
         a.k.a sequential importance sampling and resampling(SISR).
+
+        Parameters
+        ----------
+        key: jax.random.PRNGKey
+            Initial key.
+        observations: array(n_observations)
+            one-array of observed values.
+        n_particles: int (default: 10)
+            Total number of particles to consider in the SMC filter.
+        resampling: str (default: "multinomial")
+            Resampling scheme: "multinomial", "systematic", "stratified"
+            or "residual". Systematic and stratified resampling run in
+            O(n_particles) and give lower-variance estimates; residual and
+            multinomial resampling run in O(n_particles log n_particles)
+        ess_threshold: float (default: 1.0)
+            Particles are resampled at step t only if the effective sample
+            size of the weights at t-1 is below ess_threshold * n_particles.
+            1.0 resamples at every step (unless the weights are uniform);
+            0.5 is a common choice for adaptive resampling.
+        store_weights: bool (default: True)
+            Whether to keep the history of weights. If False, only the
+            ancestry (int32), the particles and the final weights are stored.
+        proposal: str (default: "transition")
+            "transition" propagates the particles through p(x_t | x_{t-1});
+            "optimal" samples from the locally optimal proposal
+            p(x_t | x_{t-1}, mu_{t-1}, y_t), which has the same cost per
+            particle and lower-variance weights
+
+        Returns
+        -------
+        dict:
+            * log_weights: array(n_observations, n_particles)
+                Log-unnormalised weights of the particles at each step
+                (only with store_weights=True)
+            * weights: array(n_observations, n_particles)
+                Normalised weights (only with store_weights=True)
+            * final_log_weights: array(n_particles)
+                Log-unnormalised weights at the last step
+            * indices: array(n_observations, n_particles) of int32
+                Ancestors of the particles at each step (arange if the
+                particles were not resampled). Paths are recovered with trace_paths
+            * particles: array(n_observations, n_particles)
+                Latent particles at each step
+            * ess: array(n_observations)
+                Effective sample size of the weights before resampling
+            * log_evidence: array(n_observations)
+                Estimates of log p(y_t | y_{1:t-1})
+            * log_marginal_likelihood: float
+                Estimate of log p(y_{1:T}), whose exponential is unbiased
         """
+        if resampling not in RESAMPLING_SCHEMES:
+            raise ValueError(f"resampling must be one of {list(RESAMPLING_SCHEMES)}, got {resampling!r}")
+        resample = RESAMPLING_SCHEMES[resampling]
+        _check_proposal(proposal)
+
         T = len(observations)
         key, key_particle_init = jax.random.split(key)
         keys = jax.random.split(key, T)
@@ -188,9 +384,310 @@ class NonMarkovianSM:
         
         carry_init = (init_log_weights, init_mu, init_xparticles)
         xs_tuple = (keys, observations)
-        _, dict_hist = jax.lax.scan(lambda carry, xs: self._smc_step(xs[0], *carry, xs[1]), carry_init, xs_tuple)
-        # transform log-unnormalised weights to weights
-        dict_hist["weights"] = jnp.exp(dict_hist["log_weights"] - jax.nn.logsumexp(dict_hist["log_weights"], axis=1, keepdims=True))
+        def smc_step(carry, xs):
+            carry, dict_carry = self._smc_step(xs[0], *carry, xs[1], resample, ess_threshold, proposal)
+            if not store_weights:
+                dict_carry.pop("log_weights")
+            return carry, dict_carry
+
+        (final_log_weights, _, _), dict_hist = jax.lax.scan(smc_step, carry_init, xs_tuple)
+        dict_hist["final_log_weights"] = final_log_weights
+        dict_hist["log_marginal_likelihood"] = dict_hist["log_evidence"].sum()
+        if store_weights:
+            # transform log-unnormalised weights to weights
+            dict_hist["weights"] = jnp.exp(dict_hist["log_weights"] - jax.nn.logsumexp(dict_hist["log_weights"], axis=1, keepdims=True))
         
         return dict_hist
+
+    @staticmethod
+    @jax.jit
+    def trace_ancestry(indices, final_indices):
+        """
+        Trace back the genealogy of a set of particles at the last step.
+
+        Parameters
+        ----------
+        indices: array(n_observations, n_particles)
+            Ancestors of the particles at each step, as returned by
+            sequential_monte_carlo
+        final_indices: array(n_paths)
+            Indices of the particles at the last step whose genealogy to trace
+
+        Returns
+        -------
+        array(n_observations, n_paths): index of the ancestor of each
+        path at every step
+        """
+        def trace_step(ix, indices_t):
+            return indices_t[ix], ix
+
+        _, ancestry = jax.lax.scan(trace_step, final_indices.astype(jnp.int32), indices, reverse=True)
+        return ancestry
+
+    def trace_paths(self, hist, final_indices=None):
+        """
+        Reconstruct the latent paths of the particles that survive up to
+        the last step of sequential_monte_carlo.
+
+        Parameters
+        ----------
+        hist: dict
+            Output of sequential_monte_carlo
+        final_indices: array(n_paths) or None
+            Indices of the particles at the last step whose paths to
+            reconstruct (e.g., sampled according to hist["final_log_weights"]).
+            Defaults to all the particles.
+
+        Returns
+        -------
+        * array(n_observations, n_paths): ancestry of the paths
+        * array(n_observations, n_paths): latent paths
+        """
+        _, n_particles = hist["indices"].shape
+        final_indices = jnp.arange(n_particles) if final_indices is None else final_indices
+        ancestry = self.trace_ancestry(hist["indices"], final_indices)
+        paths = jnp.take_along_axis(hist["particles"], ancestry, axis=1)
+        return ancestry, paths
+
+    def _kalman_matrices(self):
+        """
+        Linear-Gaussian form of the model over the augmented state s_t = (x_t, mu_t):
+        s_t = F s_{t-1} + w_t, w_t ~ N(0, Q);  y_t = H s_t + v_t, v_t ~ N(0, r)
+
+        Returns
+        -------
+        * array(2, 2): F
+        * array(2, 2): Q
+        * array(2): H
+        """
+        F = jnp.array([[self.phi, 0.0], [self.phi, self.beta]])
+        # mu_t = beta * mu_{t-1} + x_t shares the noise of x_t
+        Q = self.q * jnp.ones((2, 2))
+        H = jnp.array([0.0, 1.0])
+        return F, Q, H
+
+    def _kalman_step(self, state, yobs, F, Q, H):
+        """
+        Predict-update step of the Kalman filter over the augmented state.
+
+        Parameters
+        ----------
+        state: tuple
+            (mean, cov) filtered moments of (x, mu) at t-1
+        yobs: float
+            Observation at time t.
+        """
+        mean_prev, cov_prev = state
+        mean_pred = F @ mean_prev
+        cov_pred = F @ cov_prev @ F.T + Q
+
+        y_pred = H @ mean_pred
+        S = H @ cov_pred @ H + self.r
+        K = cov_pred @ H / S
+        mean = mean_pred + K * (yobs - y_pred)
+        cov = cov_pred - jnp.outer(K, K) * S
+
+        dict_carry = {
+            "mean": mean,
+            "cov": cov,
+            "mean_pred": mean_pred,
+            "cov_pred": cov_pred,
+            "log_evidence": norm.logpdf(yobs, loc=y_pred, scale=jnp.sqrt(S))
+        }
+        return (mean, cov), dict_carry
+
+    def _kalman_filter(self, observations):
+        """
+        Kalman filter over the augmented state (x, mu). Not compiled, so that
+        it can be vmapped over models built from traced parameters
+        """
+        F, Q, H = self._kalman_matrices()
+        # x_0 ~ N(0, q) and mu_0 = 0, as in sample_single
+        state_init = (jnp.zeros(2), jnp.diag(jnp.array([self.q, 0.0])))
+        _, dict_hist = jax.lax.scan(lambda state, y: self._kalman_step(state, y, F, Q, H),
+                                    state_init, observations)
+        dict_hist["log_marginal_likelihood"] = dict_hist["log_evidence"].sum()
+        return dict_hist
+
+    @jax.jit
+    def kalman_filter(self, observations):
+        """
+        Exact filtering distributions p(x_t, mu_t | y_{1:t}) and marginal likelihood
+        of the model, obtained with the Kalman filter over the augmented state (x, mu).
+        Runs in O(n_observations).
+
+        Parameters
+        ----------
+        observations: array(n_observations)
+            one-array of observed values.
+
+        Returns
+        -------
+        dict:
+            * mean: array(n_observations, 2)
+                Filtered mean of (x_t, mu_t)
+            * cov: array(n_observations, 2, 2)
+                Filtered covariance of (x_t, mu_t)
+            * mean_pred, cov_pred: predicted moments
+            * log_evidence: array(n_observations)
+                log p(y_t | y_{1:t-1})
+            * log_marginal_likelihood: float
+                log p(y_{1:T})
+        """
+        return self._kalman_filter(observations)
+
+    @jax.jit
+    def kalman_smoother(self, observations):
+        """
+        Exact smoothing distributions p(x_t, mu_t | y_{1:T}) of the model
+        (Rauch-Tung-Striebel smoother over the augmented state).
+
+        Parameters
+        ----------
+        observations: array(n_observations)
+            one-array of observed values.
+
+        Returns
+        -------
+        dict:
+            * mean: array(n_observations, 2)
+                Smoothed mean of (x_t, mu_t)
+            * cov: array(n_observations, 2, 2)
+                Smoothed covariance of (x_t, mu_t)
+        """
+        F, _, _ = self._kalman_matrices()
+        filter_hist = self._kalman_filter(observations)
+
+        def smooth_step(state, xs):
+            mean_next, cov_next = state
+            mean, cov, mean_pred_next, cov_pred_next = xs
+            # The augmented covariance is singular if beta = 0 (mu_t = x_t)
+            J = cov @ F.T @ jnp.linalg.pinv(cov_pred_next)
+            mean = mean + J @ (mean_next - mean_pred_next)
+            cov = cov + J @ (cov_next - cov_pred_next) @ J.T
+            return (mean, cov), (mean, cov)
+
+        state_init = (filter_hist["mean"][-1], filter_hist["cov"][-1])
+        xs = (filter_hist["mean"][:-1], filter_hist["cov"][:-1],
+              filter_hist["mean_pred"][1:], filter_hist["cov_pred"][1:])
+        _, (mean, cov) = jax.lax.scan(smooth_step, state_init, xs, reverse=True)
+        return {
+            "mean": jnp.concatenate([mean, state_init[0][None]]),
+            "cov": jnp.concatenate([cov, state_init[1][None]])
+        }
+
+    def log_likelihood(self, observations):
+        """
+        Exact log-marginal likelihood log p(y_{1:T}) of the model.
+        Not compiled, so that it can be composed with vmap and grad
+        over the parameters of the model
+        """
+        return self._kalman_filter(observations)["log_marginal_likelihood"]
+
+
+@jax.jit
+def kalman_log_likelihood_grid(observations, phi, beta, q, r):
+    """
+    Exact log-marginal likelihood of NonMarkovianSM over a grid of
+    parameters. phi, beta, q and r are broadcast against each other
+    and the likelihood is vmapped over the resulting grid.
+
+    Parameters
+    ----------
+    observations: array(n_observations)
+        one-array of observed values.
+    phi, beta, q, r: float or array
+        Parameters of the model
+
+    Returns
+    -------
+    array: log p(y_{1:T}) with the broadcast shape of the parameters
+    """
+    params = jnp.broadcast_arrays(phi, beta, q, r)
+    shape = params[0].shape
+    params = [p.ravel() for p in params]
+    log_lik = jax.vmap(lambda *p: NonMarkovianSM(*p).log_likelihood(observations))(*params)
+    return log_lik.reshape(shape)
+
+
+@partial(jax.jit, static_argnums=(3, 4, 6, 7, 8, 9))
+def particle_marginal_metropolis_hastings(key, observations, init_params, n_samples, n_particles=100,
+                                          step_size=0.1, log_prior=None, resampling="multinomial",
+                                          ess_threshold=0.5, proposal="transition"):
+    """
+    Particle-marginal Metropolis-Hastings (PMMH) over the parameters of
+    NonMarkovianSM. Each chain runs a Gaussian random-walk Metropolis-Hastings
+    over the unconstrained parameters theta = (phi, beta, log q, log r), where
+    the likelihood is replaced by its (unbiased) sequential Monte Carlo estimate.
+    Chains run in parallel (vmap) and the whole run is compiled.
+
+    Parameters
+    ----------
+    key: jax.random.PRNGKey
+        Initial key.
+    observations: array(n_observations)
+        one-array of observed values.
+    init_params: array(n_chains, 4)
+        Initial unconstrained parameters of each chain
+    n_samples: int
+        Number of Metropolis-Hastings steps of each chain
+    n_particles: int (default: 100)
+        Number of particles of the likelihood estimate
+    step_size: float or array(4) (default: 0.1)
+        Standard deviation of the random-walk proposal
+    log_prior: function or None
+        Log-prior density of the unconstrained parameters. Defaults to
+        a flat prior over theta
+    resampling: str (default: "multinomial")
+        Resampling scheme of sequential_monte_carlo
+    ess_threshold: float (default: 0.5)
+        Resampling threshold of sequential_monte_carlo
+    proposal: str (default: "transition")
+        Proposal of sequential_monte_carlo. "optimal" lowers the variance
+        of the likelihood estimate, and so raises the acceptance rate
+
+    Returns
+    -------
+    dict:
+        * params: array(n_chains, n_samples, 4)
+            Samples of the unconstrained parameters
+        * log_marginal_likelihood: array(n_chains, n_samples)
+            Likelihood estimate of the current state of each chain
+        * acceptance_rate: array(n_chains)
+    """
+    def log_target(key, theta):
+        model = NonMarkovianSM.from_unconstrained(theta)
+        hist = model.sequential_monte_carlo(key, observations, n_particles, resampling, ess_threshold,
+                                            store_weights=False, proposal=proposal)
+        log_lik = hist["log_marginal_likelihood"]
+        log_lik = jnp.where(jnp.isnan(log_lik), -jnp.inf, log_lik)
+        log_prior_theta = 0.0 if log_prior is None else log_prior(theta)
+        return log_lik, log_lik + log_prior_theta
+
+    def mh_step(state, key):
+        theta, log_lik, log_post = state
+        key_proposal, key_smc, key_accept = jax.random.split(key, 3)
+        theta_proposal = theta + step_size * jax.random.normal(key_proposal, theta.shape)
+        log_lik_proposal, log_post_proposal = log_target(key_smc, theta_proposal)
+        accept = jnp.log(jax.random.uniform(key_accept)) < log_post_proposal - log_post
+        theta = jnp.where(accept, theta_proposal, theta)
+        log_lik = jnp.where(accept, log_lik_proposal, log_lik)
+        log_post = jnp.where(accept, log_post_proposal, log_post)
+        return (theta, log_lik, log_post), (theta, log_lik, accept)
+
+    def run_chain(key, theta_init):
+        key_init, key_chain = jax.random.split(key)
+        state_init = (theta_init, *log_target(key_init, theta_init))
+        keys = jax.random.split(key_chain, n_samples)
+        _, (params, log_lik, accepted) = jax.lax.scan(mh_step, state_init, keys)
+        return params, log_lik, accepted.mean(dtype=params.dtype)
+
+    n_chains, _ = init_params.shape
+    keys = jax.random.split(key, n_chains)
+    params, log_lik, acceptance_rate = jax.vmap(run_chain)(keys, init_params)
+    return {
+        "params": params,
+        "log_marginal_likelihood": log_lik,
+        "acceptance_rate": acceptance_rate
+    }
     
\ No newline at end of file
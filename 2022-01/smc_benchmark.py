@@ -0,0 +1,224 @@
+# Benchmarks for the particle filters of the non-Markovian Gaussian sequence model
+# Usage: python smc_benchmark.py
+
+# Author: Gerardo Durán-Martín (@gerdm)
+
+import jax
+import jax.numpy as jnp
+from functools import partial
+from time import perf_counter
+from sequential_monte_carlo import (NonMarkovianSM, RESAMPLING_SCHEMES, PROPOSALS,
+                                    particle_marginal_metropolis_hastings, kalman_log_likelihood_grid)
+
+
+def time_call(f, *args, nruns=3):
+    """
+    Time the execution of f(*args), blocking until
+    the result is available
+
+    Returns
+    -------
+    * float: time (in seconds) of the first call
+    * float: best time (in seconds) over nruns further calls
+    """
+    tinit = perf_counter()
+    jax.block_until_ready(f(*args))
+    time_first = perf_counter() - tinit
+
+    time_best = time_first
+    for _ in range(nruns):
+        tinit = perf_counter()
+        jax.block_until_ready(f(*args))
+        time_best = min(time_best, perf_counter() - tinit)
+    return time_first, time_best
+
+
+def benchmark_resampling(n_particles_list=(10_000, 100_000, 1_000_000)):
+    """
+    Run time of a single resampling step for each scheme against the generic
+    categorical draw jax.random.choice(..., p=weights) previously used by
+    NonMarkovianSM._smc_step
+    """
+    def choice_resampling(key, weights):
+        n = len(weights)
+        return jax.random.choice(key, n, p=weights, shape=(n,))
+
+    schemes = {"choice": choice_resampling, **RESAMPLING_SCHEMES}
+    key = jax.random.PRNGKey(314)
+    print(f"{'particles':>10} " + " ".join(f"{name:>12}" for name in schemes) + "  (ms)")
+    for n_particles in n_particles_list:
+        log_weights = jax.random.normal(key, (n_particles,)) * 2
+        weights = jnp.exp(log_weights - jax.nn.logsumexp(log_weights))
+        times = []
+        for resample in schemes.values():
+            _, time_run = time_call(jax.jit(resample), key, weights)
+            times.append(time_run)
+        print(f"{n_particles:>10} " + " ".join(f"{1e3 * t:>12.3f}" for t in times))
+
+
+def benchmark_smc(n_particles_list=(10_000, 100_000, 1_000_000), nsteps=100, ess_thresholds=(1.0, 0.5)):
+    """
+    Throughput (particles x steps per second) of the compiled sequential
+    Monte Carlo filter for each resampling scheme, resampling at every step
+    (ess_threshold=1.0) or adaptively (ess_threshold=0.5)
+    """
+    model = NonMarkovianSM(phi=0.9, beta=0.5, q=1.0, r=1.0)
+    key = jax.random.PRNGKey(314)
+    key_sample, key_filter = jax.random.split(key)
+    observations = model.sample(key_sample, nsteps)["y"]
+
+    print(f"{'particles':>10} {'resampling':>12} {'ess thr':>8} {'resampled':>10} {'run (s)':>8} {'Mparticle-steps/s':>18}")
+    for n_particles in n_particles_list:
+        for resampling in RESAMPLING_SCHEMES:
+            for ess_threshold in ess_thresholds:
+                smc = jax.jit(partial(model.sequential_monte_carlo, n_particles=n_particles,
+                                      resampling=resampling, ess_threshold=ess_threshold))
+                hist = smc(key_filter, observations)
+                _, time_run = time_call(smc, key_filter, observations, nruns=1)
+                resampled = (hist["ess"] < ess_threshold * n_particles).mean()
+                throughput = n_particles * nsteps / time_run / 1e6
+                print(f"{n_particles:>10} {resampling:>12} {ess_threshold:>8.1f} {resampled:>10.2f} "
+                      f"{time_run:>8.3f} {throughput:>18.1f}")
+
+
+def benchmark_ancestry(n_particles_list=(10_000, 100_000, 1_000_000), nsteps=100, n_paths=100):
+    """
+    Memory of the history returned by sequential_monte_carlo with and without
+    the weights, and run time of the compiled backward trace of the genealogy
+    for every particle and for a subset of n_paths paths. "unique" is the number
+    of distinct ancestors at the first step among all the surviving paths
+    """
+    model = NonMarkovianSM(phi=0.9, beta=0.5, q=1.0, r=1.0)
+    key = jax.random.PRNGKey(314)
+    key_sample, key_filter, key_paths = jax.random.split(key, 3)
+    observations = model.sample(key_sample, nsteps)["y"]
+
+    def nbytes(hist):
+        return sum(v.nbytes for v in hist.values())
+
+    print(f"{'particles':>10} {'hist (MB)':>10} {'no weights (MB)':>16} {'trace all (ms)':>15} "
+          f"{f'trace {n_paths} (ms)':>15} {'unique':>7}")
+    for n_particles in n_particles_list:
+        hist_full = model.sequential_monte_carlo(key_filter, observations, n_particles, ess_threshold=0.5)
+        memory_full = nbytes(hist_full)
+        del hist_full
+        hist = model.sequential_monte_carlo(key_filter, observations, n_particles, ess_threshold=0.5,
+                                            store_weights=False)
+        final_indices = jax.random.randint(key_paths, (n_paths,), 0, n_particles)
+        _, time_all = time_call(model.trace_paths, hist)
+        _, time_subset = time_call(model.trace_paths, hist, final_indices)
+        ancestry, _ = model.trace_paths(hist)
+        unique = len(jnp.unique(ancestry[0]))
+        print(f"{n_particles:>10} {memory_full / 2 ** 20:>10.1f} {nbytes(hist) / 2 ** 20:>16.1f} "
+              f"{1e3 * time_all:>15.2f} {1e3 * time_subset:>15.3f} {unique:>7}")
+
+
+def benchmark_pmmh(n_chains_list=(1, 8, 32), n_samples=1_000, n_particles=100, nsteps=100):
+    """
+    Run time of the compiled particle-marginal Metropolis-Hastings over the
+    parameters of the model as the number of chains run in parallel grows,
+    with the acceptance rate and the posterior mean of (phi, beta, q, r) over
+    the second half of the chains
+    """
+    model = NonMarkovianSM(phi=0.9, beta=0.5, q=1.0, r=0.5)
+    key = jax.random.PRNGKey(314)
+    key_sample, key_pmmh = jax.random.split(key)
+    observations = model.sample(key_sample, nsteps)["y"]
+    theta_init = jnp.array([0.5, 0.2, 0.0, 0.0])
+
+    print(f"{'chains':>7} {'1st (s)':>8} {'run (s)':>8} {'acceptance':>11} {'phi':>6} {'beta':>6} {'q':>6} {'r':>6}")
+    for n_chains in n_chains_list:
+        init_params = jnp.tile(theta_init, (n_chains, 1))
+        pmmh = partial(particle_marginal_metropolis_hastings, n_samples=n_samples, n_particles=n_particles)
+        time_first, time_run = time_call(pmmh, key_pmmh, observations, init_params, nruns=1)
+        hist = pmmh(key_pmmh, observations, init_params)
+        params = hist["params"][:, n_samples // 2:].reshape(-1, 4)
+        phi, beta, log_q, log_r = params.T
+        print(f"{n_chains:>7} {time_first:>8.2f} {time_run:>8.2f} {hist['acceptance_rate'].mean():>11.2f} "
+              f"{phi.mean():>6.2f} {beta.mean():>6.2f} {jnp.exp(log_q).mean():>6.2f} {jnp.exp(log_r).mean():>6.2f}")
+
+
+def benchmark_kalman(grid_size=100, nsteps=100, n_particles_list=(100, 1_000, 10_000), nreps=20):
+    """
+    Run time of the exact log-likelihood (Kalman filter over the augmented
+    state) on a grid_size x grid_size grid of (phi, beta) against a single
+    SMC estimate, and error of the SMC filtered mean of x_t and log-likelihood
+    with respect to the exact values, averaged over nreps runs.
+
+    The mean SMC log-likelihood must lie within four standard errors of
+    the exact value, allowing for the downward bias (about half the variance)
+    of the log of the unbiased likelihood estimate; an AssertionError is
+    raised otherwise
+    """
+    model = NonMarkovianSM(phi=0.9, beta=0.5, q=1.0, r=0.5)
+    key = jax.random.PRNGKey(314)
+    key_sample, key_filter = jax.random.split(key)
+    observations = model.sample(key_sample, nsteps)["y"]
+
+    phi_grid = jnp.linspace(-0.95, 0.95, grid_size)[:, None]
+    beta_grid = jnp.linspace(0.0, 0.95, grid_size)[None, :]
+    _, time_grid = time_call(kalman_log_likelihood_grid, observations, phi_grid, beta_grid, model.q, model.r)
+    print(f"exact log-likelihood over a {grid_size}x{grid_size} grid: {1e3 * time_grid:.2f} ms "
+          f"({1e6 * time_grid / grid_size ** 2:.2f} us per model)")
+
+    kf_hist = model.kalman_filter(observations)
+    keys = jax.random.split(key_filter, nreps)
+    print(f"{'particles':>10} {'smc (ms)':>9} {'mean error':>11} {'loglik error':>13} {'sd loglik':>10}")
+    for n_particles in n_particles_list:
+        smc = jax.jit(partial(model.sequential_monte_carlo, n_particles=n_particles, ess_threshold=0.5))
+        _, time_smc = time_call(smc, key_filter, observations)
+        hist = jax.lax.map(lambda key: smc(key, observations), keys)
+        mean_smc = (hist["weights"] * hist["particles"]).sum(axis=-1)
+        mean_error = jnp.abs(mean_smc - kf_hist["mean"][:, 0]).max(axis=-1).mean()
+        log_lik = hist["log_marginal_likelihood"]
+        loglik_error = log_lik.mean() - kf_hist["log_marginal_likelihood"]
+        loglik_sd = log_lik.std()
+        print(f"{n_particles:>10} {1e3 * time_smc:>9.2f} {mean_error:>11.3f} {loglik_error:>13.3f} {loglik_sd:>10.3f}")
+        tolerance = 4 * loglik_sd / nreps ** 0.5 + loglik_sd ** 2 / 2
+        assert abs(loglik_error) < tolerance, (f"SMC log-likelihood with {n_particles} particles is "
+                                               f"{loglik_error:.3f} away from the Kalman filter (> {tolerance:.3f})")
+
+
+def benchmark_proposal(n_particles_list=(10, 100, 1_000, 10_000), nsteps=100, nreps=20):
+    """
+    Transition against locally optimal proposal in the sequential Monte Carlo
+    filter, with informative observations (r << q): run time, mean effective
+    sample size (as a fraction of the particles), standard deviation of the
+    log-likelihood estimate over nreps runs, and mean absolute error of the
+    filtered mean of x_t with respect to the Kalman filter
+    """
+    model = NonMarkovianSM(phi=0.9, beta=0.5, q=1.0, r=0.1)
+    key = jax.random.PRNGKey(314)
+    key_sample, key_filter = jax.random.split(key)
+    observations = model.sample(key_sample, nsteps)["y"]
+    mean_kf = model.kalman_filter(observations)["mean"][:, 0]
+    keys = jax.random.split(key_filter, nreps)
+
+    print(f"{'particles':>10} {'proposal':>11} {'run (ms)':>9} {'ess / N':>8} {'sd loglik':>10} {'mean error':>11}")
+    for n_particles in n_particles_list:
+        for proposal in PROPOSALS:
+            smc = jax.jit(partial(model.sequential_monte_carlo, n_particles=n_particles,
+                                  ess_threshold=0.5, proposal=proposal))
+            _, time_run = time_call(smc, key_filter, observations)
+            hist = jax.lax.map(lambda key: smc(key, observations), keys)
+            ess = hist["ess"].mean() / n_particles
+            mean_smc = (hist["weights"] * hist["particles"]).sum(axis=-1)
+            mean_error = jnp.abs(mean_smc - mean_kf).mean()
+            print(f"{n_particles:>10} {proposal:>11} {1e3 * time_run:>9.2f} {ess:>8.2f} "
+                  f"{hist['log_marginal_likelihood'].std():>10.3f} {mean_error:>11.4f}")
+
+
+def run_all():
+    """
+    Print the comparison tables of every benchmark
+    """
+    benchmark_resampling()
+    benchmark_smc()
+    benchmark_ancestry()
+    benchmark_pmmh()
+    benchmark_kalman()
+    benchmark_proposal()
+
+
+if __name__ == "__main__":
+    run_all()